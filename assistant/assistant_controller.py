@@ -1,34 +1,492 @@
-from fastapi import APIRouter, UploadFile, HTTPException
-from fastapi.responses import FileResponse
-from assistant.assistant_service import handle_audio_from_user
+from fastapi import APIRouter, Body, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+from starlette.requests import HTTPConnection
+from assistant.assistant_service import (
+    generate_audio_reply_for_user, stream_audio_reply_for_user, transcribe_speech, stream_audio_reply_for_text,
+    synthesize_text
+)
+from assistant.reply_cache import get_reply_cache, get_text_audio_cache, SharedReply
+from assistant.upload_intake import receive_audio_upload, SpooledUpload, UploadRejected, UPLOAD_FIELD_NAME
+from audio_handling.reply_formats import negotiate_reply_format, ReplyFormat, UnsupportedReplyFormat, REPLY_CODECS
+from chat_service import get_chat_interface
+from transcoding.speech_endpointing import listen_for_utterance
+from utils.admission import get_admission_controller, AdmissionRejected, Admission
+from utils.metrics import start_trace, set_trace_attribute, RequestTrace
+from typing import AsyncIterator, List, Optional, Tuple
+from uuid import uuid4
+import json
+import os
 import traceback
 
 controller = APIRouter(prefix='/voice-assistant')
 
+# Clients identify their conversation with this header, or with the cookie set on first contact
+SESSION_HEADER_NAME = 'X-Session-ID'
+SESSION_COOKIE_NAME = 'va_session_id'
+SESSION_COOKIE_MAX_AGE_SECONDS = 30 * 24 * 3600
+# Callers may pass their own request ID to correlate logs; it is echoed back in the response
+REQUEST_ID_HEADER_NAME = 'X-Request-ID'
+# Clients retrying an audio message send the same key so it is only processed once
+IDEMPOTENCY_KEY_HEADER_NAME = 'Idempotency-Key'
+# Query parameters choosing the reply format; they take precedence over the Accept header
+REPLY_FORMAT_QUERY = Query(None, alias='format', description=f"One of {', '.join(REPLY_CODECS)}")
+REPLY_SAMPLE_RATE_QUERY = Query(None, description="Sample rate of the reply in Hz")
+REPLY_BITRATE_QUERY = Query(None, description="Bitrate of MP3, Opus or Vorbis replies, such as 32k")
+# Longest text message accepted, in characters
+TEXT_MESSAGE_MAX_LENGTH = int(os.getenv('TEXT_MESSAGE_MAX_LENGTH', '4000'))
 
-@controller.post('/audio-message', status_code=200)
-async def handle_receive_audio_data(file: UploadFile):
+
+def __get_session_id(request: HTTPConnection) -> Tuple[str, bool]:
+    """Get the caller's session ID and whether it was newly created"""
+    session_id = request.headers.get(SESSION_HEADER_NAME) or request.cookies.get(SESSION_COOKIE_NAME)
+    if session_id:
+        return session_id, False
+    return str(uuid4()), True
+
+
+def __set_session_cookie(response: Response, session_id: str) -> None:
+    response.set_cookie(
+        SESSION_COOKIE_NAME,
+        session_id,
+        max_age=SESSION_COOKIE_MAX_AGE_SECONDS,
+        httponly=True,
+        samesite='lax'
+    )
+
+
+async def __prepend_chunk(first_chunk: bytes, audio_chunks: AsyncIterator[bytes],
+                          trace: RequestTrace) -> AsyncIterator[bytes]:
     try:
-        print('\n=== Received audio file ===')
-        print(f'Filename: {file.filename}')
-        print(f'Content type: {file.content_type}')
+        yield first_chunk
+        async for chunk in audio_chunks:
+            yield chunk
+        trace.finish()
+    except Exception:
+        trace.finish('error')
+        raise
+    finally:
+        # The client went away before the reply was complete
+        trace.finish('cancelled')
+        # Stop reading the reply, which cancels it if no other client is reading it
+        await audio_chunks.aclose()
+
+
+async def __admit(trace: RequestTrace) -> Admission:
+    """Wait for a turn to run the pipeline, or turn the request away with a 429 if the server is at capacity"""
+    try:
+        return await get_admission_controller().admit()
+    except AdmissionRejected as e:
+        trace.finish('rejected')
+        print(f"Rejected request {trace.request_id}: {str(e)}")
+        raise HTTPException(
+            status_code=429,
+            detail=str(e),
+            headers={'Retry-After': str(e.retry_after_seconds)}
+        )
+
+
+def __get_reply_format(request: Request, codec: Optional[str], sample_rate: Optional[int],
+                       bitrate: Optional[str], trace: RequestTrace) -> ReplyFormat:
+    """Choose the reply's format, or turn the request away with a 400 or 406 before the upload is read"""
+    try:
+        return negotiate_reply_format(request.headers.get('accept'), codec, sample_rate, bitrate)
+    except UnsupportedReplyFormat as e:
+        trace.finish('rejected')
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+def __get_reply_key(request: Request, upload: SpooledUpload, session_id: str,
+                    is_new_session: bool, reply_format: ReplyFormat) -> Optional[tuple]:
+    """
+    Identify retries of the same audio message: by the Idempotency-Key header,
+    or else by a hash of the upload within the caller's conversation. A retry
+    asking for another format gets a reply of its own.
+    """
+    # A retry carries the session cookie if the first attempt got one back
+    scope = None if is_new_session else session_id
+    idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER_NAME)
+    if idempotency_key:
+        return 'key', scope, idempotency_key, reply_format.key
+    if scope is None:
+        return None
+    return 'upload', scope, upload.sha256, reply_format.key
+
+
+async def __generate_reply_chunks(file_data: bytes, session_id: str, stream: bool,
+                                  reply_format: ReplyFormat) -> AsyncIterator[bytes]:
+    if stream:
+        async for audio_chunk in stream_audio_reply_for_user(file_data, session_id, reply_format):
+            yield audio_chunk
+    else:
+        yield await generate_audio_reply_for_user(file_data, session_id, reply_format)
+
 
-        file_data = await file.read()
-        print(f'File size: {len(file_data)} bytes')
+async def __start_reply(upload: SpooledUpload, reply_key: Optional[tuple], session_id: str,
+                        stream: bool, reply_format: ReplyFormat, trace: RequestTrace) -> SharedReply:
+    reply_cache = get_reply_cache()
+    # Admit the request before reading the upload into memory
+    admission = await __admit(trace)
+    try:
+        # Another attempt may have started the reply while this one waited
+        reply = reply_cache.get(reply_key)
+        if reply is not None:
+            admission.release()
+            return reply
 
-        generated_ai_audio_file_path = await handle_audio_from_user(file_data)
-        print(f'Generated audio path: {generated_ai_audio_file_path}')
+        file_data = await upload.read()
 
-        return FileResponse(
-            generated_ai_audio_file_path,
-            media_type='audio/mpeg',
-            filename='ai_output.mp3'
+        # The pipeline keeps its admission until it has finished, or is cancelled once no client reads it
+        return reply_cache.start(
+            reply_key, session_id, __generate_reply_chunks(file_data, session_id, stream, reply_format),
+            on_done=admission.release
         )
+    except Exception:
+        admission.release()
+        raise
+
+
+async def __receive_upload(request: Request, trace: RequestTrace) -> SpooledUpload:
+    """Receive the audio, or turn it away with a 413 or 415 before anything is spent on it"""
+    try:
+        return await receive_audio_upload(request)
+    except UploadRejected as e:
+        trace.finish('rejected')
+        print(f"Rejected upload {trace.request_id}: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+
+@controller.post('/audio-message', status_code=200, openapi_extra={
+    # The upload is streamed from the request rather than parsed by FastAPI, so describe it here
+    'requestBody': {'required': True, 'content': {'multipart/form-data': {'schema': {
+        'type': 'object',
+        'properties': {UPLOAD_FIELD_NAME: {'type': 'string', 'format': 'binary'}},
+        'required': [UPLOAD_FIELD_NAME],
+    }}}}
+})
+async def handle_receive_audio_data(request: Request, stream: bool = False,
+                                    reply_codec: Optional[str] = REPLY_FORMAT_QUERY,
+                                    sample_rate: Optional[int] = REPLY_SAMPLE_RATE_QUERY,
+                                    bitrate: Optional[str] = REPLY_BITRATE_QUERY):
+    trace = start_trace('audio-message', request.headers.get(REQUEST_ID_HEADER_NAME))
+    reply_format = __get_reply_format(request, reply_codec, sample_rate, bitrate, trace)
+    set_trace_attribute('reply_format', reply_format.key)
+    upload = await __receive_upload(request, trace)
+    try:
+        print('\n=== Received audio file ===')
+        print(f'Filename: {upload.filename}')
+        print(f'Content type: {upload.content_type}')
+        print(f'File size: {upload.size} bytes ({upload.audio_format}, '
+              f'about {upload.estimated_seconds or 0:.1f}s)')
+
+        session_id, is_new_session = __get_session_id(request)
+        print(f'Session: {session_id}{" (new)" if is_new_session else ""}')
+
+        try:
+            # Retries attach to the reply of the first attempt instead of running the pipeline again
+            reply_key = __get_reply_key(request, upload, session_id, is_new_session, reply_format)
+            reply = get_reply_cache().get(reply_key)
+            if reply is not None:
+                print(f'Replaying the reply to an earlier attempt ({"complete" if reply.done else "in progress"})')
+                set_trace_attribute('replayed', True)
+            else:
+                reply = await __start_reply(upload, reply_key, session_id, stream, reply_format, trace)
+        finally:
+            # The pipeline has its own copy of the audio by now
+            upload.close()
 
+        if stream:
+            # Wait for the first sentence before sending headers so failures in
+            # transcription or the chat stage still surface as a 500
+            audio_chunks = reply.iterate()
+            first_chunk = await anext(audio_chunks, b'')
+            print('Streaming audio response')
+
+            response = StreamingResponse(
+                __prepend_chunk(first_chunk, audio_chunks, trace),
+                media_type=reply_format.media_type
+            )
+        else:
+            response = Response(
+                await reply.read(),
+                media_type=reply_format.media_type,
+                headers={'Content-Disposition': f'attachment; filename="ai_output.{reply_format.extension}"'}
+            )
+            trace.finish()
+
+        # The format may have been chosen from the Accept header
+        response.headers['Vary'] = 'Accept'
+
+        # When streaming, only the stages finished before the first sentence are included
+        response.headers['Server-Timing'] = trace.server_timing()
+        response.headers[REQUEST_ID_HEADER_NAME] = trace.request_id
+
+        if is_new_session:
+            # The conversation of the first attempt, for a retry that never got its cookie
+            __set_session_cookie(response, reply.session_id)
+        return response
+
+    except HTTPException:
+        raise
     except Exception as e:
+        trace.finish('error')
         print(f"\n❌ Error in handle_receive_audio_data: {str(e)}")
         print(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(
             status_code=500,
             detail=f"Error processing audio: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+
+def __format_event(event: str, data: dict) -> str:
+    """Format a Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class _AdmittedStreamingResponse(StreamingResponse):
+    """
+    A streaming response that gives back the request's admission once it has
+    been sent, or has failed to be, even if its body was never started
+    """
+
+    def __init__(self, content: AsyncIterator[str], admission: Admission, trace: RequestTrace, **kwargs):
+        super().__init__(content, **kwargs)
+        self.admission = admission
+        self.trace = trace
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.release()
+            # Only recorded if the body didn't get to finish the trace
+            self.trace.finish('cancelled')
+
+
+async def __stream_text_reply(text_content: str, session_id: str, reply_format: Optional[ReplyFormat],
+                              trace: RequestTrace) -> AsyncIterator[str]:
+    """
+    Yield the reply to a text message as Server-Sent Events, one speakable unit
+    at a time. Audio for each unit is synthesized in the background and can be
+    fetched from its audio_url as soon as the unit has been sent. The stream,
+    and so the request's admission, last until all of the audio has been synthesized.
+    """
+    unit_audio: List[SharedReply] = []
+    completed = False
+    try:
+        index = 0
+        async for unit in get_chat_interface().stream_response(text_content, session_id):
+            event = {'index': index, 'text': unit}
+            if reply_format is not None:
+                audio_id = uuid4().hex
+                unit_audio.append(get_text_audio_cache().start(
+                    audio_id, session_id, synthesize_text(unit, reply_format),
+                    media_type=reply_format.media_type
+                ))
+                event['audio_url'] = f"{controller.prefix}/text-message/audio/{audio_id}"
+            yield __format_event('text', event)
+            index += 1
+
+        for audio in unit_audio:
+            await audio.wait()
+        completed = True
+        yield __format_event('done', {
+            'request_id': trace.request_id,
+            'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in trace.stage_durations().items()}
+        })
+        trace.finish()
+    except Exception as e:
+        # The response has already started, so errors are reported as an event
+        trace.finish('error')
+        print(f"\n❌ Error in handle_receive_text_message: {str(e)}")
+        print(f"Traceback: {traceback.format_exc()}")
+        yield __format_event('error', {'detail': f"Error getting response: {str(e)}"})
+    finally:
+        if not completed:
+            # Nobody will fetch the audio of a reply that was cut short
+            for audio in unit_audio:
+                audio.cancel()
+        # The client went away before the reply was complete
+        trace.finish('cancelled')
+
+
+@controller.post('/text-message', status_code=200, response_class=StreamingResponse, responses={
+    200: {'content': {'text/event-stream': {}}, 'description': "The reply as Server-Sent Events"}
+})
+async def handle_receive_text_message(request: Request,
+                                      text: str = Body(..., embed=True, max_length=TEXT_MESSAGE_MAX_LENGTH),
+                                      audio: bool = False,
+                                      reply_codec: Optional[str] = REPLY_FORMAT_QUERY,
+                                      sample_rate: Optional[int] = REPLY_SAMPLE_RATE_QUERY,
+                                      bitrate: Optional[str] = REPLY_BITRATE_QUERY):
+    """
+    Chat with text, for clients that recognize speech themselves. The reply
+    is streamed as Server-Sent Events: a "text" event for each sentence, with
+    an "audio_url" to fetch its speech from if audio=true, then a "done" event
+    once all of it has been synthesized, or an "error" event if the reply
+    failed part way.
+    """
+    trace = start_trace('text-message', request.headers.get(REQUEST_ID_HEADER_NAME))
+    if not text.strip():
+        trace.finish('rejected')
+        raise HTTPException(status_code=422, detail="The text is empty")
+    reply_format = None
+    if audio:
+        try:
+            reply_format = negotiate_reply_format(None, reply_codec, sample_rate, bitrate)
+        except UnsupportedReplyFormat as e:
+            trace.finish('rejected')
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    session_id, is_new_session = __get_session_id(request)
+    # Admitted before the response starts, so a busy server can still answer with a 429
+    admission = await __admit(trace)
+
+    response = _AdmittedStreamingResponse(
+        __stream_text_reply(text.strip(), session_id, reply_format, trace),
+        admission,
+        trace,
+        media_type='text/event-stream',
+        # Don't let proxies hold events back
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.headers[REQUEST_ID_HEADER_NAME] = trace.request_id
+    if is_new_session:
+        __set_session_cookie(response, session_id)
+    return response
+
+
+@controller.get('/text-message/audio/{audio_id}')
+async def handle_get_text_message_audio(audio_id: str):
+    """The speech of one sentence of a text reply, waiting for it if it is still being synthesized"""
+    reply = get_text_audio_cache().get(audio_id)
+    if reply is None:
+        raise HTTPException(status_code=404, detail=f"No audio {audio_id}, or it has expired")
+    try:
+        return Response(await reply.read(), media_type=reply.media_type)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error synthesizing audio: {str(e)}")
+
+
+@controller.delete('/conversation', status_code=204)
+async def handle_clear_conversation(request: Request):
+    session_id, is_new_session = __get_session_id(request)
+    if not is_new_session:
+        await get_chat_interface().clear_history(session_id)
+    return Response(status_code=204)
+
+
+async def __get_control_message_type(websocket: WebSocket, text: str) -> Optional[str]:
+    """Get the type of a control message, answering one that isn't a JSON object with an error message"""
+    try:
+        control_message = json.loads(text)
+    except json.JSONDecodeError:
+        control_message = None
+    if not isinstance(control_message, dict):
+        await websocket.send_json({'type': 'error', 'detail': 'Control messages must be JSON objects'})
+        return None
+    return control_message.get('type')
+
+
+async def __receive_turn_audio(websocket: WebSocket) -> AsyncIterator[bytes]:
+    """Yield the frames of the user's recording until the client stops the turn"""
+    upload_bytes = 0
+    while True:
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000))
+        if message.get('bytes'):
+            upload_bytes += len(message['bytes'])
+            set_trace_attribute('upload_bytes', upload_bytes)
+            yield message['bytes']
+        elif message.get('text') and await __get_control_message_type(websocket, message['text']) == 'stop':
+            return
+
+
+async def __handle_realtime_turn(websocket: WebSocket, session_id: str, reply_format: ReplyFormat,
+                                 trace: RequestTrace) -> None:
+    print('\n=== Listening on real-time connection ===')
+    speech_pcm = await listen_for_utterance(__receive_turn_audio(websocket))
+    await websocket.send_json({'type': 'speech_end'})
+    if not speech_pcm:
+        await websocket.send_json({'type': 'no_speech'})
+        return
+
+    try:
+        admission = await get_admission_controller().admit()
+    except AdmissionRejected as e:
+        trace.finish('rejected')
+        await websocket.send_json({'type': 'busy', 'retry_after': e.retry_after_seconds, 'detail': str(e)})
+        return
+
+    try:
+        text_content = await transcribe_speech(speech_pcm)
+        await websocket.send_json({'type': 'transcript', 'text': text_content})
+
+        async for audio_chunk in stream_audio_reply_for_text(text_content, session_id, reply_format):
+            await websocket.send_bytes(audio_chunk)
+    finally:
+        admission.release()
+    await websocket.send_json({
+        'type': 'reply_end',
+        'request_id': trace.request_id,
+        'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in trace.stage_durations().items()}
+    })
+
+
+@controller.websocket('/realtime')
+async def handle_realtime_conversation(websocket: WebSocket,
+                                       reply_codec: Optional[str] = REPLY_FORMAT_QUERY,
+                                       sample_rate: Optional[int] = REPLY_SAMPLE_RATE_QUERY,
+                                       bitrate: Optional[str] = REPLY_BITRATE_QUERY):
+    """
+    Real-time voice conversation. For each turn the client sends {"type": "start"}
+    and then its recording as binary frames while the user is still speaking.
+    The server detects the end of speech itself and answers with
+    {"type": "speech_end"}, {"type": "transcript", "text": ...}, the spoken reply
+    as binary frames and finally {"type": "reply_end"}. The client can end
+    a turn early with {"type": "stop"}. When the server is at capacity the turn
+    is answered with {"type": "busy", "retry_after": seconds} instead.
+    Replies are MP3 unless the format, sample_rate and bitrate query parameters
+    ask for another format; the "ready" message names the media type.
+    """
+    try:
+        reply_format = negotiate_reply_format(None, reply_codec, sample_rate, bitrate)
+    except UnsupportedReplyFormat as e:
+        # Policy violation, as for other invalid connection parameters
+        await websocket.close(code=1008, reason=str(e)[:120])
+        return
+
+    session_id, is_new_session = __get_session_id(websocket)
+    headers = None
+    if is_new_session:
+        cookie_response = Response()
+        __set_session_cookie(cookie_response, session_id)
+        headers = [header for header in cookie_response.raw_headers if header[0] == b'set-cookie']
+    await websocket.accept(headers=headers)
+    await websocket.send_json({'type': 'ready', 'session_id': session_id, 'media_type': reply_format.media_type})
+    print(f'Real-time session: {session_id}{" (new)" if is_new_session else ""}')
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                break
+            # Frames still arriving from a turn that has already ended are ignored
+            if not message.get('text') or await __get_control_message_type(websocket, message['text']) != 'start':
+                continue
+
+            trace = start_trace('realtime')
+            try:
+                await __handle_realtime_turn(websocket, session_id, reply_format, trace)
+                trace.finish()
+            except WebSocketDisconnect:
+                trace.finish('cancelled')
+                raise
+            except Exception as e:
+                trace.finish('error')
+                print(f"\n❌ Error in handle_realtime_conversation: {str(e)}")
+                print(f"Traceback: {traceback.format_exc()}")
+                await websocket.send_json({'type': 'error', 'detail': f"Error processing audio: {str(e)}"})
+    except WebSocketDisconnect:
+        pass
+    print(f'Real-time session closed: {session_id}')
\ No newline at end of file
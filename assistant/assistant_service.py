@@ -1,24 +1,51 @@
-from utils.file_utils import persist_binary_file_locally, create_unique_tmp_file
-from transcoding.transcoding_services import convert_file_to_readable_mp3
-from audio_handling.audio_transcription_service import convert_audio_to_text
-from audio_handling.audio_generation_service import convert_text_to_audio
-from chat_service import handle_get_response_for_user
+from utils.file_utils import ScratchSpace
+from transcoding.transcoding_services import (
+    convert_file_to_readable_mp3, convert_bytes_to_readable_mp3, encode_pcm_stream
+)
+from transcoding.audio_preprocessing import (
+    preprocess_audio_for_transcription, encode_speech_for_transcription, LONG_AUDIO_SEGMENT_SECONDS,
+    WHISPER_SAMPLE_RATE
+)
+from transcoding.format_detection import can_bypass_transcoding
+from audio_handling.audio_transcription_service import convert_audio_segments_to_text, IN_MEMORY_AUDIO_FILE_NAME
+from audio_handling.audio_generation_service import convert_text_to_audio_bytes
+from audio_handling.reply_formats import ReplyFormat, DEFAULT_REPLY_FORMAT
+from chat_service import handle_stream_response_for_user, DEFAULT_SESSION_ID
+from utils.executors import run_in_stage_executor
+from utils.metrics import stage_span, set_trace_attribute
+from typing import AsyncIterator, List, Optional, Tuple, Union
+import numpy as np
+import asyncio
 import os
 import traceback
 
+# Transcode uploads through ffmpeg pipes instead of temporary files
+IN_MEMORY_TRANSCODING = os.getenv('IN_MEMORY_TRANSCODING', 'true').lower() == 'true'
+# Trim silence and downsample to 16 kHz mono before transcription (in-memory path only)
+AUDIO_PREPROCESSING = os.getenv('AUDIO_PREPROCESSING', 'true').lower() == 'true'
+# Send uploads Whisper already accepts straight to it, without running ffmpeg
+TRANSCODING_BYPASS = os.getenv('TRANSCODING_BYPASS', 'true').lower() == 'true'
+# Split long recordings at pauses and transcribe the segments in parallel (preprocessing path only)
+LONG_AUDIO_TRANSCRIPTION = os.getenv('LONG_AUDIO_TRANSCRIPTION', 'true').lower() == 'true'
+# Uploads larger than this are decoded to find out whether they need splitting,
+# even if Whisper would accept them as they are
+LONG_AUDIO_MIN_BYTES = int(os.getenv('LONG_AUDIO_MIN_BYTES', str(256 * 1024)))
 
-def __get_transcoded_audio_file_path(data: bytes) -> str:
+
+async def __get_transcoded_audio_file_path(data: bytes, scratch: ScratchSpace) -> str:
     try:
         # Step 1: Save the original audio data to a temporary file
-        local_file_path = persist_binary_file_locally(data, file_suffix='user_audio.mp3')
+        local_file_path = await run_in_stage_executor(
+            'file_io', scratch.persist, data, file_suffix='user_audio.mp3'
+        )
         print(f"✓ Saved original audio to: {local_file_path}")
 
         # Step 2: Create a new unique path for the transcoded file
-        local_output_file_path = create_unique_tmp_file(file_suffix='transcoded_user_audio.mp3')
+        local_output_file_path = scratch.create_file_path(file_suffix='transcoded_user_audio.mp3')
         print(f"✓ Created output path: {local_output_file_path}")
 
         # Step 3: Convert the audio file to a readable MP3 format
-        convert_file_to_readable_mp3(
+        await convert_file_to_readable_mp3(
             local_input_file_path=local_file_path,
             local_output_file_path=local_output_file_path
         )
@@ -31,41 +58,214 @@ def __get_transcoded_audio_file_path(data: bytes) -> str:
         raise
 
 
-async def handle_audio_from_user(file: bytes) -> str:
-    try:
-        print("\nProcessing audio file...")
+async def __get_transcoded_audio(data: bytes, scratch: ScratchSpace) -> Tuple[List[Union[str, bytes]], str]:
+    """
+    Get the user's audio in a form Whisper accepts, as one or more consecutive
+    segments, along with the file name to send them under.
+    Accepted formats are passed through; anything else is transcoded in memory
+    when enabled, otherwise through temporary files in the request's scratch space.
+    """
+    split_long_audio = LONG_AUDIO_TRANSCRIPTION and IN_MEMORY_TRANSCODING and AUDIO_PREPROCESSING
+
+    if TRANSCODING_BYPASS and not (split_long_audio and len(data) > LONG_AUDIO_MIN_BYTES):
+        audio_format = can_bypass_transcoding(data)
+        if audio_format:
+            print(f"✓ Audio is already {audio_format}, skipping transcoding")
+            return [data], f"user_audio.{audio_format}"
+
+    if IN_MEMORY_TRANSCODING and AUDIO_PREPROCESSING:
+        segments, report = await preprocess_audio_for_transcription(
+            data, max_segment_seconds=LONG_AUDIO_SEGMENT_SECONDS if split_long_audio else None
+        )
+        set_trace_attribute('audio_seconds', round(report['original_seconds'], 2))
+        print(f"✓ Preprocessed audio in memory ({len(segments)} segment(s))")
+        return segments, IN_MEMORY_AUDIO_FILE_NAME
+
+    if IN_MEMORY_TRANSCODING:
+        transcoded_audio = await convert_bytes_to_readable_mp3(data)
+        print(f"✓ Converted audio in memory ({len(transcoded_audio)} bytes)")
+        return [transcoded_audio], IN_MEMORY_AUDIO_FILE_NAME
+
+    local_output_file_path = await __get_transcoded_audio_file_path(data, scratch)
+    return [local_output_file_path], os.path.basename(local_output_file_path)
+
 
+async def __transcribe_user_audio(file: bytes) -> str:
+    # Any temporary files are removed as soon as the audio is transcribed
+    with ScratchSpace() as scratch:
         # Transcode the audio
         print("1. Transcoding audio...")
-        transcoded_user_audio_file_path = __get_transcoded_audio_file_path(file)
-        print(f"   ✓ Audio transcoded to: {transcoded_user_audio_file_path}")
+        with stage_span('transcode'):
+            transcoded_user_audio, audio_file_name = await __get_transcoded_audio(file, scratch)
+        print("   ✓ Audio transcoded")
 
         # Convert audio to text
         print("\n2. Converting audio to text...")
-        text_content = convert_audio_to_text(transcoded_user_audio_file_path)
+        with stage_span('transcription'):
+            text_content = await convert_audio_segments_to_text(transcoded_user_audio, audio_file_name)
         print(f"   ✓ Transcribed text: {text_content[:100]}...")
+        return text_content
 
-        # Get AI response
-        print("\n3. Getting AI response...")
-        ai_text_reply = await handle_get_response_for_user(text_content)
-        print(f"   ✓ AI response: {ai_text_reply[:100]}...")
 
-        # Convert response to audio
-        print("\n4. Converting response to audio...")
-        generated_audio_ai = convert_text_to_audio(ai_text_reply)
+async def generate_audio_reply_for_user(file: bytes, session_id: Optional[str] = DEFAULT_SESSION_ID,
+                                        reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> bytes:
+    """
+    Process the user's audio and return the AI's whole spoken reply
+    Args:
+        file (bytes): Raw audio uploaded by the user
+        session_id (Optional[str]): The conversation the audio belongs to, or None for a
+            one-off turn that isn't added to any conversation
+        reply_format (ReplyFormat): The format to reply in
+    Returns:
+        bytes: The audio of the reply
+    """
+    try:
+        print("\nProcessing audio file...")
+
+        text_content = await __transcribe_user_audio(file)
+
+        # Get AI response and convert it to audio while it is still being generated
+        print("\n3. Getting AI response and converting it to audio...")
+        audio_chunks = [chunk async for chunk in __stream_reply_audio(text_content, session_id, reply_format)]
         print("   ✓ Generated audio response")
+        return b''.join(audio_chunks)
 
-        # Save and return the audio file path
-        print("\n5. Saving audio response...")
-        output_audio_file_path = persist_binary_file_locally(
-            data=generated_audio_ai['AudioStream'].read(),
-            file_suffix='ai_audio_reply.mp3'
-        )
-        print(f"   ✓ Saved to: {output_audio_file_path}")
+    except Exception as e:
+        print(f"\n❌ Error in generate_audio_reply_for_user: {str(e)}")
+        print(f"Traceback: {traceback.format_exc()}")
+        raise
+
+
+async def stream_audio_reply_for_user(file: bytes, session_id: str = DEFAULT_SESSION_ID,
+                                      reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> AsyncIterator[bytes]:
+    """
+    Process the user's audio and yield the AI's spoken reply one sentence at a time
+    Args:
+        file (bytes): Raw audio uploaded by the user
+        session_id (str): The conversation the audio belongs to
+        reply_format (ReplyFormat): The format to reply in
+    Yields:
+        bytes: The reply's audio, in order, as soon as each sentence is synthesized
+    """
+    try:
+        print("\nProcessing audio file (streaming)...")
+
+        text_content = await __transcribe_user_audio(file)
 
-        return output_audio_file_path
+        # Stream the AI response and synthesize each sentence as it arrives
+        print("\n3. Streaming AI response as audio...")
+        async for audio_chunk in __stream_reply_audio(text_content, session_id, reply_format):
+            yield audio_chunk
+        print("   ✓ Finished streaming audio response")
 
     except Exception as e:
-        print(f"\n❌ Error in handle_audio_from_user: {str(e)}")
+        print(f"\n❌ Error in stream_audio_reply_for_user: {str(e)}")
         print(f"Traceback: {traceback.format_exc()}")
-        raise
\ No newline at end of file
+        raise
+
+
+async def transcribe_speech(speech_pcm: bytes) -> str:
+    """
+    Transcribe an utterance that has already been decoded and trimmed, such as
+    one captured by the real-time endpoint
+    Args:
+        speech_pcm (bytes): 16 kHz mono 16-bit PCM
+    Returns:
+        str: The transcribed text
+    """
+    samples = np.frombuffer(speech_pcm, dtype=np.int16)
+    set_trace_attribute('audio_seconds', round(len(samples) / WHISPER_SAMPLE_RATE, 2))
+    with stage_span('transcode'):
+        segments = await encode_speech_for_transcription(
+            samples, max_segment_seconds=LONG_AUDIO_SEGMENT_SECONDS if LONG_AUDIO_TRANSCRIPTION else None
+        )
+    with stage_span('transcription'):
+        text_content = await convert_audio_segments_to_text(segments, IN_MEMORY_AUDIO_FILE_NAME)
+    print(f"   ✓ Transcribed text: {text_content[:100]}...")
+    return text_content
+
+
+async def stream_audio_reply_for_text(text_content: str, session_id: str = DEFAULT_SESSION_ID,
+                                      reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> AsyncIterator[bytes]:
+    """
+    Yield the AI's spoken reply to text the user has said, one sentence at a time
+    Args:
+        text_content (str): What the user said
+        session_id (str): The conversation it belongs to
+        reply_format (ReplyFormat): The format to reply in
+    Yields:
+        bytes: The reply's audio, in order, as soon as each sentence is synthesized
+    """
+    async for audio_chunk in __stream_reply_audio(text_content, session_id, reply_format):
+        yield audio_chunk
+
+
+async def synthesize_text(text_content: str, reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> AsyncIterator[bytes]:
+    """
+    Synthesize text as a standalone piece of audio, such as one sentence of a
+    reply to a text message
+    Args:
+        text_content (str): The text to synthesize
+        reply_format (ReplyFormat): The format to synthesize in
+    Yields:
+        bytes: The audio; Ogg formats are yielded a page at a time
+    """
+    if not reply_format.is_stream_encoded:
+        yield await convert_text_to_audio_bytes(text_content, reply_format)
+        return
+
+    async def synthesize_pcm() -> AsyncIterator[bytes]:
+        yield await convert_text_to_audio_bytes(text_content, reply_format.chunk_format)
+
+    async for page in encode_pcm_stream(
+        synthesize_pcm(), reply_format.codec, reply_format.sample_rate, reply_format.bitrate
+    ):
+        yield page
+
+
+async def __stream_reply_audio(text_content: str, session_id: Optional[str],
+                               reply_format: ReplyFormat) -> AsyncIterator[bytes]:
+    """
+    Get the AI's reply and yield its audio in the requested format. Ogg formats
+    are synthesized as PCM and encoded as one stream, since Ogg files can't
+    simply be concatenated like MP3 frames or PCM.
+    """
+    audio_chunks = __synthesize_reply_units(text_content, session_id, reply_format.chunk_format)
+    if reply_format.is_stream_encoded:
+        audio_chunks = encode_pcm_stream(
+            audio_chunks, reply_format.codec, reply_format.sample_rate, reply_format.bitrate
+        )
+    async for audio_chunk in audio_chunks:
+        yield audio_chunk
+
+
+async def __synthesize_reply_units(text_content: str, session_id: Optional[str],
+                                   chunk_format: ReplyFormat) -> AsyncIterator[bytes]:
+    """
+    Get the AI's reply and yield its audio in order, one speakable unit at a time.
+    Units are handed to Polly as soon as GPT finishes them, so synthesis overlaps
+    with generation and with sending earlier audio to the client.
+    """
+    pending_audio: asyncio.Queue = asyncio.Queue()
+
+    async def queue_synthesis_for_units():
+        try:
+            async for unit in handle_stream_response_for_user(text_content, session_id):
+                print(f"   ✓ AI response unit: {unit[:100]}")
+                pending_audio.put_nowait(asyncio.create_task(convert_text_to_audio_bytes(unit, chunk_format)))
+        finally:
+            pending_audio.put_nowait(None)
+
+    producer = asyncio.create_task(queue_synthesis_for_units())
+    try:
+        while (synthesis := await pending_audio.get()) is not None:
+            yield await synthesis
+        # Re-raise any error from the chat stage
+        await producer
+    finally:
+        # The client may disconnect mid-stream; don't leave GPT or Polly calls behind
+        producer.cancel()
+        while not pending_audio.empty():
+            synthesis = pending_audio.get_nowait()
+            if synthesis is not None:
+                synthesis.cancel()
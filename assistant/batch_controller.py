@@ -0,0 +1,81 @@
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse
+from assistant.batch_jobs import get_batch_job_queue, validate_callback_url, BATCH_MAX_CLIPS, BATCH_MAX_BYTES
+from assistant.upload_intake import receive_audio_uploads, UploadRejected, UPLOAD_FIELD_NAME
+from audio_handling.reply_formats import negotiate_reply_format, UnsupportedReplyFormat, REPLY_CODECS
+from utils.metrics import start_trace
+from typing import Optional
+import traceback
+
+controller = APIRouter(prefix='/voice-assistant')
+
+
+@controller.post('/batches', status_code=202, openapi_extra={
+    # The clips are streamed from the request rather than parsed by FastAPI, so describe them here
+    'requestBody': {'required': True, 'content': {'multipart/form-data': {'schema': {
+        'type': 'object',
+        'properties': {UPLOAD_FIELD_NAME: {'type': 'array', 'items': {'type': 'string', 'format': 'binary'}}},
+        'required': [UPLOAD_FIELD_NAME],
+    }}}}
+})
+async def handle_create_batch(request: Request,
+                              callback_url: Optional[str] = Query(
+                                  None, description="A local URL the batch's status is posted to once it completes"
+                              ),
+                              reply_codec: Optional[str] = Query(
+                                  None, alias='format', description=f"One of {', '.join(REPLY_CODECS)}"
+                              ),
+                              sample_rate: Optional[int] = Query(None, description="Sample rate of the replies in Hz"),
+                              bitrate: Optional[str] = Query(None, description="Bitrate of the replies, such as 32k")):
+    """
+    Queue voice notes for processing. Each 'file' field of the form is a clip,
+    replied to as a conversation of its own. Poll the returned status URL, or
+    pass a callback URL, to find out when the replies are ready.
+    """
+    trace = start_trace('batches')
+    try:
+        # The Accept header is about this response, so the replies' format only comes from the query
+        reply_format = negotiate_reply_format(None, reply_codec, sample_rate, bitrate)
+        if callback_url:
+            validate_callback_url(callback_url)
+    except (UnsupportedReplyFormat, ValueError) as e:
+        trace.finish('rejected')
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        batch_id = await get_batch_job_queue().submit(
+            receive_audio_uploads(request, BATCH_MAX_CLIPS, BATCH_MAX_BYTES), reply_format, callback_url
+        )
+    except UploadRejected as e:
+        trace.finish('rejected')
+        print(f"Rejected batch {trace.request_id}: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        trace.finish('error')
+        print(f"\n❌ Error in handle_create_batch: {str(e)}")
+        print(f"Traceback: {traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Error queueing batch: {str(e)}")
+
+    trace.finish()
+    batch = await get_batch_job_queue().store.get_batch(batch_id)
+    status_url = request.url_for('handle_get_batch', batch_id=batch_id).path
+    return JSONResponse(batch, status_code=202, headers={'Location': status_url})
+
+
+@controller.get('/batches/{batch_id}')
+async def handle_get_batch(batch_id: str):
+    batch = await get_batch_job_queue().store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail=f"No batch {batch_id}")
+    return batch
+
+
+@controller.get('/batches/{batch_id}/jobs/{job_id}/reply')
+async def handle_get_batch_reply(batch_id: str, job_id: str):
+    reply = await get_batch_job_queue().store.get_reply_path(batch_id, job_id)
+    if reply is None:
+        raise HTTPException(status_code=404, detail=f"No reply to clip {job_id} of batch {batch_id}")
+    reply_path, reply_format = reply
+    return FileResponse(
+        reply_path, media_type=reply_format.media_type, filename=f"ai_output_{job_id}.{reply_format.extension}"
+    )
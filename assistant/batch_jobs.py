@@ -0,0 +1,521 @@
+import asyncio
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import traceback
+from typing import AsyncIterator, List, Optional
+from urllib.parse import urlsplit
+from uuid import uuid4
+import httpx
+from assistant.assistant_service import generate_audio_reply_for_user
+from assistant.upload_intake import SpooledUpload
+from audio_handling.reply_formats import ReplyFormat
+from utils.admission import get_admission_controller
+from utils.executors import run_in_stage_executor
+from utils.file_utils import create_if_not_exists
+from utils.metrics import counter, gauge, start_trace, set_trace_attribute
+
+# The local SQLite database batch jobs are queued in, shared by all workers on the host
+BATCH_DB_PATH = os.getenv('BATCH_DB_PATH', 'batch_jobs.db')
+# Where the clips of queued batches and their replies are kept
+BATCH_STORAGE_DIR = os.getenv('BATCH_STORAGE_DIR', 'batch_jobs')
+# Clips each worker process runs through the pipeline at the same time
+BATCH_WORKER_CONCURRENCY = int(os.getenv('BATCH_WORKER_CONCURRENCY', '4'))
+# Largest batch accepted in one request
+BATCH_MAX_CLIPS = int(os.getenv('BATCH_MAX_CLIPS', '500'))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', str(500 * 1024 * 1024)))
+# A failing clip is tried this many times before it is marked as failed
+BATCH_MAX_ATTEMPTS = int(os.getenv('BATCH_MAX_ATTEMPTS', '3'))
+# A failed clip waits this long before its next attempt, doubling with each attempt,
+# so a clip that fails on an upstream outage isn't retried straight away
+BATCH_RETRY_BACKOFF_SECONDS = float(os.getenv('BATCH_RETRY_BACKOFF_SECONDS', '30'))
+# A clip that hasn't finished this long after a worker took it, e.g. because
+# the worker process died, is handed to another worker
+BATCH_JOB_LEASE_SECONDS = int(os.getenv('BATCH_JOB_LEASE_SECONDS', '900'))
+# How often idle workers look for clips queued by other processes
+BATCH_POLL_INTERVAL_SECONDS = float(os.getenv('BATCH_POLL_INTERVAL_SECONDS', '2'))
+# Completed batches, and their replies, are deleted after this long
+BATCH_RETENTION_SECONDS = int(os.getenv('BATCH_RETENTION_SECONDS', str(24 * 3600)))
+# Callbacks are only sent to these hosts, so batches can't be used to reach other services
+BATCH_CALLBACK_ALLOWED_HOSTS = set(os.getenv('BATCH_CALLBACK_ALLOWED_HOSTS', 'localhost,127.0.0.1,::1').split(','))
+BATCH_CALLBACK_TIMEOUT_SECONDS = float(os.getenv('BATCH_CALLBACK_TIMEOUT_SECONDS', '10'))
+BATCH_CALLBACK_ATTEMPTS = 3
+# Where clients download the reply to a clip
+BATCH_REPLY_PATH = '/voice-assistant/batches/{batch_id}/jobs/{job_id}/reply'
+
+BATCH_JOBS = counter('voice_assistant_batch_jobs_total', 'Batch clips processed, by outcome', ('outcome',))
+BATCH_JOBS_RUNNING = gauge('voice_assistant_batch_jobs_running', 'Batch clips being processed by this worker')
+BATCH_CALLBACKS = counter(
+    'voice_assistant_batch_callbacks_total', 'Batch completion callbacks, by outcome', ('outcome',)
+)
+
+
+def validate_callback_url(callback_url: str) -> None:
+    """
+    Check that a callback URL points at an allowed host
+    Raises:
+        ValueError: If it doesn't
+    """
+    url = urlsplit(callback_url)
+    if url.scheme not in ('http', 'https') or url.hostname not in BATCH_CALLBACK_ALLOWED_HOSTS:
+        raise ValueError(f"Callbacks must be http(s) URLs on {', '.join(sorted(BATCH_CALLBACK_ALLOWED_HOSTS))}")
+
+
+class BatchJob:
+    """One clip of a batch, as claimed by a worker"""
+
+    def __init__(self, job_id: str, batch_id: str, attempts: int, reply_format: ReplyFormat):
+        self.job_id = job_id
+        self.batch_id = batch_id
+        self.attempts = attempts
+        self.reply_format = reply_format
+
+    @property
+    def clip_path(self) -> str:
+        return os.path.join(BATCH_STORAGE_DIR, self.batch_id, f"{self.job_id}.clip")
+
+    @property
+    def reply_path(self) -> str:
+        return os.path.join(BATCH_STORAGE_DIR, self.batch_id, f"{self.job_id}.{self.reply_format.extension}")
+
+    def read_clip(self) -> bytes:
+        with open(self.clip_path, 'rb') as f:
+            return f.read()
+
+    def write_reply(self, audio: bytes) -> None:
+        # Written under a temporary name so the reply is never served half written
+        tmp_path = f"{self.reply_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(audio)
+        os.replace(tmp_path, self.reply_path)
+
+
+class BatchJobStore:
+    """
+    The job queue, in a local SQLite database in WAL mode so every worker
+    process on the host can take clips from it. Workers claim a clip with a
+    lease; clips whose lease runs out are claimed again, and failed clips are
+    claimed again after a backoff. Queries run in the batch_store thread pool
+    with one connection per thread.
+    """
+
+    # How often, at most, expired batches are purged
+    PURGE_INTERVAL_SECONDS = 60
+
+    def __init__(self, db_path: str = BATCH_DB_PATH, max_attempts: int = BATCH_MAX_ATTEMPTS,
+                 lease_seconds: int = BATCH_JOB_LEASE_SECONDS, retention_seconds: int = BATCH_RETENTION_SECONDS,
+                 retry_backoff_seconds: float = BATCH_RETRY_BACKOFF_SECONDS):
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.lease_seconds = lease_seconds
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+        connection = self._get_connection()
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                sample_rate INTEGER NOT NULL,
+                bitrate TEXT,
+                callback_url TEXT,
+                callback_status TEXT,
+                created_at REAL NOT NULL,
+                completed_at REAL
+            )"""
+        )
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS batch_jobs (
+                job_id TEXT PRIMARY KEY,
+                batch_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                filename TEXT,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                lease_expires_at REAL,
+                not_before REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        if 'not_before' not in [column[1] for column in connection.execute("PRAGMA table_info(batch_jobs)")]:
+            # Queues created before retries were delayed
+            connection.execute("ALTER TABLE batch_jobs ADD COLUMN not_before REAL")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_batch_id ON batch_jobs (batch_id, position)")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_status ON batch_jobs (status, created_at)")
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_batches_completed_at ON batches (completed_at)")
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _create_batch(self, batch_id: str, job_ids: List[str], filenames: List[Optional[str]],
+                      reply_format: ReplyFormat, callback_url: Optional[str]) -> None:
+        now = time.time()
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                """INSERT INTO batches (batch_id, codec, sample_rate, bitrate, callback_url, created_at)
+                   VALUES (?, ?, ?, ?, ?, ?)""",
+                (batch_id, reply_format.codec, reply_format.sample_rate, reply_format.bitrate, callback_url, now)
+            )
+            connection.executemany(
+                """INSERT INTO batch_jobs (job_id, batch_id, position, filename, status, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, 'queued', ?, ?)""",
+                [(job_id, batch_id, position, filename, now, now)
+                 for position, (job_id, filename) in enumerate(zip(job_ids, filenames))]
+            )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _claim_job(self) -> Optional[BatchJob]:
+        now = time.time()
+        connection = self._get_connection()
+        # Clips abandoned by a worker that has used up their attempts aren't tried again
+        connection.execute(
+            """UPDATE batch_jobs SET status = 'failed', error = 'The worker processing the clip stopped',
+                   updated_at = ?
+               WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?""",
+            (now, now, self.max_attempts)
+        )
+        # One statement, so two workers can never claim the same clip
+        row = connection.execute(
+            """UPDATE batch_jobs SET status = 'running', attempts = attempts + 1, lease_expires_at = ?, updated_at = ?
+               WHERE job_id = (
+                   SELECT job_id FROM batch_jobs
+                   WHERE (status = 'queued' AND (not_before IS NULL OR not_before <= ?))
+                       OR (status = 'running' AND lease_expires_at < ?)
+                   ORDER BY created_at, position LIMIT 1
+               )
+               RETURNING job_id, batch_id, attempts""",
+            (now + self.lease_seconds, now, now, now)
+        ).fetchone()
+        if row is None:
+            return None
+        job_id, batch_id, attempts = row
+        codec, sample_rate, bitrate = connection.execute(
+            "SELECT codec, sample_rate, bitrate FROM batches WHERE batch_id = ?", (batch_id,)
+        ).fetchone()
+        return BatchJob(job_id, batch_id, attempts, ReplyFormat(codec, sample_rate, bitrate))
+
+    def _finish_job(self, job: BatchJob, error: Optional[str]) -> bool:
+        """Record the outcome of a clip. Returns whether this completed its batch."""
+        now = time.time()
+        not_before = None
+        if error is None:
+            status = 'done'
+        elif job.attempts >= self.max_attempts:
+            status = 'failed'
+        else:
+            status = 'queued'
+            not_before = now + self.retry_backoff_seconds * 2 ** (job.attempts - 1)
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                """UPDATE batch_jobs SET status = ?, error = ?, lease_expires_at = NULL, not_before = ?, updated_at = ?
+                   WHERE job_id = ?""",
+                (status, error, not_before, now, job.job_id)
+            )
+            # Exactly one worker sees the batch complete, so the callback is sent once
+            completed = connection.execute(
+                """UPDATE batches SET completed_at = ?
+                   WHERE batch_id = ? AND completed_at IS NULL AND NOT EXISTS (
+                       SELECT 1 FROM batch_jobs WHERE batch_id = ? AND status IN ('queued', 'running')
+                   )""",
+                (now, job.batch_id, job.batch_id)
+            ).rowcount == 1
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return completed
+
+    def _release_job(self, job: BatchJob) -> None:
+        """Put back a clip whose processing was interrupted, without counting the attempt"""
+        self._get_connection().execute(
+            """UPDATE batch_jobs SET status = 'queued', attempts = attempts - 1, lease_expires_at = NULL,
+                   updated_at = ?
+               WHERE job_id = ? AND status = 'running'""",
+            (time.time(), job.job_id)
+        )
+
+    def _set_callback_status(self, batch_id: str, callback_status: str) -> None:
+        self._get_connection().execute(
+            "UPDATE batches SET callback_status = ? WHERE batch_id = ?", (callback_status, batch_id)
+        )
+
+    def _get_batch(self, batch_id: str) -> Optional[dict]:
+        connection = self._get_connection()
+        batch = connection.execute(
+            """SELECT codec, sample_rate, bitrate, callback_url, callback_status, created_at, completed_at
+               FROM batches WHERE batch_id = ?""",
+            (batch_id,)
+        ).fetchone()
+        if batch is None:
+            return None
+        codec, sample_rate, bitrate, callback_url, callback_status, created_at, completed_at = batch
+        reply_format = ReplyFormat(codec, sample_rate, bitrate)
+        jobs = connection.execute(
+            """SELECT job_id, position, filename, status, attempts, error FROM batch_jobs
+               WHERE batch_id = ? ORDER BY position""",
+            (batch_id,)
+        ).fetchall()
+
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        for job in jobs:
+            counts[job[3]] += 1
+        if completed_at is not None:
+            batch_status = 'completed'
+        else:
+            batch_status = 'queued' if counts['queued'] == len(jobs) else 'running'
+        return {
+            'batch_id': batch_id,
+            'status': batch_status,
+            'created_at': created_at,
+            'completed_at': completed_at,
+            'reply_media_type': reply_format.media_type,
+            'callback_url': callback_url,
+            'callback_status': callback_status,
+            'counts': counts,
+            'jobs': [{
+                'job_id': job_id,
+                'index': position,
+                'filename': filename,
+                'status': status,
+                'attempts': attempts,
+                'error': error,
+                'reply_url': BATCH_REPLY_PATH.format(batch_id=batch_id, job_id=job_id) if status == 'done' else None,
+            } for job_id, position, filename, status, attempts, error in jobs],
+        }
+
+    def _get_reply_path(self, batch_id: str, job_id: str) -> Optional[tuple]:
+        row = self._get_connection().execute(
+            """SELECT codec, sample_rate, bitrate FROM batch_jobs JOIN batches USING (batch_id)
+               WHERE batch_id = ? AND job_id = ? AND status = 'done'""",
+            (batch_id, job_id)
+        ).fetchone()
+        if row is None:
+            return None
+        job = BatchJob(job_id, batch_id, 0, ReplyFormat(*row))
+        return job.reply_path, job.reply_format
+
+    def _purge_expired(self) -> List[str]:
+        """Delete the batches that completed longer ago than the retention period. Returns their IDs."""
+        now = time.time()
+        if now - self._last_purge < self.PURGE_INTERVAL_SECONDS:
+            return []
+        self._last_purge = now
+
+        connection = self._get_connection()
+        expire_before = now - self.retention_seconds
+        batch_ids = [row[0] for row in connection.execute(
+            "SELECT batch_id FROM batches WHERE completed_at < ?", (expire_before,)
+        )]
+        for batch_id in batch_ids:
+            connection.execute("DELETE FROM batch_jobs WHERE batch_id = ?", (batch_id,))
+            connection.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+        return batch_ids
+
+    async def create_batch(self, batch_id: str, job_ids: List[str], filenames: List[Optional[str]],
+                           reply_format: ReplyFormat, callback_url: Optional[str]) -> None:
+        await run_in_stage_executor(
+            'batch_store', self._create_batch, batch_id, job_ids, filenames, reply_format, callback_url
+        )
+
+    async def claim_job(self) -> Optional[BatchJob]:
+        return await run_in_stage_executor('batch_store', self._claim_job)
+
+    async def finish_job(self, job: BatchJob, error: Optional[str]) -> bool:
+        return await run_in_stage_executor('batch_store', self._finish_job, job, error)
+
+    async def release_job(self, job: BatchJob) -> None:
+        await run_in_stage_executor('batch_store', self._release_job, job)
+
+    async def set_callback_status(self, batch_id: str, callback_status: str) -> None:
+        await run_in_stage_executor('batch_store', self._set_callback_status, batch_id, callback_status)
+
+    async def get_batch(self, batch_id: str) -> Optional[dict]:
+        return await run_in_stage_executor('batch_store', self._get_batch, batch_id)
+
+    async def get_reply_path(self, batch_id: str, job_id: str) -> Optional[tuple]:
+        """Get the path and format of a clip's reply, or None if the clip has no reply (yet)"""
+        return await run_in_stage_executor('batch_store', self._get_reply_path, batch_id, job_id)
+
+    async def purge_expired(self) -> List[str]:
+        return await run_in_stage_executor('batch_store', self._purge_expired)
+
+
+class BatchJobQueue:
+    """
+    Runs queued batch clips through the same stages as /audio-message, with
+    up to BATCH_WORKER_CONCURRENCY clips in flight per worker process, so bulk
+    work doesn't hold HTTP connections. Clips take background turns from the
+    admission controller, so they only use capacity requests leave spare. Each clip is a one-off turn with no history.
+    When a batch completes, its status is posted to its callback URL.
+    """
+
+    def __init__(self, store: BatchJobStore, concurrency: int = BATCH_WORKER_CONCURRENCY):
+        self.store = store
+        self.concurrency = concurrency
+        self.running = 0
+        self._wake = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+        self._callbacks = set()
+
+    async def submit(self, uploads: AsyncIterator[SpooledUpload], reply_format: ReplyFormat,
+                     callback_url: Optional[str] = None) -> str:
+        """
+        Store the clips of a batch and queue them. Nothing is queued unless every clip is accepted.
+        Args:
+            uploads (AsyncIterator[SpooledUpload]): The clips, as they are received
+            reply_format (ReplyFormat): The format to reply to each clip in
+            callback_url (Optional[str]): Where to post the batch's status once it completes
+        Returns:
+            str: The batch's ID
+        """
+        batch_id = uuid4().hex
+        batch_dir = os.path.join(BATCH_STORAGE_DIR, batch_id)
+        await run_in_stage_executor('file_io', create_if_not_exists, batch_dir)
+
+        job_ids = []
+        filenames = []
+        try:
+            async for upload in uploads:
+                try:
+                    job_id = uuid4().hex
+                    await upload.save(BatchJob(job_id, batch_id, 0, reply_format).clip_path)
+                    job_ids.append(job_id)
+                    filenames.append(upload.filename)
+                finally:
+                    upload.close()
+            await self.store.create_batch(batch_id, job_ids, filenames, reply_format, callback_url)
+        except BaseException:
+            await run_in_stage_executor('file_io', shutil.rmtree, batch_dir, True)
+            raise
+
+        print(f"Queued batch {batch_id} with {len(job_ids)} clip(s)")
+        self._wake.set()
+        return batch_id
+
+    async def _process(self, job: BatchJob) -> None:
+        trace = start_trace('batch')
+        set_trace_attribute('batch_id', job.batch_id)
+        print(f"\n=== Processing batch clip {job.job_id} (attempt {job.attempts}) ===")
+
+        self.running += 1
+        BATCH_JOBS_RUNNING.set(self.running)
+        error = None
+        try:
+            file_data = await run_in_stage_executor('file_io', job.read_clip)
+            # Each clip is a one-off turn: it isn't saved into the conversation store, where it
+            # would evict real sessions, and a retry doesn't see the turns of a failed attempt
+            audio_reply = await generate_audio_reply_for_user(file_data, None, job.reply_format)
+            await run_in_stage_executor('file_io', job.write_reply, audio_reply)
+            trace.finish()
+        except asyncio.CancelledError:
+            trace.finish('cancelled')
+            # The worker is shutting down; let another one take the clip
+            await asyncio.shield(self.store.release_job(job))
+            raise
+        except Exception as e:
+            trace.finish('error')
+            error = str(e) or type(e).__name__
+        finally:
+            self.running -= 1
+            BATCH_JOBS_RUNNING.set(self.running)
+
+        if error is None:
+            BATCH_JOBS.inc(outcome='done')
+        else:
+            BATCH_JOBS.inc(outcome='failed' if job.attempts >= self.store.max_attempts else 'retried')
+        if await self.store.finish_job(job, error):
+            print(f"Batch {job.batch_id} completed")
+            task = asyncio.create_task(self._send_callback(job.batch_id))
+            self._callbacks.add(task)
+            task.add_done_callback(self._callbacks.discard)
+
+    async def _send_callback(self, batch_id: str) -> None:
+        batch = await self.store.get_batch(batch_id)
+        if batch is None or not batch['callback_url']:
+            return
+
+        callback_status = 'failed'
+        async with httpx.AsyncClient(timeout=BATCH_CALLBACK_TIMEOUT_SECONDS) as http_client:
+            for attempt in range(BATCH_CALLBACK_ATTEMPTS):
+                try:
+                    response = await http_client.post(batch['callback_url'], json=batch)
+                    response.raise_for_status()
+                    callback_status = 'sent'
+                    break
+                except httpx.HTTPError as e:
+                    print(f"Callback for batch {batch_id} failed (attempt {attempt + 1}): {e!r}")
+                    await asyncio.sleep(2 ** attempt)
+        BATCH_CALLBACKS.inc(outcome=callback_status)
+        await self.store.set_callback_status(batch_id, callback_status)
+
+    async def _purge_expired(self) -> None:
+        for batch_id in await self.store.purge_expired():
+            await run_in_stage_executor('file_io', shutil.rmtree, os.path.join(BATCH_STORAGE_DIR, batch_id), True)
+
+    async def _run_worker(self) -> None:
+        while True:
+            # Cleared before looking, so a batch queued meanwhile still wakes the worker
+            self._wake.clear()
+            # Taken before claiming, so a claimed clip's lease doesn't run out while it waits for a turn
+            admission = await get_admission_controller().admit_background()
+            try:
+                job = await self.store.claim_job()
+                if job is not None:
+                    await self._process(job)
+                    continue
+            except Exception as e:
+                print(f"Error in batch worker: {str(e)}")
+                print(f"Traceback: {traceback.format_exc()}")
+            finally:
+                admission.release()
+
+            try:
+                await self._purge_expired()
+            except Exception as e:
+                print(f"Could not purge expired batches: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), BATCH_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> None:
+        """Start the workers"""
+        create_if_not_exists(BATCH_STORAGE_DIR)
+        self._workers = [asyncio.create_task(self._run_worker()) for _ in range(self.concurrency)]
+
+    async def stop(self) -> None:
+        """Stop the workers. Clips they were processing are put back in the queue."""
+        for task in [*self._workers, *self._callbacks]:
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._callbacks, return_exceptions=True)
+        self._workers = []
+
+
+_batch_job_queue: Optional[BatchJobQueue] = None
+
+
+def get_batch_job_queue() -> BatchJobQueue:
+    """Get or create the batch job queue of this worker process"""
+    global _batch_job_queue
+    if _batch_job_queue is None:
+        _batch_job_queue = BatchJobQueue(BatchJobStore())
+    return _batch_job_queue
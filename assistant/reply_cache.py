@@ -0,0 +1,220 @@
+import asyncio
+import os
+import time
+from collections import Counter, OrderedDict
+from typing import AsyncIterator, Callable, Dict, Hashable, List, Optional, Tuple
+from utils.metrics import register_callback_metric
+
+# How long, and how much, completed replies are kept for clients that retry
+REPLY_CACHE_TTL_SECONDS = int(os.getenv('REPLY_CACHE_TTL_SECONDS', '600'))
+REPLY_CACHE_MAX_BYTES = int(os.getenv('REPLY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# How long, and how much, the speech of text replies is kept for clients to fetch
+TEXT_AUDIO_TTL_SECONDS = int(os.getenv('TEXT_AUDIO_TTL_SECONDS', '300'))
+TEXT_AUDIO_MAX_BYTES = int(os.getenv('TEXT_AUDIO_MAX_BYTES', str(32 * 1024 * 1024)))
+
+
+class SharedReply:
+    """
+    The spoken reply of one request, produced once and readable by any number
+    of requests: the original one and any retries that arrive while it is
+    still being generated or after it has completed. Unless told otherwise,
+    generation stops once every request reading it has gone away.
+    """
+
+    def __init__(self, session_id: str, media_type: str = 'audio/mpeg', cancel_when_abandoned: bool = True):
+        self.session_id = session_id
+        self.media_type = media_type
+        self.cancel_when_abandoned = cancel_when_abandoned
+        # Requests currently reading the reply
+        self.readers = 0
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._updated = asyncio.Event()
+        # The task producing the reply, set by ReplyCache.start
+        self._task: Optional[asyncio.Task] = None
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[Exception] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def iterate(self) -> AsyncIterator[bytes]:
+        """Yield the reply's chunks from the start, waiting for the ones not produced yet"""
+        self.readers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and not self.done and self.cancel_when_abandoned:
+                # Nobody is left to hear the reply, so don't spend any more upstream calls on it
+                self.cancel()
+
+    async def read(self) -> bytes:
+        """Wait for the whole reply"""
+        return b''.join([chunk async for chunk in self.iterate()])
+
+    async def wait(self) -> None:
+        """Wait until the reply is complete or has failed, without raising its error"""
+        while not self.done:
+            await self._updated.wait()
+
+    def cancel(self) -> None:
+        """Stop generating the reply if it is still being generated; readers then get an error"""
+        if self._task is not None:
+            self._task.cancel()
+
+
+class ReplyCache:
+    """
+    Makes audio messages idempotent. A reply is generated by a task of its own,
+    so a client that times out and retries attaches to the pipeline that is
+    already running instead of starting another one, and the turn is only
+    added to the conversation once. A reply that every client has stopped
+    reading is cancelled, unless cancel_abandoned is off. Completed replies
+    are kept for a TTL, with the oldest dropped early once they exceed the
+    size cap. Failed and cancelled replies aren't kept, so a retry runs the
+    pipeline again.
+    """
+
+    def __init__(self, ttl_seconds: int = REPLY_CACHE_TTL_SECONDS, max_bytes: int = REPLY_CACHE_MAX_BYTES,
+                 cancel_abandoned: bool = True):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.cancel_abandoned = cancel_abandoned
+        self._in_flight: Dict[Hashable, SharedReply] = {}
+        # key -> (expiry time, reply), oldest first
+        self._completed: "OrderedDict[Hashable, Tuple[float, SharedReply]]" = OrderedDict()
+        self._completed_bytes = 0
+        self._tasks = set()
+        self.stats = Counter()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._completed:
+            key, (expires_at, reply) = next(iter(self._completed.items()))
+            if expires_at > now and self._completed_bytes <= self.max_bytes:
+                break
+            del self._completed[key]
+            self._completed_bytes -= reply.size
+
+    def get(self, key: Optional[Hashable]) -> Optional[SharedReply]:
+        """
+        Find the reply of an earlier request with the same key
+        Args:
+            key (Optional[Hashable]): The request's idempotency key, if it has one
+        Returns:
+            Optional[SharedReply]: The reply, complete or still being generated, or None
+        """
+        if key is None:
+            return None
+        if key in self._in_flight:
+            self.stats['in_flight_hits'] += 1
+            return self._in_flight[key]
+
+        self._evict()
+        if key in self._completed:
+            self.stats['completed_hits'] += 1
+            return self._completed[key][1]
+        return None
+
+    def start(self, key: Optional[Hashable], session_id: str, audio_chunks: AsyncIterator[bytes],
+              on_done: Optional[Callable[[], None]] = None, media_type: str = 'audio/mpeg') -> SharedReply:
+        """
+        Generate a reply in the background
+        Args:
+            key (Optional[Hashable]): The request's idempotency key; without one the reply isn't shared
+            session_id (str): The conversation the reply belongs to
+            audio_chunks (AsyncIterator[bytes]): The pipeline producing the reply's audio
+            on_done (Optional[Callable]): Called once the pipeline has finished, successfully or not
+            media_type (str): The media type of the audio
+        Returns:
+            SharedReply: The reply, to be read by the request
+        """
+        reply = SharedReply(session_id, media_type, cancel_when_abandoned=self.cancel_abandoned)
+
+        async def produce():
+            try:
+                async for chunk in audio_chunks:
+                    reply.append(chunk)
+                reply.finish()
+            except Exception as e:
+                reply.finish(e)
+            finally:
+                if not reply.done:
+                    # Cancelled, because its readers went away or the app is shutting down
+                    reply.finish(RuntimeError("Reply generation was cancelled"))
+                if on_done is not None:
+                    on_done()
+                if key is not None:
+                    self._in_flight.pop(key, None)
+                    if reply.error is None and reply.size <= self.max_bytes:
+                        if key in self._completed:
+                            self._completed_bytes -= self._completed.pop(key)[1].size
+                        self._completed[key] = (time.monotonic() + self.ttl_seconds, reply)
+                        self._completed_bytes += reply.size
+                        self._evict()
+
+        if key is not None:
+            self._in_flight[key] = reply
+            self.stats['misses'] += 1
+        # Keep a reference so the task isn't garbage collected while it runs
+        task = asyncio.create_task(produce())
+        reply._task = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return reply
+
+
+_reply_cache: Optional[ReplyCache] = None
+_text_audio_cache: Optional[ReplyCache] = None
+
+
+def get_reply_cache() -> ReplyCache:
+    """Get or create the shared ReplyCache instance"""
+    global _reply_cache
+    if _reply_cache is None:
+        _reply_cache = ReplyCache()
+    return _reply_cache
+
+
+def get_text_audio_cache() -> ReplyCache:
+    """
+    Get or create the store the speech of text replies is fetched from. It is
+    kept apart from the idempotent replies so neither can crowd out the other.
+    Synthesis isn't cancelled when a fetch is abandoned, as the client may
+    fetch again; the text stream cancels it if the reply is cut short.
+    """
+    global _text_audio_cache
+    if _text_audio_cache is None:
+        _text_audio_cache = ReplyCache(TEXT_AUDIO_TTL_SECONDS, TEXT_AUDIO_MAX_BYTES, cancel_abandoned=False)
+    return _text_audio_cache
+
+
+register_callback_metric(
+    'voice_assistant_reply_cache_lookups_total', 'Idempotent reply lookups by result', 'counter', 'result',
+    lambda: _reply_cache.stats if _reply_cache is not None else {}
+)
+register_callback_metric(
+    'voice_assistant_text_audio_lookups_total', 'Text reply audio lookups by result', 'counter', 'result',
+    lambda: _text_audio_cache.stats if _text_audio_cache is not None else {}
+)
@@ -0,0 +1,364 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import AsyncIterator, List, Optional, Tuple
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+from transcoding.audio_probe import measure_seconds_per_byte
+from transcoding.format_detection import detect_audio_format
+from utils.executors import run_in_stage_executor
+from utils.file_utils import get_tmp_folder_path
+from utils.metrics import counter, set_trace_attribute, stage_span
+
+# Uploads larger or longer than this are rejected before anything is spent on them
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(50 * 1024 * 1024)))
+UPLOAD_MAX_SECONDS = float(os.getenv('UPLOAD_MAX_SECONDS', '600'))
+# Durations are estimated from the start of compressed uploads, so allow some slack
+UPLOAD_DURATION_TOLERANCE = 1.1
+# No recorder encodes speech below this bitrate (Opus's minimum), so smaller
+# uploads can't be too long and their duration isn't probed
+UPLOAD_MIN_BITRATE_BPS = 6000
+# Uploads are kept in memory up to this size, and spill over to scratch storage beyond it
+UPLOAD_SPOOL_MEMORY_BYTES = int(os.getenv('UPLOAD_SPOOL_MEMORY_BYTES', str(1024 * 1024)))
+# The container and bitrate are probed from this many bytes at the start of the upload
+UPLOAD_PROBE_BYTES = 64 * 1024
+# Bytes needed to recognize the container
+UPLOAD_SIGNATURE_BYTES = 64
+# The multipart field holding the audio
+UPLOAD_FIELD_NAME = 'file'
+
+UPLOAD_REJECTIONS = counter(
+    'voice_assistant_upload_rejections_total', 'Uploads rejected before processing', ('reason',)
+)
+
+
+class UploadRejected(Exception):
+    """Raised when an upload is too large, too long or not audio"""
+
+    def __init__(self, status_code: int, reason: str, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+
+
+def reject_upload(status_code: int, reason: str, detail: str) -> None:
+    UPLOAD_REJECTIONS.inc(reason=reason)
+    raise UploadRejected(status_code, reason, detail)
+
+
+class SpooledUpload:
+    """
+    An audio upload received into a bounded spool. The byte limit is enforced
+    as the data arrives, the container is checked from the first bytes, and
+    the duration is estimated from the start while the rest is still arriving.
+    """
+
+    def __init__(self, expected_bytes: Optional[int] = None):
+        self.filename: Optional[str] = None
+        self.content_type: Optional[str] = None
+        self.size = 0
+        self.audio_format: Optional[str] = None
+        self.estimated_seconds: Optional[float] = None
+        self._expected_bytes = expected_bytes
+        self._head = bytearray()
+        self._digest = hashlib.sha256()
+        self._file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MEMORY_BYTES, dir=get_tmp_folder_path())
+        self._probe: Optional[asyncio.Task] = None
+
+    @property
+    def sha256(self) -> str:
+        return self._digest.hexdigest()
+
+    @property
+    def _is_on_disk(self) -> bool:
+        # The spool rolls over to scratch storage once it holds more than its memory limit
+        return self.size > UPLOAD_SPOOL_MEMORY_BYTES
+
+    def _check_duration(self, seconds_per_byte: float, total_bytes: int) -> None:
+        self.estimated_seconds = seconds_per_byte * total_bytes
+        if self.estimated_seconds > UPLOAD_MAX_SECONDS * UPLOAD_DURATION_TOLERANCE:
+            reject_upload(413, 'too_long', f"Audio is about {self.estimated_seconds:.0f}s long, "
+                                          f"the limit is {UPLOAD_MAX_SECONDS:.0f}s")
+
+    def _detect_format(self) -> None:
+        self.audio_format = detect_audio_format(bytes(self._head))
+        if self.audio_format is None:
+            reject_upload(415, 'not_audio', "The upload isn't in a recognized audio format")
+
+    def _start_probe(self, total_bytes: Optional[int]) -> None:
+        could_be_too_long = total_bytes is None or (
+            total_bytes * 8 / UPLOAD_MIN_BITRATE_BPS > UPLOAD_MAX_SECONDS * UPLOAD_DURATION_TOLERANCE
+        )
+        if could_be_too_long:
+            # Runs while the rest of the upload arrives
+            self._probe = asyncio.create_task(self._measure_seconds_per_byte(bytes(self._head)))
+
+    @staticmethod
+    async def _measure_seconds_per_byte(head: bytes) -> Optional[float]:
+        try:
+            return await measure_seconds_per_byte(head)
+        except Exception as e:
+            # Such as a malformed WAV header or ffmpeg failing to start. The
+            # upload is then checked for size only, like undecodable containers.
+            print(f"Could not probe the duration of an upload: {e!r}")
+            return None
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.size > UPLOAD_MAX_BYTES:
+            reject_upload(413, 'too_large', f"Uploads are limited to {UPLOAD_MAX_BYTES} bytes")
+
+        if len(self._head) < UPLOAD_PROBE_BYTES:
+            self._head += data[:UPLOAD_PROBE_BYTES - len(self._head)]
+            if self.audio_format is None and len(self._head) >= UPLOAD_SIGNATURE_BYTES:
+                self._detect_format()
+            if len(self._head) >= UPLOAD_PROBE_BYTES:
+                self._start_probe(self._expected_bytes)
+        elif self._probe is not None and self._probe.done() and self._expected_bytes:
+            # Turn away overlong uploads without waiting for the rest of them
+            seconds_per_byte = self._probe.result()
+            if seconds_per_byte is not None:
+                self._check_duration(seconds_per_byte, self._expected_bytes)
+
+        self._digest.update(data)
+        # Includes the write that rolls the spool over, which creates the file
+        if self._is_on_disk:
+            await run_in_stage_executor('file_io', self._file.write, data)
+        else:
+            self._file.write(data)
+
+    async def finish(self) -> None:
+        """Check the complete upload"""
+        if self.size == 0:
+            reject_upload(415, 'not_audio', "The upload is empty")
+        if self.audio_format is None:
+            self._detect_format()
+        if self._probe is None:
+            self._start_probe(self.size)
+            if self._probe is None:
+                return
+        with stage_span('probe'):
+            seconds_per_byte = await self._probe
+        # Containers that can't be decoded from their start are checked for size only
+        if seconds_per_byte is not None:
+            self._check_duration(seconds_per_byte, self.size)
+
+    async def save(self, path: str) -> None:
+        """Copy the whole upload to a file"""
+        def copy_to_file() -> None:
+            self._file.seek(0)
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(self._file, f)
+
+        await run_in_stage_executor('file_io', copy_to_file)
+
+    async def read(self) -> bytes:
+        """Get the whole upload"""
+        def read_file() -> bytes:
+            self._file.seek(0)
+            return self._file.read()
+
+        if self._is_on_disk:
+            return await run_in_stage_executor('file_io', read_file)
+        return read_file()
+
+    def close(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+        self._file.close()
+
+
+class _AudioPartParser:
+    """Splits the audio parts of a multipart body into SpooledUploads as they arrive"""
+
+    def __init__(self, expected_bytes: Optional[int]):
+        self.expected_bytes = expected_bytes
+        # (upload, data) in the order they arrived; data is None where the upload's part ended
+        self.events: List[Tuple[SpooledUpload, Optional[bytes]]] = []
+        # Uploads not handed to the caller yet, to be closed if the body is rejected
+        self.unclaimed: List[SpooledUpload] = []
+        self._upload: Optional[SpooledUpload] = None
+        self._header_name = b''
+        self._header_value = b''
+        self._content_disposition = b''
+        self._content_type = b''
+
+    def on_part_begin(self) -> None:
+        self._content_disposition = b''
+        self._content_type = b''
+        self._upload = None
+
+    def on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def on_header_end(self) -> None:
+        name = self._header_name.lower()
+        if name == b'content-disposition':
+            self._content_disposition = self._header_value
+        elif name == b'content-type':
+            self._content_type = self._header_value
+        self._header_name = b''
+        self._header_value = b''
+
+    def on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._content_disposition)
+        # Any fields other than the audio are skipped
+        if options.get(b'name') == UPLOAD_FIELD_NAME.encode():
+            self._upload = SpooledUpload(self.expected_bytes)
+            self._upload.filename = options.get(b'filename', b'').decode(errors='replace') or None
+            self._upload.content_type = self._content_type.decode(errors='replace') or None
+            self.unclaimed.append(self._upload)
+
+    def on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._upload is not None:
+            self.events.append((self._upload, data[start:end]))
+
+    def on_part_end(self) -> None:
+        if self._upload is not None:
+            self.events.append((self._upload, None))
+        self._upload = None
+
+
+async def __iterate_multipart(request: Request, boundary: Optional[bytes],
+                              expected_bytes: Optional[int]) -> AsyncIterator[SpooledUpload]:
+    if not boundary:
+        reject_upload(400, 'malformed', "The multipart form has no boundary")
+
+    part_parser = _AudioPartParser(expected_bytes)
+    parser = MultipartParser(boundary, {
+        'on_part_begin': part_parser.on_part_begin,
+        'on_header_field': part_parser.on_header_field,
+        'on_header_value': part_parser.on_header_value,
+        'on_header_end': part_parser.on_header_end,
+        'on_headers_finished': part_parser.on_headers_finished,
+        'on_part_data': part_parser.on_part_data,
+        'on_part_end': part_parser.on_part_end,
+    })
+    try:
+        async for chunk in request.stream():
+            try:
+                parser.write(chunk)
+            except MultipartParseError as e:
+                reject_upload(400, 'malformed', f"The multipart form is malformed: {str(e)}")
+            # The parser's callbacks can't await, so the audio is written to the spools after each chunk
+            events = part_parser.events
+            part_parser.events = []
+            for upload, data in events:
+                if data is not None:
+                    await upload.write(data)
+                    continue
+                await upload.finish()
+                part_parser.unclaimed.remove(upload)
+                yield upload
+        parser.finalize()
+    finally:
+        for upload in part_parser.unclaimed:
+            upload.close()
+
+
+async def __spool_body(request: Request, expected_bytes: Optional[int]) -> SpooledUpload:
+    content_type, _ = parse_options_header(request.headers.get('content-type', ''))
+    upload = SpooledUpload(expected_bytes)
+    upload.content_type = content_type.decode(errors='replace') or None
+    try:
+        async for chunk in request.stream():
+            await upload.write(chunk)
+        await upload.finish()
+    except Exception:
+        upload.close()
+        raise
+    return upload
+
+
+def __get_expected_bytes(request: Request, max_bytes: int) -> Optional[int]:
+    content_length = request.headers.get('content-length')
+    expected_bytes = int(content_length) if content_length and content_length.isdigit() else None
+    if expected_bytes is not None and expected_bytes > max_bytes + UPLOAD_PROBE_BYTES:
+        # Larger than the limit even allowing for multipart framing
+        reject_upload(413, 'too_large', f"Uploads are limited to {max_bytes} bytes")
+    return expected_bytes
+
+
+def __is_multipart(request: Request) -> Tuple[bool, Optional[bytes]]:
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    return content_type == b'multipart/form-data', options.get(b'boundary')
+
+
+async def receive_audio_upload(request: Request) -> SpooledUpload:
+    """
+    Stream the audio of a request into a bounded spool, checking it as it
+    arrives. The audio is either the 'file' field of a multipart form, as
+    sent by the web client, or the whole request body.
+    Args:
+        request (Request): The request, whose body hasn't been read yet
+    Returns:
+        SpooledUpload: The checked upload; close it once it has been read
+    Raises:
+        UploadRejected: With 413 if the upload is too large or too long, with 415
+            if it isn't audio, or with 422 if a multipart form has no audio field
+    """
+    expected_bytes = __get_expected_bytes(request, UPLOAD_MAX_BYTES)
+    is_multipart, boundary = __is_multipart(request)
+
+    with stage_span('upload'):
+        if not is_multipart:
+            upload = await __spool_body(request, expected_bytes)
+        else:
+            # Only the first audio part is read
+            uploads = __iterate_multipart(request, boundary, expected_bytes)
+            upload = await anext(uploads, None)
+            await uploads.aclose()
+            if upload is None:
+                reject_upload(422, 'missing_file', f"The request has no '{UPLOAD_FIELD_NAME}' field")
+
+    set_trace_attribute('upload_bytes', upload.size)
+    if upload.estimated_seconds is not None:
+        set_trace_attribute('audio_seconds', round(upload.estimated_seconds, 2))
+    return upload
+
+
+async def receive_audio_uploads(request: Request, max_uploads: int,
+                                max_total_bytes: int) -> AsyncIterator[SpooledUpload]:
+    """
+    Stream the audio parts of a multipart form one at a time, checking each
+    one as it arrives like receive_audio_upload does
+    Args:
+        request (Request): The request, whose body hasn't been read yet
+        max_uploads (int): Most audio parts the form may have
+        max_total_bytes (int): Most bytes the whole form may have
+    Yields:
+        SpooledUpload: Each checked upload, in order; close it once it has been read
+    Raises:
+        UploadRejected: As for receive_audio_upload, or with 413 if there are too
+            many uploads or they are too large together
+    """
+    # Only turns away forms that are too large as a whole; the total size of
+    # the form says nothing about the length of each clip
+    __get_expected_bytes(request, max_total_bytes)
+    is_multipart, boundary = __is_multipart(request)
+    if not is_multipart:
+        reject_upload(415, 'not_multipart', "Clips are sent as the 'file' fields of a multipart form")
+
+    count = 0
+    total_bytes = 0
+    with stage_span('upload'):
+        async for upload in __iterate_multipart(request, boundary, None):
+            count += 1
+            total_bytes += upload.size
+            if count > max_uploads:
+                upload.close()
+                reject_upload(413, 'too_many_files', f"Batches are limited to {max_uploads} clips")
+            if total_bytes > max_total_bytes:
+                upload.close()
+                reject_upload(413, 'too_large', f"Batches are limited to {max_total_bytes} bytes")
+            yield upload
+
+    set_trace_attribute('upload_bytes', total_bytes)
+    if count == 0:
+        reject_upload(422, 'missing_file', f"The request has no '{UPLOAD_FIELD_NAME}' fields")
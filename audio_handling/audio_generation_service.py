@@ -1,16 +1,120 @@
-import boto3
-from typing import Dict, Any
+import asyncio
+import os
+from typing import AsyncIterator, Dict, Any, Optional
+from utils.admission import stage_limit
+from utils.executors import run_in_stage_executor
+from utils.text_utils import split_into_chunks
+from utils.metrics import stage_span
+from audio_handling.reply_formats import ReplyFormat, DEFAULT_REPLY_FORMAT
+from audio_handling.tts_cache import get_tts_cache, get_tts_cache_key
+from transcoding.transcoding_services import get_transcoder
+from utils.upstream_clients import get_upstream_clients
 
-def convert_text_to_audio(text_content: str) -> Dict[str, Any]:
-    polly_client = boto3.client('polly')
+POLLY_ENGINE = 'standard'
+POLLY_LANGUAGE_CODE = 'en-US'
+POLLY_OUTPUT_FORMAT = 'mp3'
+POLLY_VOICE_ID = 'Raveena'
+# Serve repeated phrases from the TTS cache instead of calling Polly again
+TTS_CACHE_ENABLED = os.getenv('TTS_CACHE_ENABLED', 'true').lower() == 'true'
+# Polly rejects requests with more text than this
+POLLY_MAX_TEXT_LENGTH = 3000
+# Longer texts are split between sentences into chunks of at most this many
+# characters, which are synthesized in parallel
+TTS_CHUNK_MAX_LENGTH = min(int(os.getenv('TTS_CHUNK_MAX_LENGTH', '1000')), POLLY_MAX_TEXT_LENGTH)
+# How many chunks of one text are synthesized at the same time
+TTS_CHUNK_PARALLELISM = int(os.getenv('TTS_CHUNK_PARALLELISM', '4'))
+
+def convert_text_to_audio(text_content: str, output_format: str = POLLY_OUTPUT_FORMAT,
+                          sample_rate: Optional[int] = None) -> Dict[str, Any]:
+    polly_client = get_upstream_clients().polly
+    options = {'SampleRate': str(sample_rate)} if sample_rate else {}
     try:
         response = polly_client.synthesize_speech(  # Fixed typo in synthesize
-            Engine='standard',
-            LanguageCode='en-US',
-            OutputFormat='mp3',
+            Engine=POLLY_ENGINE,
+            LanguageCode=POLLY_LANGUAGE_CODE,
+            OutputFormat=output_format,
             Text=text_content,
-            VoiceId='Raveena'
+            VoiceId=POLLY_VOICE_ID,
+            **options
         )
         return response
     except Exception as e:
         raise Exception(f"Failed to convert text to audio: {str(e)}")
+
+
+def __synthesize_audio_bytes(text_content: str, reply_format: ReplyFormat) -> bytes:
+    return convert_text_to_audio(
+        text_content, reply_format.polly_output_format, reply_format.sample_rate
+    )['AudioStream'].read()
+
+
+async def __call_polly(text_content: str, reply_format: ReplyFormat) -> bytes:
+    async with stage_limit('polly'):
+        audio = await run_in_stage_executor('tts', __synthesize_audio_bytes, text_content, reply_format)
+    if reply_format.codec == 'mp3' and reply_format.bitrate:
+        # Polly has no bitrate setting, so lower MP3 tiers are re-encoded
+        audio = await get_transcoder().to_mp3(audio, reply_format.sample_rate, 1, reply_format.bitrate)
+    return audio
+
+
+async def __synthesize_chunk(text_content: str, reply_format: ReplyFormat) -> bytes:
+    if not TTS_CACHE_ENABLED:
+        return await __call_polly(text_content, reply_format)
+
+    tts_cache = get_tts_cache()
+    cache_key = get_tts_cache_key(
+        text_content, POLLY_VOICE_ID, POLLY_ENGINE, POLLY_LANGUAGE_CODE, reply_format.key
+    )
+    audio = await tts_cache.get(cache_key)
+    if audio is None:
+        audio = await __call_polly(text_content, reply_format)
+        await tts_cache.put(cache_key, audio)
+    return audio
+
+
+async def stream_text_as_audio(text_content: str,
+                               reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> AsyncIterator[bytes]:
+    """
+    Synthesize text of any length, yielding its audio in order. Text longer
+    than TTS_CHUNK_MAX_LENGTH is split between sentences and the chunks are
+    synthesized in parallel, so a long text takes about as long as one chunk.
+    MP3 frames and PCM can simply be concatenated, so nothing is re-encoded.
+    Args:
+        text_content (str): The text to synthesize
+        reply_format (ReplyFormat): The format to synthesize in, MP3 or PCM
+    Yields:
+        bytes: The audio of each chunk, in order
+    """
+    parallelism = asyncio.Semaphore(TTS_CHUNK_PARALLELISM)
+
+    async def synthesize(chunk: str) -> bytes:
+        async with parallelism:
+            return await __synthesize_chunk(chunk, reply_format)
+
+    tasks = [asyncio.create_task(synthesize(chunk))
+             for chunk in split_into_chunks(text_content, TTS_CHUNK_MAX_LENGTH)]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        # Don't leave chunks synthesizing if the caller stops early or one of them failed
+        for task in tasks:
+            task.cancel()
+
+
+async def convert_text_to_audio_bytes(text_content: str, reply_format: ReplyFormat = DEFAULT_REPLY_FORMAT) -> bytes:
+    """
+    Convert text to audio without blocking the event loop. Repeated texts
+    are served from the TTS cache, which keeps each format separately;
+    otherwise the Polly call and the read of its audio stream run in the
+    bounded TTS thread pool. Long texts are synthesized as parallel chunks.
+    Args:
+        text_content (str): The text to synthesize
+        reply_format (ReplyFormat): The format to synthesize in, MP3 or PCM
+    Returns:
+        bytes: The audio
+    """
+    with stage_span('tts'):
+        if len(text_content) <= TTS_CHUNK_MAX_LENGTH:
+            return await __synthesize_chunk(text_content, reply_format)
+        return b''.join([chunk async for chunk in stream_text_as_audio(text_content, reply_format)])
@@ -1,23 +1,41 @@
-from openai import OpenAI
+from utils.admission import stage_limit
+from utils.executors import run_in_stage_executor
+from utils.text_utils import stitch_transcripts
+from utils.upstream_clients import get_upstream_clients
+from typing import List, Optional, Union
+import asyncio
+import os
 
+# Whisper infers the audio format from the file name, so in-memory audio needs one
+IN_MEMORY_AUDIO_FILE_NAME = 'user_audio.mp3'
+# How many segments of a long recording are transcribed at the same time
+TRANSCRIPTION_FAN_OUT = int(os.getenv('TRANSCRIPTION_FAN_OUT', '4'))
 
-def convert_audio_to_text(local_input_file_path: str) -> dict:
+
+async def convert_audio_to_text(audio: Union[str, bytes], file_name: Optional[str] = None) -> dict:
     """
-    Convert audio file to text using OpenAI's Whisper model
+    Convert audio to text using OpenAI's Whisper model
 
     Args:
-        local_input_file_path (str): Path to the local audio file
+        audio (Union[str, bytes]): Path to the local audio file, or the audio itself
+        file_name (Optional[str]): Name to upload in-memory audio under; its extension tells Whisper the format
 
     Returns:
-        str: Transcribed text from the audio file
+        str: Transcribed text from the audio
     """
-    # Initialize OpenAI client
-    client = OpenAI()
+    # Use the shared OpenAI client and its connection pool
+    client = get_upstream_clients().openai
 
     try:
-        # Open and transcribe the audio file
-        with open(local_input_file_path, 'rb') as audio_file:
-            transcription = client.audio.transcriptions.create(
+        if isinstance(audio, bytes):
+            # Send the in-memory buffer directly
+            audio_file = (file_name or IN_MEMORY_AUDIO_FILE_NAME, audio)
+        else:
+            # Read the audio file off the event loop
+            audio_file = (os.path.basename(audio), await run_in_stage_executor('file_io', __read_file, audio))
+
+        async with stage_limit('whisper'):
+            transcription = await client.audio.transcriptions.create(
                 model="whisper-1",
                 file=audio_file
             )
@@ -30,11 +48,48 @@ def convert_audio_to_text(local_input_file_path: str) -> dict:
         raise
 
 
+async def convert_audio_segments_to_text(segments: List[Union[str, bytes]], file_name: Optional[str] = None) -> str:
+    """
+    Transcribe consecutive segments of one recording concurrently and join the text
+
+    Args:
+        segments (List[Union[str, bytes]]): The segments in order, as paths or audio
+        file_name (Optional[str]): Name to upload in-memory audio under
+
+    Returns:
+        str: Transcribed text of the whole recording, with words repeated across segment overlaps removed
+    """
+    if len(segments) == 1:
+        return await convert_audio_to_text(segments[0], file_name)
+
+    fan_out = asyncio.Semaphore(TRANSCRIPTION_FAN_OUT)
+
+    async def transcribe_segment(segment: Union[str, bytes]) -> str:
+        async with fan_out:
+            return await convert_audio_to_text(segment, file_name)
+
+    tasks = [asyncio.create_task(transcribe_segment(segment)) for segment in segments]
+    try:
+        transcripts = await asyncio.gather(*tasks)
+    finally:
+        # Don't leave the other segments running if one of them failed
+        for task in tasks:
+            task.cancel()
+
+    print(f"Transcribed {len(segments)} segments with up to {TRANSCRIPTION_FAN_OUT} at a time")
+    return stitch_transcripts(transcripts)
+
+
+def __read_file(local_input_file_path: str) -> bytes:
+    with open(local_input_file_path, 'rb') as audio_file:
+        return audio_file.read()
+
+
 # Example usage
 if __name__ == "__main__":
     try:
         audio_path = "path/to/your/audio/file.mp3"
-        text = convert_audio_to_text(audio_path)
+        text = asyncio.run(convert_audio_to_text(audio_path))
         print(f"Transcribed text: {text}")
     except Exception as e:
         print(f"Failed to transcribe: {str(e)}")
\ No newline at end of file
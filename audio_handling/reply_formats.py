@@ -0,0 +1,188 @@
+import re
+from typing import List, Optional, Tuple
+
+# Encodings a spoken reply can be sent in. MP3 and PCM replies are synthesized
+# one chunk at a time and concatenated; the Ogg codecs are synthesized as PCM
+# and encoded as one continuous stream, since Ogg files can't be concatenated.
+REPLY_CODECS = {
+    'mp3': {
+        'media_type': 'audio/mpeg',
+        'extension': 'mp3',
+        # The rates Polly synthesizes MP3 at; 22050 Hz is its default for the standard engine
+        'sample_rates': (8000, 16000, 22050, 24000),
+        'default_sample_rate': 22050,
+        'default_bitrate': None,
+    },
+    'opus': {
+        'media_type': 'audio/ogg; codecs=opus',
+        'extension': 'opus',
+        # Polly synthesizes PCM at these rates only
+        'sample_rates': (8000, 16000),
+        'default_sample_rate': 16000,
+        # Plenty for a single voice
+        'default_bitrate': '24k',
+    },
+    'ogg_vorbis': {
+        'media_type': 'audio/ogg; codecs=vorbis',
+        'extension': 'ogg',
+        'sample_rates': (8000, 16000),
+        'default_sample_rate': 16000,
+        'default_bitrate': None,
+    },
+    'pcm': {
+        'media_type': 'audio/pcm',
+        'extension': 'pcm',
+        'sample_rates': (8000, 16000),
+        'default_sample_rate': 16000,
+        'default_bitrate': None,
+    },
+}
+DEFAULT_REPLY_CODEC = 'mp3'
+STREAM_ENCODED_CODECS = {'opus', 'ogg_vorbis'}
+# Bitrates clients may ask for, in kbit/s
+MIN_REPLY_BITRATE_KBPS = 8
+MAX_REPLY_BITRATE_KBPS = 320
+
+
+class UnsupportedReplyFormat(Exception):
+    """Raised when a client asks for a reply format that can't be produced"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+class ReplyFormat:
+    """
+    How a spoken reply is encoded: a codec from REPLY_CODECS, a sample rate
+    and, for the compressed codecs, an optional bitrate. MP3 at a chosen
+    bitrate is synthesized by Polly and re-encoded.
+    """
+
+    def __init__(self, codec: str = DEFAULT_REPLY_CODEC, sample_rate: Optional[int] = None,
+                 bitrate: Optional[str] = None):
+        if codec not in REPLY_CODECS:
+            raise UnsupportedReplyFormat(400, f"Unknown reply format '{codec}', expected one of {sorted(REPLY_CODECS)}")
+        codec_info = REPLY_CODECS[codec]
+
+        sample_rate = sample_rate or codec_info['default_sample_rate']
+        if sample_rate not in codec_info['sample_rates']:
+            raise UnsupportedReplyFormat(
+                400, f"{codec} replies are available at {', '.join(map(str, codec_info['sample_rates']))} Hz"
+            )
+
+        if bitrate is not None:
+            if codec == 'pcm':
+                raise UnsupportedReplyFormat(400, "pcm replies have no bitrate")
+            match = re.fullmatch(r'(\d+)k', bitrate.lower())
+            if not match or not MIN_REPLY_BITRATE_KBPS <= int(match[1]) <= MAX_REPLY_BITRATE_KBPS:
+                raise UnsupportedReplyFormat(
+                    400, f"Bitrates are given as {MIN_REPLY_BITRATE_KBPS}k to {MAX_REPLY_BITRATE_KBPS}k"
+                )
+            bitrate = bitrate.lower()
+
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate or codec_info['default_bitrate']
+
+    @property
+    def media_type(self) -> str:
+        if self.codec == 'pcm':
+            return f"audio/pcm; rate={self.sample_rate}; channels=1; encoding=s16le"
+        return REPLY_CODECS[self.codec]['media_type']
+
+    @property
+    def extension(self) -> str:
+        return REPLY_CODECS[self.codec]['extension']
+
+    @property
+    def is_stream_encoded(self) -> bool:
+        """Whether the reply is encoded as one stream rather than concatenated from chunks"""
+        return self.codec in STREAM_ENCODED_CODECS
+
+    @property
+    def chunk_format(self) -> 'ReplyFormat':
+        """The format each chunk of the reply is synthesized in"""
+        return ReplyFormat('pcm', self.sample_rate) if self.is_stream_encoded else self
+
+    @property
+    def polly_output_format(self) -> str:
+        return 'mp3' if self.codec == 'mp3' else 'pcm'
+
+    @property
+    def key(self) -> str:
+        """Identifies the format in cache keys. The default format is plain 'mp3', as it always was."""
+        key = self.codec
+        if self.sample_rate != REPLY_CODECS[self.codec]['default_sample_rate']:
+            key += f"@{self.sample_rate}"
+        if self.bitrate != REPLY_CODECS[self.codec]['default_bitrate']:
+            key += f"/{self.bitrate}"
+        return key
+
+
+DEFAULT_REPLY_FORMAT = ReplyFormat()
+
+
+def __parse_accept(accept: str) -> List[Tuple[str, dict]]:
+    """Get the media ranges of an Accept header with their parameters, most preferred first"""
+    media_ranges = []
+    for index, media_range in enumerate(accept.split(',')):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        options = {}
+        for param in params:
+            name, _, value = param.partition('=')
+            options[name.strip().lower()] = value.strip().strip('"').lower()
+        try:
+            quality = float(options.pop('q', '1'))
+        except ValueError:
+            quality = 0
+        if media_type and quality > 0:
+            media_ranges.append((-quality, index, media_type.lower(), options))
+    return [(media_type, options) for _, _, media_type, options in sorted(media_ranges)]
+
+
+def __codec_for_media_range(media_type: str, options: dict) -> Optional[str]:
+    if media_type in ('audio/mpeg', 'audio/mp3'):
+        return 'mp3'
+    if media_type == 'audio/opus' or (media_type == 'audio/ogg' and options.get('codecs') == 'opus'):
+        return 'opus'
+    if media_type == 'audio/ogg':
+        return 'ogg_vorbis'
+    if media_type == 'audio/pcm':
+        return 'pcm'
+    if media_type in ('audio/*', '*/*'):
+        return DEFAULT_REPLY_CODEC
+    return None
+
+
+def negotiate_reply_format(accept: Optional[str] = None, codec: Optional[str] = None,
+                           sample_rate: Optional[int] = None, bitrate: Optional[str] = None) -> ReplyFormat:
+    """
+    Choose the format of a reply from the request's query parameters or, if
+    they don't name a codec, its Accept header
+    Args:
+        accept (Optional[str]): The Accept header, e.g. "audio/ogg; codecs=opus, audio/mpeg;q=0.5"
+        codec (Optional[str]): A codec from REPLY_CODECS asked for explicitly
+        sample_rate (Optional[int]): The sample rate asked for, the codec's default if None
+        bitrate (Optional[str]): The bitrate asked for, such as '32k'
+    Returns:
+        ReplyFormat: The format to send the reply in
+    Raises:
+        UnsupportedReplyFormat: With 406 if the Accept header only names audio
+            types that can't be produced, or with 400 if the parameters are invalid
+    """
+    if codec is None and accept:
+        media_ranges = __parse_accept(accept)
+        for media_type, options in media_ranges:
+            codec = __codec_for_media_range(media_type, options)
+            if codec is not None:
+                if codec == 'pcm' and sample_rate is None and options.get('rate', '').isdigit():
+                    sample_rate = int(options['rate'])
+                break
+        else:
+            # Clients that don't ask for audio at all, like API explorers, get the default
+            if any(media_type.startswith('audio/') for media_type, _ in media_ranges):
+                raise UnsupportedReplyFormat(
+                    406, f"Replies are available as {', '.join(info['media_type'] for info in REPLY_CODECS.values())}"
+                )
+    return ReplyFormat(codec or DEFAULT_REPLY_CODEC, sample_rate, bitrate)
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from typing import List, Optional
+from utils.executors import run_in_stage_executor
+from utils.metrics import register_callback_metric
+
+# Size caps for the two cache tiers, in bytes of audio
+TTS_CACHE_MEMORY_BYTES = int(os.getenv('TTS_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024)))
+TTS_CACHE_DISK_BYTES = int(os.getenv('TTS_CACHE_DISK_BYTES', str(512 * 1024 * 1024)))
+TTS_CACHE_DIR = os.getenv('TTS_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'oz_voice_assistant_tts_cache'))
+# Suffix of entries still being written, which are neither counted nor evicted
+TTS_CACHE_TMP_SUFFIX = '.tmp'
+
+
+def normalize_tts_text(text: str) -> str:
+    """Normalize text so that differences Polly doesn't pronounce share a cache entry"""
+    return ' '.join(text.split())
+
+
+def get_tts_cache_key(text: str, voice_id: str, engine: str, language_code: str, output_format: str) -> str:
+    """Build the content address of a synthesized phrase"""
+    key_source = '\0'.join([normalize_tts_text(text), voice_id, engine, language_code, output_format])
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+class TTSCache:
+    """
+    Content-addressed cache of synthesized audio. A bounded in-memory LRU is
+    checked first, then a size-capped directory on disk. Disk hits are
+    promoted to memory, and the oldest disk entries are removed once the
+    directory is over its cap.
+    """
+
+    def __init__(self, cache_dir: str = TTS_CACHE_DIR,
+                 max_memory_bytes: int = TTS_CACHE_MEMORY_BYTES,
+                 max_disk_bytes: int = TTS_CACHE_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_bytes = 0
+        self.stats = Counter()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Writes run on several file_io threads, so the disk size and eviction are guarded
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = sum(entry.stat().st_size for entry in self._disk_entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _disk_entries(self) -> List[os.DirEntry]:
+        return [
+            entry for entry in os.scandir(self.cache_dir)
+            if entry.is_file() and not entry.name.endswith(TTS_CACHE_TMP_SUFFIX)
+        ]
+
+    def _put_in_memory(self, key: str, audio: bytes) -> None:
+        if len(audio) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key))
+        self._memory[key] = audio
+        self._memory_bytes += len(audio)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _read_from_disk(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), 'rb') as f:
+                audio = f.read()
+            # Touch the file so eviction removes the least recently used entries
+            os.utime(self._path(key))
+            return audio
+        except FileNotFoundError:
+            return None
+
+    def _write_to_disk(self, key: str, audio: bytes) -> None:
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+
+        # Write under a temporary name of its own so readers never see a partial file,
+        # even if another thread is synthesizing the same phrase
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=f"{key}.", suffix=TTS_CACHE_TMP_SUFFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(audio)
+            with self._disk_lock:
+                if os.path.exists(path):
+                    return
+                os.replace(tmp_path, path)
+                self._disk_bytes += len(audio)
+                if self._disk_bytes > self.max_disk_bytes:
+                    self._evict_from_disk()
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _evict_from_disk(self) -> None:
+        """Remove the least recently used entries until the directory is under its cap. Needs _disk_lock."""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry.stat().st_mtime)
+        self._disk_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                self._disk_bytes -= entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """
+        Look up synthesized audio
+        Args:
+            key (str): Key from get_tts_cache_key
+        Returns:
+            Optional[bytes]: The cached audio, or None on a miss
+        """
+        audio = self._memory.get(key)
+        if audio is not None:
+            self._memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return audio
+
+        audio = await run_in_stage_executor('file_io', self._read_from_disk, key)
+        if audio is not None:
+            self._put_in_memory(key, audio)
+            self.stats['disk_hits'] += 1
+            return audio
+
+        self.stats['misses'] += 1
+        return None
+
+    async def put(self, key: str, audio: bytes) -> None:
+        """Store synthesized audio in both tiers"""
+        self._put_in_memory(key, audio)
+        await run_in_stage_executor('file_io', self._write_to_disk, key, audio)
+
+
+_tts_cache: Optional[TTSCache] = None
+
+
+def get_tts_cache() -> TTSCache:
+    """Get or create the shared TTSCache instance"""
+    global _tts_cache
+    if _tts_cache is None:
+        _tts_cache = TTSCache()
+    return _tts_cache
+
+
+register_callback_metric(
+    'voice_assistant_tts_cache_lookups_total', 'TTS cache lookups by result', 'counter', 'result',
+    lambda: _tts_cache.stats if _tts_cache is not None else {}
+)
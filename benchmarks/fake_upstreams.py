@@ -0,0 +1,194 @@
+"""
+Local stand-ins for the upstream services, for load tests without API keys.
+
+One server answers as OpenAI (Whisper, chat completions), Polly and the
+Custom Search API, with a configurable latency distribution and failure
+rate per upstream. Point the app at it with OPENAI_BASE_URL,
+AWS_ENDPOINT_URL_POLLY and GOOGLE_SEARCH_BASE_URL.
+
+Usage:
+    python -m benchmarks.fake_upstreams --port 9100 --latency whisper=500 --failure-rate polly=0.01
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from transcoding.transcoding_services import SubprocessTranscoder
+
+# Median latency of each upstream in milliseconds. For chat completions this
+# is the time to the first token; the rest stream at CHAT_TOKEN_INTERVAL_MS.
+DEFAULT_LATENCY_MS = {
+    'whisper': 600,
+    'chat': 400,
+    'polly': 150,
+    'search': 250,
+}
+CHAT_TOKEN_INTERVAL_MS = 15
+# Spread of the log-normal latency distributions; 0 makes every call take the median
+DEFAULT_LATENCY_SIGMA = 0.3
+
+TRANSCRIPTS = [
+    "What's the weather like today?",
+    "Tell me a fun fact about octopuses.",
+    "What are the latest election results?",
+    "How do I make a good cup of coffee?",
+    "Can you explain that in simpler terms?",
+    "What is the current price of bitcoin?",
+    "Give me three ideas for a weekend trip.",
+    "Who won the game last night?",
+]
+REPLY_SENTENCES = [
+    "That's a great question.",
+    "Here is what I found for you, based on the most recent information available.",
+    "The short answer is that it depends on a few factors, including timing and location.",
+    "Many people find it helpful to start small and adjust from there.",
+    "Results are still coming in, so the numbers may change over the next few hours.",
+    "Let me know if you would like more detail on any of these points.",
+]
+
+
+def parse_overrides(values: List[str], defaults: Dict[str, float]) -> Dict[str, float]:
+    """Parse repeated NAME=VALUE options on top of defaults"""
+    result = dict(defaults)
+    for value in values or []:
+        name, _, number = value.partition('=')
+        if name not in defaults:
+            raise argparse.ArgumentTypeError(f"Unknown upstream '{name}', expected one of {sorted(defaults)}")
+        result[name] = float(number)
+    return result
+
+
+def generate_silent_mp3_frames() -> bytes:
+    """A short, valid MP3 to serve as synthesized speech"""
+    pcm = bytes(16000)  # Half a second of 16 kHz mono silence
+    return asyncio.run(SubprocessTranscoder().encode_mp3(pcm, sample_rate=16000, channels=1, bitrate='32k'))
+
+
+def create_fake_upstreams_app(latency_ms: Dict[str, float], failure_rates: Dict[str, float],
+                              sigma: float = DEFAULT_LATENCY_SIGMA, seed: int = 0) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(seed)
+    speech_audio = generate_silent_mp3_frames()
+    stats = {name: {'calls': 0, 'failures': 0} for name in DEFAULT_LATENCY_MS}
+
+    async def simulate(upstream: str) -> bool:
+        """Wait like the upstream would. Returns False if this call should fail."""
+        stats[upstream]['calls'] += 1
+        await asyncio.sleep(latency_ms[upstream] / 1000 * rng.lognormvariate(0, sigma))
+        if rng.random() < failure_rates[upstream]:
+            stats[upstream]['failures'] += 1
+            return False
+        return True
+
+    def failure(upstream: str) -> JSONResponse:
+        return JSONResponse({'error': {'message': f"Simulated {upstream} failure", 'type': 'server_error'}},
+                            status_code=500)
+
+    @app.get('/v1/models')
+    async def list_models():
+        return {'object': 'list', 'data': [{'id': 'whisper-1', 'object': 'model', 'created': 0, 'owned_by': 'fake'}]}
+
+    @app.post('/v1/audio/transcriptions')
+    async def transcribe(request: Request):
+        await request.body()
+        if not await simulate('whisper'):
+            return failure('whisper')
+        return {'text': rng.choice(TRANSCRIPTS)}
+
+    @app.post('/v1/chat/completions')
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if not await simulate('chat'):
+            return failure('chat')
+
+        # A different reply every time, so the TTS cache behaves as it would in production
+        reply = ' '.join(rng.sample(REPLY_SENTENCES, 3)) + f" Reference {rng.randrange(10 ** 6)}."
+        if not body.get('stream'):
+            return {
+                'id': 'chatcmpl-fake', 'object': 'chat.completion', 'created': int(time.time()), 'model': body['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+            }
+
+        async def stream_tokens():
+            words = reply.split(' ')
+            for index, word in enumerate(words):
+                chunk = {
+                    'id': 'chatcmpl-fake', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                    'model': body['model'],
+                    'choices': [{'index': 0, 'delta': {'content': word if index == 0 else f" {word}"},
+                                 'finish_reason': None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(CHAT_TOKEN_INTERVAL_MS / 1000)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream_tokens(), media_type='text/event-stream')
+
+    @app.post('/v1/speech')
+    async def synthesize_speech(request: Request):
+        body = await request.json()
+        if not await simulate('polly'):
+            return JSONResponse({'message': 'Simulated polly failure'}, status_code=500,
+                                headers={'x-amzn-ErrorType': 'ServiceFailureException'})
+        headers = {'x-amzn-RequestCharacters': str(len(body.get('Text', '')))}
+        if body.get('OutputFormat') == 'pcm':
+            # Half a second of silence at the requested rate
+            return Response(bytes(int(body.get('SampleRate') or 16000)), media_type='audio/pcm', headers=headers)
+        return Response(speech_audio, media_type='audio/mpeg', headers=headers)
+
+    @app.get('/v1/voices')
+    async def describe_voices():
+        return {'Voices': []}
+
+    @app.api_route('/customsearch/v1', methods=['GET', 'HEAD'])
+    async def custom_search(request: Request):
+        if request.method == 'HEAD':
+            return Response()
+        if not await simulate('search'):
+            return failure('search')
+        query = request.query_params.get('q', '')
+        return {'items': [
+            {
+                'title': f"Result {index} for {query}",
+                'snippet': f"{rng.randrange(100)} updates as of {rng.randrange(24)}:00, with {rng.randrange(10 ** 4)} votes counted.",
+                'link': f"https://example.com/{index}",
+            }
+            for index in range(5)
+        ]}
+
+    @app.get('/stats')
+    async def read_stats():
+        return stats
+
+    return app
+
+
+def add_upstream_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--latency', action='append', metavar='UPSTREAM=MS',
+                        help=f"Median latency of an upstream, repeatable. Defaults: {DEFAULT_LATENCY_MS}")
+    parser.add_argument('--failure-rate', action='append', metavar='UPSTREAM=RATE',
+                        help="Fraction of calls to an upstream that fail with a 500, repeatable")
+    parser.add_argument('--latency-sigma', type=float, default=DEFAULT_LATENCY_SIGMA,
+                        help="Spread of the log-normal latency distributions")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for latencies, failures and replies")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve fake Whisper, chat completions, Polly and Custom Search APIs")
+    parser.add_argument('--port', type=int, default=9100)
+    add_upstream_arguments(parser)
+    args = parser.parse_args()
+
+    app = create_fake_upstreams_app(
+        latency_ms=parse_overrides(args.latency, DEFAULT_LATENCY_MS),
+        failure_rates=parse_overrides(args.failure_rate, {name: 0.0 for name in DEFAULT_LATENCY_MS}),
+        sigma=args.latency_sigma,
+        seed=args.seed
+    )
+    uvicorn.run(app, host='127.0.0.1', port=args.port, log_level='warning')
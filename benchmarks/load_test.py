@@ -0,0 +1,295 @@
+"""
+Offline load test of /voice-assistant/audio-message.
+
+Starts the fake upstreams and the app (under uvicorn) as subprocesses,
+sends a corpus of generated clips at a fixed concurrency, and reports
+throughput, end-to-end and per-stage latency percentiles, and the app's
+peak RSS. Stage timings come from the Server-Timing header of each reply.
+No API keys, network access or microphone are needed.
+
+With --text, /voice-assistant/text-message is loaded instead, which skips
+the audio stages and so measures the LLM and search tier on its own. Stage
+timings then come from the reply's "done" event.
+
+Usage:
+    python -m benchmarks.load_test --requests 200 --concurrency 16
+    python -m benchmarks.load_test --latency whisper=1200 --failure-rate polly=0.02 --app-env TRANSCODER_ENGINE=pyav
+    python -m benchmarks.load_test --text --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+from uuid import uuid4
+import httpx
+from benchmarks.fake_upstreams import add_upstream_arguments, TRANSCRIPTS
+from benchmarks.transcoder_benchmark import generate_speech_like_wav
+from transcoding.transcoding_services import run_ffmpeg
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT_SECONDS = 30
+PERCENTILES = (50, 95, 99)
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Nearest-rank percentile"""
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percent / 100), len(ordered) - 1)]
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Get the milliseconds of each stage from a Server-Timing header"""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, *params = [part.strip() for part in entry.split(';')]
+        for param in params:
+            if name and param.startswith('dur='):
+                timings[name] = float(param[4:])
+    return timings
+
+
+def get_peak_rss_mb(pid: int) -> Optional[float]:
+    """Peak resident set size of a process, where /proc is available"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+async def build_clip_corpus(seconds: List[float], formats: List[str]) -> List[tuple]:
+    """Generate (name, audio) clips of every length in every format"""
+    clips = []
+    for clip_seconds in seconds:
+        wav = generate_speech_like_wav(clip_seconds)
+        for clip_format in formats:
+            if clip_format == 'wav':
+                audio = wav
+            elif clip_format == 'webm':
+                audio = await run_ffmpeg(['-i', 'pipe:0', '-c:a', 'libopus', '-b:a', '32k', '-f', 'webm', 'pipe:1'],
+                                         input_data=wav)
+            elif clip_format == 'mp3':
+                audio = await run_ffmpeg(['-i', 'pipe:0', '-c:a', 'libmp3lame', '-q:a', '2', '-f', 'mp3', 'pipe:1'],
+                                         input_data=wav)
+            else:
+                raise ValueError(f"Unsupported clip format: {clip_format}")
+            clips.append((f"{clip_seconds:g}s.{clip_format}", audio))
+    return clips
+
+
+def start_process(args: List[str], env: Dict[str, str], log_file) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, *args], cwd=PROJECT_ROOT, env=env,
+                            stdout=log_file, stderr=subprocess.STDOUT)
+
+
+async def wait_until_ready(url: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"Process exited with status {process.returncode} before {url} was ready")
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise TimeoutError(f"{url} wasn't ready after {STARTUP_TIMEOUT_SECONDS}s")
+
+
+async def send_text_message(client: httpx.AsyncClient, url: str, text: str, session_id: str) -> tuple:
+    """Send a text message and read its whole reply. Returns the status and the stage timings."""
+    async with client.stream('POST', url, json={'text': text}, headers={'X-Session-ID': session_id}) as response:
+        if response.status_code != 200:
+            return response.status_code, {}
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith('event: '):
+                event = line[len('event: '):]
+            elif line.startswith('data: ') and event in ('done', 'error'):
+                data = json.loads(line[len('data: '):])
+                return (200, data['timings_ms']) if event == 'done' else ('stream_error', {})
+    return 'incomplete', {}
+
+
+async def drive_load(app_url: str, clips: List[tuple], requests: int, concurrency: int, stream: bool,
+                     text: bool = False) -> dict:
+    results = []
+    next_request = iter(range(requests))
+    if text:
+        url = f"{app_url}/voice-assistant/text-message"
+    else:
+        url = f"{app_url}/voice-assistant/audio-message" + ('?stream=true' if stream else '')
+
+    async def virtual_user(user: int, client: httpx.AsyncClient):
+        for index in next_request:
+            clip_name, audio = clips[index % len(clips)]
+            started_at = time.perf_counter()
+            try:
+                if text:
+                    status, stages = await send_text_message(
+                        client, url, TRANSCRIPTS[index % len(TRANSCRIPTS)], f"load-test-{user}"
+                    )
+                else:
+                    response = await client.post(
+                        url,
+                        files={'file': ('recording.mp3', audio)},
+                        # Each virtual user keeps its own conversation, so histories grow as in real use.
+                        # Clips repeat, so every request gets its own idempotency key to avoid replayed replies.
+                        headers={'X-Session-ID': f"load-test-{user}", 'Idempotency-Key': uuid4().hex}
+                    )
+                    status = response.status_code
+                    stages = parse_server_timing(response.headers.get('server-timing'))
+            except httpx.HTTPError as e:
+                status, stages = type(e).__name__, {}
+            results.append({
+                'clip': clip_name,
+                'status': status,
+                'latency_ms': (time.perf_counter() - started_at) * 1000,
+                'stages_ms': stages,
+            })
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        started_at = time.perf_counter()
+        await asyncio.gather(*(virtual_user(user, client) for user in range(concurrency)))
+        elapsed_seconds = time.perf_counter() - started_at
+
+    return {'elapsed_seconds': elapsed_seconds, 'results': results}
+
+
+def summarize(run: dict, peak_rss_mb: Optional[float]) -> dict:
+    results = run['results']
+    succeeded = [result for result in results if result['status'] == 200]
+
+    latencies = {'total': [result['latency_ms'] for result in succeeded]}
+    stage_latencies = defaultdict(list)
+    for result in succeeded:
+        for stage, milliseconds in result['stages_ms'].items():
+            stage_latencies[stage].append(milliseconds)
+    latencies.update(stage_latencies)
+
+    return {
+        'requests': len(results),
+        'succeeded': len(succeeded),
+        'statuses': dict(Counter(str(result['status']) for result in results)),
+        'elapsed_seconds': run['elapsed_seconds'],
+        'throughput_rps': len(succeeded) / run['elapsed_seconds'],
+        'latency_ms': {
+            name: {
+                **{f"p{percent}": percentile(values, percent) for percent in PERCENTILES},
+                'mean': statistics.mean(values),
+            }
+            for name, values in latencies.items() if values
+        },
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def print_report(summary: dict) -> None:
+    print(f"\nRequests: {summary['requests']} ({summary['succeeded']} succeeded), statuses: {summary['statuses']}")
+    print(f"Throughput: {summary['throughput_rps']:.2f} req/s over {summary['elapsed_seconds']:.1f}s")
+    peak_rss = summary['peak_rss_mb']
+    print(f"App peak RSS: {f'{peak_rss:.1f} MB' if peak_rss is not None else 'n/a'}\n")
+
+    print(f"{'latency ms':<16}" + ''.join(f"{f'p{percent}':>10}" for percent in PERCENTILES) + f"{'mean':>10}")
+    for name, values in summary['latency_ms'].items():
+        print(f"{name:<16}" + ''.join(f"{values[f'p{percent}']:>10.1f}" for percent in PERCENTILES)
+              + f"{values['mean']:>10.1f}")
+
+
+async def run_load_test(args: argparse.Namespace) -> dict:
+    if args.text:
+        clips = [('text', b'')]
+    else:
+        clips = await build_clip_corpus(args.clip_seconds, args.clip_formats)
+        print(f"Generated {len(clips)} clips: {', '.join(name for name, _ in clips)}")
+
+    upstream_port, app_port = get_free_port(), get_free_port()
+    upstream_url = f"http://127.0.0.1:{upstream_port}"
+    app_url = f"http://127.0.0.1:{app_port}"
+
+    upstream_args = ['--port', str(upstream_port), '--latency-sigma', str(args.latency_sigma), '--seed', str(args.seed)]
+    for latency in args.latency or []:
+        upstream_args += ['--latency', latency]
+    for failure_rate in args.failure_rate or []:
+        upstream_args += ['--failure-rate', failure_rate]
+
+    with tempfile.TemporaryDirectory() as scratch_dir, open(args.app_log, 'w') as log_file:
+        app_env = {
+            **os.environ,
+            'OPENAI_API_KEY': 'load-test', 'OPENAI_ORG_ID': 'load-test',
+            'OPENAI_BASE_URL': f"{upstream_url}/v1",
+            'AWS_ENDPOINT_URL_POLLY': upstream_url,
+            'AWS_ACCESS_KEY_ID': 'load-test', 'AWS_SECRET_ACCESS_KEY': 'load-test', 'AWS_DEFAULT_REGION': 'us-east-1',
+            'GOOGLE_SEARCH_BASE_URL': f"{upstream_url}/customsearch/v1",
+            'GOOGLE_API_KEY': 'load-test', 'GOOGLE_CSE_ID': 'load-test',
+            # Keep every run's state separate from the developer's and from other runs
+            'CONVERSATION_BACKEND': 'memory',
+            'TTS_CACHE_DIR': os.path.join(scratch_dir, 'tts_cache'),
+            'BATCH_DB_PATH': os.path.join(scratch_dir, 'batch_jobs.db'),
+            'BATCH_STORAGE_DIR': os.path.join(scratch_dir, 'batch_jobs'),
+            'SCRATCH_BASE_DIR': scratch_dir,
+        }
+        for setting in args.app_env or []:
+            name, _, value = setting.partition('=')
+            app_env[name] = value
+
+        upstreams = start_process(['-m', 'benchmarks.fake_upstreams', *upstream_args], os.environ.copy(), log_file)
+        app = None
+        try:
+            await wait_until_ready(f"{upstream_url}/stats", upstreams)
+            app = start_process(['-m', 'uvicorn', 'main:app', '--host', '127.0.0.1', '--port', str(app_port),
+                                 '--log-level', 'warning'], app_env, log_file)
+            await wait_until_ready(f"{app_url}/metrics", app)
+
+            print(f"Sending {args.requests} requests with {args.concurrency} concurrent users...")
+            run = await drive_load(app_url, clips, args.requests, args.concurrency, args.stream, args.text)
+            summary = summarize(run, get_peak_rss_mb(app.pid))
+        finally:
+            for process in (app, upstreams):
+                if process is not None:
+                    process.terminate()
+                    process.wait()
+
+    print_report(summary)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(summary, output, indent=2)
+        print(f"\nWrote results to {args.output}")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the voice assistant against local fake upstreams")
+    parser.add_argument('--requests', type=int, default=100, help="Total requests to send")
+    parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once")
+    parser.add_argument('--clip-seconds', type=float, nargs='+', default=[2, 5, 10], help="Lengths of the clips")
+    parser.add_argument('--clip-formats', nargs='+', default=['wav', 'webm'], choices=['wav', 'webm', 'mp3'],
+                        help="Formats of the clips")
+    parser.add_argument('--stream', action='store_true',
+                        help="Request streamed replies. Stage timings then cover only the stages before the first sentence.")
+    parser.add_argument('--text', action='store_true',
+                        help="Send text messages instead of clips, to load the LLM and search tier on its own")
+    parser.add_argument('--app-env', action='append', metavar='NAME=VALUE',
+                        help="Extra environment for the app, such as TRANSCODER_ENGINE=pyav, repeatable")
+    parser.add_argument('--app-log', default=os.devnull, help="File to write the app's and upstreams' output to")
+    parser.add_argument('--output', help="Write the results as JSON to this file, for comparing runs")
+    add_upstream_arguments(parser)
+    asyncio.run(run_load_test(parser.parse_args()))
@@ -0,0 +1,106 @@
+"""
+Micro-benchmark of the transcoding engines.
+
+Runs the same clips through every available engine, the same way the
+pipeline does (full MP3 transcode, and decode + re-encode as in the
+preprocessing stage), and reports per-clip wall-clock latency and CPU time.
+CPU time includes child processes, so ffmpeg's own work is counted for the
+subprocess engine.
+
+Usage:
+    python -m benchmarks.transcoder_benchmark --iterations 20 --seconds 5
+"""
+import argparse
+import asyncio
+import io
+import resource
+import statistics
+import time
+import wave
+from typing import Callable, Dict, List
+import numpy as np
+from transcoding.transcoding_services import create_transcoder, Transcoder
+
+SAMPLE_RATE = 48000
+
+
+def generate_speech_like_wav(seconds: float) -> bytes:
+    """Generate a stereo 48 kHz WAV of amplitude-modulated tones with silence around them"""
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    syllables = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    voice = np.sin(2 * np.pi * 180 * t) + 0.5 * np.sin(2 * np.pi * 360 * t)
+    signal = voice * syllables * 0.3
+    # Half a second of silence at both ends, like a push-to-talk recording
+    signal[:SAMPLE_RATE // 2] = 0
+    signal[-SAMPLE_RATE // 2:] = 0
+
+    samples = (signal * 32767).astype(np.int16)
+    stereo = np.repeat(samples[:, None], 2, axis=1)
+
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav_file:
+        wav_file.setnchannels(2)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(stereo.tobytes())
+    return output.getvalue()
+
+
+def cpu_seconds() -> float:
+    """CPU time used by this process and its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+async def measure(operation: Callable, iterations: int) -> Dict[str, float]:
+    latencies: List[float] = []
+    cpu_times: List[float] = []
+    for _ in range(iterations):
+        cpu_start, wall_start = cpu_seconds(), time.perf_counter()
+        await operation()
+        latencies.append(time.perf_counter() - wall_start)
+        cpu_times.append(cpu_seconds() - cpu_start)
+
+    latencies.sort()
+    return {
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000,
+        'cpu_ms': statistics.mean(cpu_times) * 1000,
+    }
+
+
+async def run_benchmark(iterations: int, seconds: float) -> None:
+    # create_transcoder('pyav') returns the subprocess engine when PyAV isn't installed
+    engines: List[Transcoder] = list({
+        engine.name: engine for engine in [create_transcoder('subprocess'), create_transcoder('pyav')]
+    }.values())
+
+    wav_clip = generate_speech_like_wav(seconds)
+    mp3_clip = await engines[0].to_mp3(wav_clip)
+    clips = {'wav': wav_clip, 'mp3': mp3_clip}
+
+    print(f"{'engine':<12}{'input':<7}{'operation':<20}{'p50 ms':>10}{'p95 ms':>10}{'cpu ms':>10}")
+    for engine in engines:
+        for clip_name, clip in clips.items():
+            async def transcode():
+                await engine.to_mp3(clip)
+
+            async def preprocess():
+                pcm = await engine.decode_pcm(clip, sample_rate=16000, channels=1)
+                await engine.encode_mp3(pcm, sample_rate=16000, channels=1, bitrate='32k')
+
+            for operation_name, operation in [('to_mp3', transcode), ('decode+encode 16k', preprocess)]:
+                # Warm up codecs and thread pools before measuring
+                await operation()
+                result = await measure(operation, iterations)
+                print(f"{engine.name:<12}{clip_name:<7}{operation_name:<20}"
+                      f"{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}{result['cpu_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-clip latency and CPU time of the transcoders")
+    parser.add_argument('--iterations', type=int, default=20, help="Runs per engine, input and operation")
+    parser.add_argument('--seconds', type=float, default=5, help="Length of the generated clip")
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.iterations, args.seconds))
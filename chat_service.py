@@ -1,10 +1,96 @@
 from openai import AsyncOpenAI
-from typing import List, Dict, Optional
-from googleapiclient.discovery import build
+from typing import List, Dict, Optional, AsyncIterator, AsyncContextManager, Tuple
+from utils.text_utils import pop_speakable_units
+from search.google_search_client import GoogleSearchClient
+from utils.upstream_clients import get_upstream_clients
+from utils.admission import stage_limit
+from utils.metrics import stage_span, set_trace_attribute, register_callback_metric
+from sessions.conversation_store import get_conversation_backend
+from context_window import ContextWindowManager, SEARCH_RESULTS_PREFIX
+from collections import Counter, deque
+import asyncio
+import contextlib
 import os
+import weakref
+import re
 import json
 from datetime import datetime
 
+# Session used by callers that don't track their own conversation
+DEFAULT_SESSION_ID = 'default'
+# Cheaper model used to fold old turns into the rolling conversation summary
+CONTEXT_SUMMARY_MODEL = os.getenv('CONTEXT_SUMMARY_MODEL', 'gpt-3.5-turbo')
+# Number of recent turns whose prompt token statistics are kept
+PROMPT_STATS_HISTORY_SIZE = 100
+# How to decide whether a turn needs a Google search: 'heuristic' or 'always'
+SEARCH_ROUTING = os.getenv('SEARCH_ROUTING', 'heuristic')
+
+
+class SearchRouter:
+    """
+    Decides per turn whether a Google search is needed, using cheap local
+    heuristics. Small talk and follow-ups about the previous answer are
+    answered from the history alone. Counts of each decision and its reason
+    are kept in stats.
+    """
+
+    # Utterances made up only of these words are small talk
+    SMALL_TALK_WORDS = {
+        'thanks', 'thank', 'you', 'thx', 'ok', 'okay', 'cool', 'great', 'nice', 'awesome', 'perfect',
+        'got', 'it', 'yes', 'yeah', 'yep', 'no', 'nope', 'sure', 'right', 'alright', 'fine', 'good',
+        'hi', 'hello', 'hey', 'bye', 'goodbye', 'see', 'later', 'morning', 'evening', 'night',
+        'there', 'how', 'are', 'doing', 'so', 'much', 'very', 'that', 'is', 'sounds', 'makes', 'sense',
+        'all', 'oh', 'wow', 'hmm'
+    }
+    # Phrases that ask about the conversation itself rather than the world
+    FOLLOW_UP_PATTERN = re.compile(
+        r"\b(repeat( that)?|say (that|it) again|what did you (just )?say|tell me more|explain (that|it|this)|"
+        r"what do you mean|can you elaborate|(summari[sz]e|simplify) (that|it|this)|in simpler terms|"
+        r"why is that|how so|go on)\b"
+    )
+    # Words that signal the user wants current information
+    FRESHNESS_PATTERN = re.compile(
+        r"\b(latest|today|tonight|now|current(ly)?|live|news|update[sd]?|recent(ly)?|this (week|month|year)|"
+        r"score|results?|won|winning|election|weather|forecast|price|stock|breaking)\b"
+    )
+
+    def __init__(self, mode: str = SEARCH_ROUTING):
+        self.mode = mode
+        self.stats = Counter()
+
+    def _decide(self, user_input: str, history: List[Dict[str, str]]) -> Tuple[bool, str]:
+        if self.mode == 'always':
+            return True, 'always'
+
+        text = user_input.lower().strip()
+        words = re.findall(r"[a-z']+", text)
+
+        if not words or set(words) <= self.SMALL_TALK_WORDS:
+            return False, 'small_talk'
+        if self.FRESHNESS_PATTERN.search(text):
+            return True, 'fresh_information'
+
+        has_previous_answer = any(message['role'] == 'assistant' for message in history)
+        if has_previous_answer and self.FOLLOW_UP_PATTERN.search(text):
+            return False, 'follow_up'
+
+        return True, 'default'
+
+    def needs_search(self, user_input: str, history: List[Dict[str, str]]) -> bool:
+        """
+        Decide whether a turn needs a Google search
+        Args:
+            user_input (str): The user's input/question
+            history (List[Dict[str, str]]): The conversation before this turn
+        Returns:
+            bool: True if the turn should be searched
+        """
+        search, reason = self._decide(user_input, history)
+        self.stats['search' if search else 'skip'] += 1
+        self.stats[f"reason:{reason}"] += 1
+        print(f"Search routing: {'search' if search else 'skip'} ({reason})")
+        return search
+
 
 class ChatInterface:
     _instance = None  # Singleton instance
@@ -17,26 +103,41 @@ class ChatInterface:
 
     def __init__(self, openai_api_key: str = None):
         if not self._initialized:
-            self.client = AsyncOpenAI(api_key=openai_api_key or os.getenv('OPENAI_API_KEY'))
-            self.google_api_key = os.getenv('GOOGLE_API_KEY')
-            self.google_cse_id = os.getenv('GOOGLE_CSE_ID')
-            self.messages: List[Dict[str, str]] = [
-                {
-                    "role": "system",
-                    "content": """You are a helpful assistant with real-time search capabilities.
-                    For current events like elections and live updates:
-                    1. Extract and present specific numbers, statistics, and concrete data from the search results
-                    2. If you find actual numbers or results, present them directly
-                    3. Only if no concrete data is found, then suggest checking specific sources
-                    4. Focus on extracting actionable information from the search results rather than just linking to sources
-                    5. For election results, prioritize reporting specific vote counts, seats won, and percentages if available
-
-                    Keep your responses focused on the actual data found. If you find real numbers or results, lead with those.
-                    Maintain conversation context and update information when asked for the latest."""
-                }
-            ]
+            # Only an explicitly passed key gets its own client; otherwise the shared one is used
+            self._own_client = AsyncOpenAI(api_key=openai_api_key) if openai_api_key else None
+            # Decides which turns need a search at all
+            self.search_router = SearchRouter()
+            # Conversation histories are kept per session in the configured backend
+            self.conversations = get_conversation_backend()
+            # One lock per session with a turn in progress, so overlapping turns don't overwrite each other's history
+            self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+            # Keeps each prompt under the token budget
+            self.context_window = ContextWindowManager(summarize=self._summarize)
+            # Prompt token statistics of the most recent turns, newest last
+            self.recent_prompt_stats = deque(maxlen=PROMPT_STATS_HISTORY_SIZE)
+            self.system_message: Dict[str, str] = {
+                "role": "system",
+                "content": """You are a helpful assistant with real-time search capabilities.
+                For current events like elections and live updates:
+                1. Extract and present specific numbers, statistics, and concrete data from the search results
+                2. If you find actual numbers or results, present them directly
+                3. Only if no concrete data is found, then suggest checking specific sources
+                4. Focus on extracting actionable information from the search results rather than just linking to sources
+                5. For election results, prioritize reporting specific vote counts, seats won, and percentages if available
+
+                Keep your responses focused on the actual data found. If you find real numbers or results, lead with those.
+                Maintain conversation context and update information when asked for the latest."""
+            }
             self._initialized = True
 
+    @property
+    def client(self) -> AsyncOpenAI:
+        return self._own_client or get_upstream_clients().openai
+
+    @property
+    def search_client(self) -> GoogleSearchClient:
+        return get_upstream_clients().search
+
     async def search_google(self, query: str) -> Optional[str]:
         """
         Perform a Google search using Custom Search API
@@ -46,23 +147,12 @@ class ChatInterface:
             str: Formatted search results or None if search fails
         """
         try:
-            service = build(
-                "customsearch", "v1",
-                developerKey=self.google_api_key,
-                static_discovery=False
-            )
-
             # Enhance the search query to target current results
             enhanced_query = f"{query} latest results live updates"
 
-            # Execute search with more specific parameters
-            result = service.cse().list(
-                q=enhanced_query,
-                cx=self.google_cse_id,
-                num=5,  # Increased number of results
-                dateRestrict='h1',  # Restrict to last hour
-                sort='date'  # Sort by date
-            ).execute()
+            # Served from the shared cache when the same query was searched recently
+            with stage_span('search'):
+                result = await self.search_client.search(enhanced_query)
 
             if 'items' not in result:
                 return None
@@ -94,40 +184,130 @@ class ChatInterface:
             print(f"Google Search error: {str(e)}")
             return None
 
-    async def get_response(self, user_input: str) -> str:
+    def _get_session_lock(self, session_id: Optional[str]) -> AsyncContextManager:
+        """
+        Get the lock a turn holds from loading its session's history until saving it.
+        It is dropped once no turn of the session holds or waits for it. One-off
+        turns have no history to protect, so they don't wait for each other.
+        """
+        if session_id is None:
+            return contextlib.nullcontext()
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = self._session_locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def get_conversation_history(self, session_id: Optional[str] = DEFAULT_SESSION_ID) -> List[Dict[str, str]]:
+        """Get the conversation history of a session, starting with the system message"""
+        if session_id is None:
+            return [self.system_message]
+        with stage_span('history'):
+            messages = await self.conversations.load(session_id)
+        return messages if messages is not None else [self.system_message]
+
+    async def clear_history(self, session_id: str = DEFAULT_SESSION_ID):
+        """Clear a session's chat history, leaving only the system message"""
+        await self.conversations.delete(session_id)
+        print("Conversation history cleared")
+
+    async def _add_user_turn(self, messages: List[Dict[str, str]], user_input: str) -> None:
+        """
+        Add the user's message and any relevant search results to the history
+        Args:
+            messages (List[Dict[str, str]]): The session's conversation history
+            user_input (str): The user's input/question
+        """
+        needs_search = self.search_router.needs_search(user_input, messages)
+
+        # Add user message to history
+        messages.append({"role": "user", "content": user_input})
+
+        # Perform Google search for relevant information, unless the history is enough
+        search_results = await self.search_google(user_input) if needs_search else None
+        if search_results:
+            messages.append({
+                "role": "system",
+                "content": f"{SEARCH_RESULTS_PREFIX}\n{search_results}"
+            })
+
+    async def _summarize(self, transcript: str) -> str:
+        """Summarize earlier turns of a conversation so they can be dropped from the prompt"""
+        with stage_span('summarize'):
+            async with stage_limit('gpt'):
+                response = await self.client.chat.completions.create(
+                    model=CONTEXT_SUMMARY_MODEL,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": "Summarize this conversation in a few sentences. Keep names, numbers, "
+                                       "results and anything the user may refer back to."
+                        },
+                        {"role": "user", "content": transcript}
+                    ],
+                    temperature=0,
+                    max_tokens=300
+                )
+        return response.choices[0].message.content
+
+    async def _prepare_prompt(self, session_id: Optional[str], user_input: str) -> List[Dict[str, str]]:
+        """
+        Load the session's history, add the user's turn and trim it to the prompt token budget
+        Args:
+            session_id (Optional[str]): The conversation the input belongs to, or None for a one-off turn
+            user_input (str): The user's input/question
+        Returns:
+            List[Dict[str, str]]: The messages to send to GPT
+        """
+        messages = await self.get_conversation_history(session_id)
+        await self._add_user_turn(messages, user_input)
+
+        messages, prompt_stats = await self.context_window.fit(messages)
+        self.recent_prompt_stats.append({'session_id': session_id, **prompt_stats})
+        set_trace_attribute('prompt_tokens', prompt_stats['prompt_tokens'])
+        print(f"Prompt tokens: {prompt_stats['prompt_tokens']} "
+              f"(before trimming: {prompt_stats['prompt_tokens_before']})")
+
+        return messages
+
+    async def _add_assistant_turn(self, session_id: Optional[str], messages: List[Dict[str, str]],
+                                  assistant_message: str) -> None:
+        """Store the assistant's response and save the session's history"""
+        messages.append({"role": "assistant", "content": assistant_message})
+        if session_id is None:
+            # One-off turns aren't kept, so they never evict real conversations
+            return
+        with stage_span('history'):
+            await self.conversations.save(session_id, messages)
+
+        # Debug: Print conversation length
+        print(f"Conversation history length: {len(messages)} messages")
+
+    async def get_response(self, user_input: str, session_id: Optional[str] = DEFAULT_SESSION_ID) -> str:
         """
         Get a response from the assistant while maintaining conversation history
         Args:
             user_input (str): The user's input/question
+            session_id (Optional[str]): The conversation the input belongs to, or None for a one-off turn
         Returns:
             str: The assistant's response
         """
         try:
-            # Add user message to history
-            self.messages.append({"role": "user", "content": user_input})
-
-            # Perform Google search for relevant information
-            search_results = await self.search_google(user_input)
-            if search_results:
-                self.messages.append({
-                    "role": "system",
-                    "content": f"Here are relevant search results for the query:\n{search_results}"
-                })
-
-            # Get response from GPT-4
-            response = await self.client.chat.completions.create(
-                model="gpt-4-1106-preview",
-                messages=self.messages,
-                temperature=0.7,
-                max_tokens=2000
-            )
-
-            # Extract and store assistant's response
-            assistant_message = response.choices[0].message.content
-            self.messages.append({"role": "assistant", "content": assistant_message})
-
-            # Debug: Print conversation length
-            print(f"Conversation history length: {len(self.messages)} messages")
+            async with self._get_session_lock(session_id):
+                messages = await self._prepare_prompt(session_id, user_input)
+
+                # Get response from GPT-4
+                with stage_span('llm'):
+                    async with stage_limit('gpt'):
+                        response = await self.client.chat.completions.create(
+                            model="gpt-4-1106-preview",
+                            messages=messages,
+                            temperature=0.7,
+                            max_tokens=2000
+                        )
+
+                # Extract and store assistant's response
+                assistant_message = response.choices[0].message.content
+                await self._add_assistant_turn(session_id, messages, assistant_message)
 
             return assistant_message
 
@@ -135,40 +315,148 @@ class ChatInterface:
             print(f"Error getting response from OpenAI: {str(e)}")
             raise Exception(f"Failed to get AI response: {str(e)}")
 
-    def clear_history(self):
-        """Clear chat history except for the system message"""
-        self.messages = [self.messages[0]]
-        print("Conversation history cleared")
+    async def _read_response_stream(self, messages: List[Dict[str, str]], units: asyncio.Queue) -> str:
+        """
+        Stream a response from GPT-4 token by token into a queue of speakable units,
+        followed by None once the stream has ended or failed
+        Args:
+            messages (List[Dict[str, str]]): The prompt
+            units (asyncio.Queue): Where each unit is put as soon as it is complete
+        Returns:
+            str: The whole response
+        """
+        try:
+            with stage_span('llm'):
+                # The slot is held until the last token, as the stream occupies the upstream until then
+                async with stage_limit('gpt'):
+                    stream = await self.client.chat.completions.create(
+                        model="gpt-4-1106-preview",
+                        messages=messages,
+                        temperature=0.7,
+                        max_tokens=2000,
+                        stream=True
+                    )
+
+                    assistant_message = ''
+                    buffer = ''
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            continue
+                        token = chunk.choices[0].delta.content
+                        if not token:
+                            continue
 
-    def get_conversation_history(self) -> List[Dict[str, str]]:
-        """Get the current conversation history"""
-        return self.messages
+                        assistant_message += token
+                        buffer += token
+                        new_units, buffer = pop_speakable_units(buffer)
+                        for unit in new_units:
+                            units.put_nowait(unit)
+
+            if buffer.strip():
+                units.put_nowait(buffer.strip())
+            return assistant_message
+        finally:
+            units.put_nowait(None)
+
+    async def stream_response(self, user_input: str,
+                              session_id: Optional[str] = DEFAULT_SESSION_ID) -> AsyncIterator[str]:
+        """
+        Stream a response from the assistant in speakable units (sentences or long clauses)
+        Args:
+            user_input (str): The user's input/question
+            session_id (Optional[str]): The conversation the input belongs to, or None for a one-off turn
+        Yields:
+            str: Each unit of the response as soon as it is complete
+        """
+        try:
+            # A later turn of the session waits for this one, as it needs this reply in its history
+            async with self._get_session_lock(session_id):
+                messages = await self._prepare_prompt(session_id, user_input)
+
+                # The stream is read by a task of its own, so the GPT slot and the llm span
+                # end with the last token however slowly the units are consumed
+                units = asyncio.Queue()
+                reader = asyncio.create_task(self._read_response_stream(messages, units))
+                try:
+                    while (unit := await units.get()) is not None:
+                        yield unit
+                    assistant_message = await reader
+                finally:
+                    # Stop reading if the consumer has stopped listening
+                    reader.cancel()
+
+                # Store the full assistant response once generation has finished
+                await self._add_assistant_turn(session_id, messages, assistant_message)
+
+        except Exception as e:
+            print(f"Error streaming response from OpenAI: {str(e)}")
+            raise Exception(f"Failed to get AI response: {str(e)}")
 
 
 # Create a singleton instance
 _chat_interface = None
 
 
+def __get_recent_prompt_averages() -> Dict[str, float]:
+    if _chat_interface is None or not _chat_interface.recent_prompt_stats:
+        return {}
+    recent_prompt_stats = _chat_interface.recent_prompt_stats
+    return {
+        name: sum(stats[name] for stats in recent_prompt_stats) / len(recent_prompt_stats)
+        for name in ('prompt_tokens', 'prompt_tokens_before', 'dropped_search_results', 'summarized_messages')
+    }
+
+
+register_callback_metric(
+    'voice_assistant_search_routing_total', 'Search routing decisions and their reasons', 'counter', 'decision',
+    lambda: _chat_interface.search_router.stats if _chat_interface is not None else {}
+)
+register_callback_metric(
+    'voice_assistant_recent_prompt_average', 'Prompt statistics averaged over the most recent turns', 'gauge',
+    'statistic', __get_recent_prompt_averages
+)
+
+
 def get_chat_interface() -> ChatInterface:
     """Get or create the singleton ChatInterface instance"""
     global _chat_interface
     if _chat_interface is None:
-        _chat_interface = ChatInterface(openai_api_key=os.getenv('OPENAI_API_KEY'))
+        _chat_interface = ChatInterface()
     return _chat_interface
 
 
-async def handle_get_response_for_user(text_content: str) -> str:
+async def handle_get_response_for_user(text_content: str, session_id: str = DEFAULT_SESSION_ID) -> str:
     """
     Wrapper function to get response from ChatInterface
     Args:
         text_content (str): The text to send to the AI
+        session_id (str): The conversation the text belongs to
     Returns:
         str: The AI's response
     """
     try:
         # Use the singleton instance
         chat_interface = get_chat_interface()
-        response = await chat_interface.get_response(text_content)
+        response = await chat_interface.get_response(text_content, session_id)
         return response
     except Exception as e:
-        raise Exception(f"Failed to get response: {str(e)}")
\ No newline at end of file
+        raise Exception(f"Failed to get response: {str(e)}")
+
+
+async def handle_stream_response_for_user(text_content: str,
+                                          session_id: Optional[str] = DEFAULT_SESSION_ID) -> AsyncIterator[str]:
+    """
+    Wrapper function to stream a response from ChatInterface
+    Args:
+        text_content (str): The text to send to the AI
+        session_id (Optional[str]): The conversation the text belongs to, or None for a one-off turn
+    Yields:
+        str: The AI's response, one speakable unit at a time
+    """
+    try:
+        # Use the singleton instance
+        chat_interface = get_chat_interface()
+        async for unit in chat_interface.stream_response(text_content, session_id):
+            yield unit
+    except Exception as e:
+        raise Exception(f"Failed to get response: {str(e)}")
@@ -0,0 +1,169 @@
+import os
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to a character based estimate
+    tiktoken = None
+
+Messages = List[Dict[str, str]]
+
+# Most tokens the prompt sent to GPT may contain, reply excluded
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+# The most recent messages are always kept verbatim, never summarized
+CONTEXT_KEEP_RECENT_MESSAGES = int(os.getenv('CONTEXT_KEEP_RECENT_MESSAGES', '6'))
+
+# Prefixes that mark messages injected by ChatInterface rather than said by anyone
+SEARCH_RESULTS_PREFIX = "Here are relevant search results for the query:"
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+
+# Every message costs a few tokens of framing on top of its content,
+# and every reply is primed with a few more.
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_PROMPT = 3
+
+_encoding = None
+_encoding_unavailable = tiktoken is None
+
+
+def count_text_tokens(text: str) -> int:
+    """Count the tokens in a piece of text"""
+    global _encoding, _encoding_unavailable
+    if _encoding is None and not _encoding_unavailable:
+        try:
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # tiktoken downloads its encoding on first use, which can fail offline
+            print(f"Token encoding unavailable, estimating token counts: {str(e)}")
+            _encoding_unavailable = True
+
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text))
+
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    """Count the tokens a single chat message adds to the prompt"""
+    return TOKENS_PER_MESSAGE + count_text_tokens(message['content'])
+
+
+def count_prompt_tokens(messages: Messages) -> int:
+    """Count the tokens of a whole prompt"""
+    return TOKENS_PER_PROMPT + sum(count_message_tokens(message) for message in messages)
+
+
+def is_search_results(message: Dict[str, str]) -> bool:
+    return message['role'] == 'system' and message['content'].startswith(SEARCH_RESULTS_PREFIX)
+
+
+def is_summary(message: Dict[str, str]) -> bool:
+    return message['role'] == 'system' and message['content'].startswith(SUMMARY_PREFIX)
+
+
+class ContextWindowManager:
+    """
+    Keeps a conversation's prompt under a token budget. When the budget is
+    exceeded, search results from earlier turns are dropped first, oldest
+    first. If that isn't enough, the oldest turns are folded into a rolling
+    summary message that sits right after the system message.
+    """
+
+    def __init__(self,
+                 summarize: Optional[Callable[[str], Awaitable[str]]] = None,
+                 prompt_token_budget: int = PROMPT_TOKEN_BUDGET,
+                 keep_recent_messages: int = CONTEXT_KEEP_RECENT_MESSAGES):
+        """
+        Args:
+            summarize: Coroutine that summarizes a transcript. Without it, old turns are dropped instead.
+            prompt_token_budget (int): Most tokens the prompt may contain
+            keep_recent_messages (int): Number of latest messages that are never removed
+        """
+        self.summarize = summarize
+        self.prompt_token_budget = prompt_token_budget
+        self.keep_recent_messages = keep_recent_messages
+
+    def _latest_user_index(self, messages: Messages) -> int:
+        for index in range(len(messages) - 1, -1, -1):
+            if messages[index]['role'] == 'user':
+                return index
+        return len(messages)
+
+    def _drop_stale_search_results(self, messages: Messages) -> Tuple[Messages, int]:
+        """Drop search results, oldest first, until the prompt fits. The current turn's results are kept."""
+        current_turn_start = self._latest_user_index(messages)
+        stale_indexes = [index for index, message in enumerate(messages[:current_turn_start])
+                         if is_search_results(message)]
+
+        prompt_tokens = count_prompt_tokens(messages)
+        dropped = set()
+        for index in stale_indexes:
+            if prompt_tokens <= self.prompt_token_budget:
+                break
+            prompt_tokens -= count_message_tokens(messages[index])
+            dropped.add(index)
+
+        return [message for index, message in enumerate(messages) if index not in dropped], len(dropped)
+
+    async def _summarize_old_turns(self, messages: Messages) -> Tuple[Messages, int]:
+        """Fold the oldest turns into the rolling summary until the prompt fits"""
+        system_message, history = messages[0], messages[1:]
+        previous_summary = history.pop(0) if history and is_summary(history[0]) else None
+
+        # Never fold the current turn or the most recent messages
+        foldable_count = min(len(history) - self.keep_recent_messages, self._latest_user_index(history))
+        if foldable_count <= 0:
+            return messages, 0
+
+        excess_tokens = count_prompt_tokens(messages) - self.prompt_token_budget
+        fold_count = 0
+        while fold_count < foldable_count and excess_tokens > 0:
+            excess_tokens -= count_message_tokens(history[fold_count])
+            fold_count += 1
+        # Don't leave an assistant reply without the question it answered
+        while fold_count < foldable_count and history[fold_count]['role'] != 'user':
+            fold_count += 1
+        if fold_count == 0:
+            return messages, 0
+
+        folded, remaining = history[:fold_count], history[fold_count:]
+        transcript = "\n".join(
+            f"{message['role']}: {message['content']}"
+            for message in ([previous_summary] if previous_summary else []) + folded
+            if not is_search_results(message)
+        )
+
+        summary_message = []
+        if self.summarize is not None:
+            try:
+                summary = await self.summarize(transcript)
+                summary_message = [{"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"}]
+            except Exception as e:
+                print(f"Failed to summarize conversation, dropping old turns instead: {str(e)}")
+
+        return [system_message] + summary_message + remaining, len(folded)
+
+    async def fit(self, messages: Messages) -> Tuple[Messages, Dict[str, int]]:
+        """
+        Trim a conversation so that it fits the prompt token budget
+        Args:
+            messages (Messages): The conversation, starting with the system message
+        Returns:
+            Tuple[Messages, Dict[str, int]]: The trimmed conversation and its token statistics
+        """
+        prompt_tokens_before = count_prompt_tokens(messages)
+        dropped_search_results = 0
+        summarized_messages = 0
+
+        if prompt_tokens_before > self.prompt_token_budget:
+            messages, dropped_search_results = self._drop_stale_search_results(messages)
+
+        if count_prompt_tokens(messages) > self.prompt_token_budget:
+            messages, summarized_messages = await self._summarize_old_turns(messages)
+
+        stats = {
+            'prompt_tokens_before': prompt_tokens_before,
+            'prompt_tokens': count_prompt_tokens(messages),
+            'dropped_search_results': dropped_search_results,
+            'summarized_messages': summarized_messages,
+        }
+        return messages, stats
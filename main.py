@@ -1,14 +1,39 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from assistant.assistant_controller import controller as AssistantAudioController
+from assistant.batch_controller import controller as BatchJobController
+from assistant.batch_jobs import get_batch_job_queue
 from project_config import setup_app_config
+from utils.executors import shutdown_stage_executors
+from utils.upstream_clients import get_upstream_clients, close_upstream_clients
+from utils.file_utils import run_scratch_janitor
+from utils.metrics import render_metrics
+import asyncio
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the shared upstream clients and open their connections before taking traffic
+    await get_upstream_clients().warm_up()
+    # Enforce age and size quotas on scratch files in the background
+    scratch_janitor = asyncio.create_task(run_scratch_janitor())
+    # Work through queued batch jobs, including any left over from before a restart
+    get_batch_job_queue().start()
+    yield
+    await get_batch_job_queue().stop()
+    scratch_janitor.cancel()
+    # Let in-flight blocking calls finish before the worker exits
+    shutdown_stage_executors()
+    await close_upstream_clients()
 
 
 def create_app() -> FastAPI:
     setup_app_config()
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     # Mount static files
     app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -23,6 +48,7 @@ def create_app() -> FastAPI:
     ]
 
     app.include_router(AssistantAudioController, tags=['assistant'])
+    app.include_router(BatchJobController, tags=['batches'])
 
     app.add_middleware(
         CORSMiddleware,
@@ -36,6 +62,11 @@ def create_app() -> FastAPI:
     async def read_root(request: Request):
         return templates.TemplateResponse("index.html", {"request": request})
 
+    @app.get("/metrics")
+    async def read_metrics():
+        # Prometheus text exposition format
+        return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
     return app
 
 
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Dict
+import httpx
+
+GOOGLE_SEARCH_BASE_URL = os.getenv('GOOGLE_SEARCH_BASE_URL', 'https://www.googleapis.com/customsearch/v1')
+# Results are fresh for this long. Searches are restricted to the last hour,
+# so this is kept to a small fraction of that window.
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv('SEARCH_CACHE_TTL_SECONDS', '60'))
+# After going stale, results are still served for this long while they are refreshed in the background
+SEARCH_CACHE_STALE_SECONDS = float(os.getenv('SEARCH_CACHE_STALE_SECONDS', '120'))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+SEARCH_MAX_CONNECTIONS = int(os.getenv('SEARCH_MAX_CONNECTIONS', '20'))
+SEARCH_TIMEOUT_SECONDS = float(os.getenv('SEARCH_TIMEOUT_SECONDS', '5'))
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so trivially different phrasings share a cache entry"""
+    return ' '.join(query.lower().split())
+
+
+class GoogleSearchClient:
+    """
+    Async Custom Search API client on a pooled keep-alive connection.
+    Results are cached per normalized query with stale-while-revalidate, and
+    identical concurrent queries share a single upstream request.
+    """
+
+    def __init__(self, api_key: str, cse_id: str,
+                 ttl_seconds: float = SEARCH_CACHE_TTL_SECONDS,
+                 stale_seconds: float = SEARCH_CACHE_STALE_SECONDS,
+                 max_entries: int = SEARCH_CACHE_MAX_ENTRIES):
+        self.api_key = api_key
+        self.cse_id = cse_id
+        self.ttl_seconds = ttl_seconds
+        self.stale_seconds = stale_seconds
+        self.max_entries = max_entries
+        self.http_client = httpx.AsyncClient(
+            timeout=SEARCH_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=SEARCH_MAX_CONNECTIONS,
+                max_keepalive_connections=SEARCH_MAX_CONNECTIONS
+            )
+        )
+        # normalized query -> (fetched at, result)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        # normalized query -> the upstream request currently fetching it
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.stats = {'fresh_hits': 0, 'stale_hits': 0, 'misses': 0, 'coalesced': 0, 'upstream_requests': 0}
+
+    async def _fetch(self, query: str) -> dict:
+        self.stats['upstream_requests'] += 1
+        response = await self.http_client.get(GOOGLE_SEARCH_BASE_URL, params={
+            'key': self.api_key,
+            'cx': self.cse_id,
+            'q': query,
+            'num': 5,
+            'dateRestrict': 'h1',  # Restrict to last hour
+            'sort': 'date'  # Sort by date
+        })
+        response.raise_for_status()
+        return response.json()
+
+    async def _fetch_and_cache(self, cache_key: str, query: str) -> dict:
+        try:
+            result = await self._fetch(query)
+            self._cache[cache_key] = (time.monotonic(), result)
+            self._cache.move_to_end(cache_key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            return result
+        finally:
+            self._in_flight.pop(cache_key, None)
+
+    def _single_flight(self, cache_key: str, query: str) -> asyncio.Task:
+        """Get the in-flight request for a query, starting one if there is none"""
+        task = self._in_flight.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_and_cache(cache_key, query))
+            self._in_flight[cache_key] = task
+        else:
+            self.stats['coalesced'] += 1
+        return task
+
+    @staticmethod
+    def _log_refresh_failure(task: asyncio.Task) -> None:
+        # The stale result keeps being served until it expires
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Google Search refresh failed: {str(task.exception())}")
+
+    async def search(self, query: str) -> dict:
+        """
+        Run a Custom Search API query, served from cache when possible
+        Args:
+            query (str): The search query
+        Returns:
+            dict: The Custom Search API response
+        """
+        cache_key = normalize_query(query)
+        cached = self._cache.get(cache_key)
+        if cached is not None:
+            age = time.monotonic() - cached[0]
+            if age <= self.ttl_seconds:
+                self.stats['fresh_hits'] += 1
+                return cached[1]
+            if age <= self.ttl_seconds + self.stale_seconds:
+                self.stats['stale_hits'] += 1
+                if cache_key not in self._in_flight:
+                    self._single_flight(cache_key, query).add_done_callback(self._log_refresh_failure)
+                return cached[1]
+
+        self.stats['misses'] += 1
+        # Shield the shared request so one caller going away doesn't cancel it for the others
+        return await asyncio.shield(self._single_flight(cache_key, query))
+
+    async def warm_up(self) -> None:
+        """Open a pooled connection without running a search, which would use up quota"""
+        await self.http_client.head(GOOGLE_SEARCH_BASE_URL)
+
+    async def close(self) -> None:
+        await self.http_client.aclose()
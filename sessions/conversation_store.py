@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+from utils.executors import run_in_stage_executor
+
+Messages = List[Dict[str, str]]
+
+# Which backend holds conversations: 'memory' (per process) or 'sqlite' (shared by all workers)
+CONVERSATION_BACKEND = os.getenv('CONVERSATION_BACKEND', 'memory')
+# Most conversations kept by the in-memory backend before the least recently used is evicted
+CONVERSATION_MAX_SESSIONS = int(os.getenv('CONVERSATION_MAX_SESSIONS', '1000'))
+# Conversations idle for longer than this are evicted
+CONVERSATION_IDLE_TTL_SECONDS = int(os.getenv('CONVERSATION_IDLE_TTL_SECONDS', '3600'))
+# Location of the SQLite database used by the sqlite backend
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', 'conversations.db')
+
+
+class ConversationBackend:
+    """Storage for conversation histories keyed by session ID"""
+
+    async def load(self, session_id: str) -> Optional[Messages]:
+        """Get the messages of a session, or None if it doesn't exist or has expired"""
+        raise NotImplementedError
+
+    async def save(self, session_id: str, messages: Messages) -> None:
+        """Store the messages of a session and mark it as recently used"""
+        raise NotImplementedError
+
+    async def delete(self, session_id: str) -> None:
+        """Remove a session"""
+        raise NotImplementedError
+
+
+class InMemoryConversationBackend(ConversationBackend):
+    """
+    Per-process store with LRU and idle-TTL eviction. Sessions are kept in
+    least-recently-used order, so expired sessions are always at the front.
+    """
+
+    def __init__(self, max_sessions: int = CONVERSATION_MAX_SESSIONS,
+                 idle_ttl_seconds: int = CONVERSATION_IDLE_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        # session_id -> (last used timestamp, messages)
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _evict(self) -> None:
+        expire_before = time.monotonic() - self.idle_ttl_seconds
+        while self._sessions:
+            session_id, (last_used, _) = next(iter(self._sessions.items()))
+            if last_used >= expire_before and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+
+    async def load(self, session_id: str) -> Optional[Messages]:
+        self._evict()
+        if session_id not in self._sessions:
+            return None
+        # Refresh the timestamp along with the position, so the order stays the order of last use
+        messages = self._sessions[session_id][1]
+        self._sessions[session_id] = (time.monotonic(), messages)
+        self._sessions.move_to_end(session_id)
+        return list(messages)
+
+    async def save(self, session_id: str, messages: Messages) -> None:
+        self._sessions[session_id] = (time.monotonic(), list(messages))
+        self._sessions.move_to_end(session_id)
+        self._evict()
+
+    async def delete(self, session_id: str) -> None:
+        self._sessions.pop(session_id, None)
+
+
+class SQLiteConversationBackend(ConversationBackend):
+    """
+    Store backed by a local SQLite database in WAL mode, so several worker
+    processes on the same host can share sessions. Queries run in the
+    session_store thread pool with one connection per thread.
+    """
+
+    # How often, at most, expired sessions are purged from the database
+    EVICTION_INTERVAL_SECONDS = 60
+
+    def __init__(self, db_path: str = CONVERSATION_DB_PATH,
+                 idle_ttl_seconds: int = CONVERSATION_IDLE_TTL_SECONDS):
+        self.db_path = db_path
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self._local = threading.local()
+        self._last_eviction = 0.0
+
+        connection = self._get_connection()
+        connection.execute(
+            """CREATE TABLE IF NOT EXISTS conversations (
+                session_id TEXT PRIMARY KEY,
+                messages TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated_at ON conversations (updated_at)")
+
+    def _get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _load(self, session_id: str) -> Optional[Messages]:
+        row = self._get_connection().execute(
+            "SELECT messages FROM conversations WHERE session_id = ? AND updated_at >= ?",
+            (session_id, time.time() - self.idle_ttl_seconds)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, session_id: str, messages: Messages) -> None:
+        now = time.time()
+        connection = self._get_connection()
+        connection.execute(
+            """INSERT INTO conversations (session_id, messages, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(session_id) DO UPDATE SET messages = excluded.messages, updated_at = excluded.updated_at""",
+            (session_id, json.dumps(messages), now)
+        )
+        if now - self._last_eviction >= self.EVICTION_INTERVAL_SECONDS:
+            self._last_eviction = now
+            connection.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.idle_ttl_seconds,))
+
+    def _delete(self, session_id: str) -> None:
+        self._get_connection().execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
+
+    async def load(self, session_id: str) -> Optional[Messages]:
+        return await run_in_stage_executor('session_store', self._load, session_id)
+
+    async def save(self, session_id: str, messages: Messages) -> None:
+        await run_in_stage_executor('session_store', self._save, session_id, messages)
+
+    async def delete(self, session_id: str) -> None:
+        await run_in_stage_executor('session_store', self._delete, session_id)
+
+
+_conversation_backend = None
+
+
+def get_conversation_backend() -> ConversationBackend:
+    """Get or create the configured conversation backend"""
+    global _conversation_backend
+    if _conversation_backend is None:
+        if CONVERSATION_BACKEND == 'sqlite':
+            _conversation_backend = SQLiteConversationBackend()
+        elif CONVERSATION_BACKEND == 'memory':
+            _conversation_backend = InMemoryConversationBackend()
+        else:
+            raise ValueError(f"Unknown CONVERSATION_BACKEND: {CONVERSATION_BACKEND}")
+    return _conversation_backend
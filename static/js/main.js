@@ -1,6 +1,13 @@
 let mediaRecorder;
 let audioChunks = [];
 let isRecording = false;
+// Real-time connection; the recording is uploaded while the user speaks when it's open
+let realtimeSocket = null;
+let isRealtimeTurn = false;
+let replyPlayer = null;
+// How often MediaRecorder hands a slice of the recording to the real-time connection
+const RECORDER_TIMESLICE_MS = 250;
+const REALTIME_RECONNECT_DELAY_MS = 3000;
 
 document.addEventListener('DOMContentLoaded', () => {
     const recordButton = document.getElementById('recordButton');
@@ -15,10 +22,25 @@ document.addEventListener('DOMContentLoaded', () => {
             mediaRecorder = new MediaRecorder(stream);
 
             mediaRecorder.ondataavailable = (event) => {
-                audioChunks.push(event.data);
+                if (isRealtimeTurn) {
+                    // Upload each slice while the user is still speaking
+                    if (event.data.size > 0 && realtimeSocket) {
+                        realtimeSocket.send(event.data);
+                    }
+                } else {
+                    audioChunks.push(event.data);
+                }
             };
 
             mediaRecorder.onstop = async () => {
+                if (isRealtimeTurn) {
+                    // The last slice has been sent; end the turn if the server hasn't already
+                    isRealtimeTurn = false;
+                    if (realtimeSocket) {
+                        realtimeSocket.send(JSON.stringify({ type: 'stop' }));
+                    }
+                    return;
+                }
                 const audioBlob = new Blob(audioChunks, { type: 'audio/mp3' });
                 await sendAudioToServer(audioBlob);
                 audioChunks = [];
@@ -36,25 +58,45 @@ document.addEventListener('DOMContentLoaded', () => {
             const formData = new FormData();
             formData.append('file', audioBlob, 'recording.mp3');
 
-            const response = await fetch('/voice-assistant/audio-message', {
+            // Ask for a streamed reply when the browser can play MP3 progressively
+            const canStream = canStreamAudio();
+            const params = new URLSearchParams(getReplyFormat(canStream));
+            if (canStream) {
+                params.set('stream', 'true');
+            }
+            const url = `/voice-assistant/audio-message?${params}`;
+
+            const response = await fetch(url, {
                 method: 'POST',
-                body: formData
+                body: formData,
+                // Lets the server recognize a retry of this recording and replay its reply
+                headers: { 'Idempotency-Key': crypto.randomUUID() }
             });
 
+            if (response.status === 429) {
+                // The server is at capacity; nothing was processed
+                showBusy(response.headers.get('Retry-After'));
+                return;
+            }
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
 
-            // Handle the audio response
-            const audioResponse = await response.blob();
-            const audioUrl = URL.createObjectURL(audioResponse);
-
             // Add messages to conversation log
             addMessageToLog('You', 'Audio message sent', 'user-message');
 
-            // Play the response
-            const audio = new Audio(audioUrl);
-            audio.play();
+            if (canStream) {
+                // Start playback as soon as the first sentence arrives
+                await playStreamedAudio(response);
+            } else {
+                // Handle the audio response
+                const audioResponse = await response.blob();
+                const audioUrl = URL.createObjectURL(audioResponse);
+
+                // Play the response
+                const audio = new Audio(audioUrl);
+                audio.play();
+            }
 
             recordingStatus.textContent = 'Response received and playing';
         } catch (error) {
@@ -63,6 +105,149 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    function canStreamAudio() {
+        return window.MediaSource && MediaSource.isTypeSupported('audio/mpeg');
+    }
+
+    // Streamed replies stay MP3, which MediaSource can play as it arrives; whole replies are
+    // Opus where the browser plays it. Replies are smaller when the user saves data or is on 2G.
+    function getReplyFormat(streamed) {
+        const connection = navigator.connection;
+        const constrained = connection && (connection.saveData || /2g$/.test(connection.effectiveType));
+        if (!streamed && new Audio().canPlayType('audio/ogg; codecs=opus')) {
+            return constrained ? { format: 'opus', bitrate: '16k' } : { format: 'opus' };
+        }
+        return constrained ? { sample_rate: '16000', bitrate: '32k' } : {};
+    }
+
+    // Plays MP3 chunks as they arrive. Calls are queued, so they can be made without awaiting.
+    async function createStreamingPlayer() {
+        const mediaSource = new MediaSource();
+        const audio = new Audio(URL.createObjectURL(mediaSource));
+
+        await new Promise((resolve) => mediaSource.addEventListener('sourceopen', resolve, { once: true }));
+        const sourceBuffer = mediaSource.addSourceBuffer('audio/mpeg');
+
+        const appendChunk = (chunk) => new Promise((resolve) => {
+            sourceBuffer.addEventListener('updateend', resolve, { once: true });
+            sourceBuffer.appendBuffer(chunk);
+        });
+
+        let started = false;
+        let pending = Promise.resolve();
+        return {
+            append(chunk) {
+                pending = pending.then(() => appendChunk(chunk)).then(() => {
+                    if (!started) {
+                        audio.play();
+                        started = true;
+                        recordingStatus.textContent = 'Playing response...';
+                    }
+                });
+                return pending;
+            },
+            end() {
+                pending = pending.then(() => mediaSource.endOfStream());
+                return pending;
+            }
+        };
+    }
+
+    // Same interface for browsers without MediaSource: plays the reply once it is complete
+    function createBufferedPlayer() {
+        const chunks = [];
+        return {
+            append(chunk) {
+                chunks.push(chunk);
+            },
+            end() {
+                const audioUrl = URL.createObjectURL(new Blob(chunks, { type: 'audio/mpeg' }));
+                new Audio(audioUrl).play();
+            }
+        };
+    }
+
+    async function playStreamedAudio(response) {
+        const player = await createStreamingPlayer();
+        const reader = response.body.getReader();
+
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            await player.append(value);
+        }
+        await player.end();
+    }
+
+    function connectRealtime() {
+        if (!window.WebSocket) return;
+
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        const params = new URLSearchParams(getReplyFormat(true));
+        const socket = new WebSocket(`${protocol}//${window.location.host}/voice-assistant/realtime?${params}`);
+        socket.binaryType = 'arraybuffer';
+
+        socket.onopen = () => {
+            realtimeSocket = socket;
+        };
+        socket.onmessage = handleRealtimeMessage;
+        socket.onclose = () => {
+            // Fall back to uploading whole recordings until the connection is back
+            realtimeSocket = null;
+            isRealtimeTurn = false;
+            setTimeout(connectRealtime, REALTIME_RECONNECT_DELAY_MS);
+        };
+    }
+
+    function handleRealtimeMessage(event) {
+        if (event.data instanceof ArrayBuffer) {
+            // A sentence of the spoken reply
+            const chunk = new Uint8Array(event.data);
+            replyPlayer = replyPlayer.then((player) => {
+                player.append(chunk);
+                return player;
+            });
+            return;
+        }
+
+        const message = JSON.parse(event.data);
+        switch (message.type) {
+            case 'speech_end':
+                // The server heard the user stop talking
+                if (isRecording) {
+                    stopRecording();
+                }
+                recordingStatus.textContent = 'Processing...';
+                break;
+            case 'no_speech':
+                recordingStatus.textContent = 'No speech detected';
+                break;
+            case 'transcript':
+                addMessageToLog('You', message.text, 'user-message');
+                replyPlayer = canStreamAudio()
+                    ? createStreamingPlayer()
+                    : Promise.resolve(createBufferedPlayer());
+                break;
+            case 'reply_end':
+                replyPlayer.then((player) => player.end());
+                recordingStatus.textContent = 'Response received and playing';
+                break;
+            case 'busy':
+                showBusy(message.retry_after);
+                break;
+            case 'error':
+                console.error('Error from real-time connection:', message.detail);
+                recordingStatus.textContent = 'Error processing audio';
+                break;
+        }
+    }
+
+    function showBusy(retryAfterSeconds) {
+        recordingStatus.textContent = retryAfterSeconds
+            ? `The assistant is busy, please try again in ${retryAfterSeconds}s`
+            : 'The assistant is busy, please try again shortly';
+    }
+
     function addMessageToLog(sender, message, className) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${className}`;
@@ -71,33 +256,55 @@ document.addEventListener('DOMContentLoaded', () => {
         conversationLog.scrollTop = conversationLog.scrollHeight;
     }
 
-    recordButton.addEventListener('click', () => {
-        if (!isRecording) {
-            // Start recording
+    function startRecording() {
+        if (realtimeSocket) {
+            // Stream the recording; the server decides when the user has finished
+            realtimeSocket.send(JSON.stringify({ type: 'start' }));
+            isRealtimeTurn = true;
+            mediaRecorder.start(RECORDER_TIMESLICE_MS);
+            recordingStatus.textContent = 'Listening...';
+        } else {
             mediaRecorder.start();
-            isRecording = true;
-            recordButton.classList.add('recording');
-            recordButton.classList.remove('bg-blue-500');
-            recordButton.classList.add('bg-red-500');
-            recordButtonText.textContent = 'Stop Recording';
             recordingStatus.textContent = 'Recording...';
+        }
+        isRecording = true;
+        recordButton.classList.add('recording');
+        recordButton.classList.remove('bg-blue-500');
+        recordButton.classList.add('bg-red-500');
+        recordButtonText.textContent = 'Stop Recording';
+    }
+
+    function stopRecording() {
+        mediaRecorder.stop();
+        isRecording = false;
+        recordButton.classList.remove('recording');
+        recordButton.classList.remove('bg-red-500');
+        recordButton.classList.add('bg-blue-500');
+        recordButtonText.textContent = 'Start Recording';
+        recordingStatus.textContent = 'Processing audio...';
+    }
+
+    recordButton.addEventListener('click', () => {
+        if (!isRecording) {
+            startRecording();
         } else {
-            // Stop recording
-            mediaRecorder.stop();
-            isRecording = false;
-            recordButton.classList.remove('recording');
-            recordButton.classList.remove('bg-red-500');
-            recordButton.classList.add('bg-blue-500');
-            recordButtonText.textContent = 'Start Recording';
-            recordingStatus.textContent = 'Processing audio...';
+            stopRecording();
         }
     });
 
-    clearButton.addEventListener('click', () => {
+    clearButton.addEventListener('click', async () => {
         conversationLog.innerHTML = '';
-        recordingStatus.textContent = 'Conversation history cleared';
+        try {
+            // Forget this browser's conversation on the server as well
+            await fetch('/voice-assistant/conversation', { method: 'DELETE' });
+            recordingStatus.textContent = 'Conversation history cleared';
+        } catch (error) {
+            console.error('Error clearing conversation:', error);
+            recordingStatus.textContent = 'Error clearing conversation history';
+        }
     });
 
     // Initialize recording setup
     setupRecording();
+    connectRealtime();
 });
\ No newline at end of file
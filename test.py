@@ -9,7 +9,7 @@ def test_imports():
         print(f"❌ Error importing assistant_controller: {str(e)}")
 
     try:
-        from assistant.assistant_service import handle_audio_from_user
+        from assistant.assistant_service import generate_audio_reply_for_user
         print("✅ assistant_service imported successfully")
     except Exception as e:
         print(f"❌ Error importing assistant_service: {str(e)}")
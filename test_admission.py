@@ -0,0 +1,203 @@
+import asyncio
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import assistant.assistant_controller
+from utils import admission
+from utils.admission import AdmissionController, AdmissionRejected, stage_limit
+
+
+@pytest.fixture(autouse=True)
+def fresh_stage_limits(monkeypatch):
+    # Semaphores belong to the event loop they were first waited on in
+    monkeypatch.setattr(admission, '_stage_semaphores', {})
+    monkeypatch.setattr(admission, '_stage_waiting', {})
+    monkeypatch.setattr(admission, '_stage_running', {})
+    monkeypatch.setitem(admission.STAGE_CONCURRENCY_LIMITS, 'gpt', 2)
+
+
+def test_requests_beyond_the_queue_are_rejected():
+    controller = AdmissionController(max_concurrent=2, max_queued=1, queue_timeout_seconds=5)
+
+    async def scenario():
+        running = [await controller.admit(), await controller.admit()]
+        waiting = asyncio.create_task(controller.admit())
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit()
+        assert (controller.running, controller.queued) == (2, 1)
+
+        running[0].release()
+        admitted = await waiting
+        return rejected.value, admitted
+
+    rejected, admitted = asyncio.run(scenario())
+    assert rejected.reason == 'queue full'
+    assert 1 <= rejected.retry_after_seconds <= admission.MAX_RETRY_AFTER_SECONDS
+    assert (controller.running, controller.queued) == (2, 0)
+
+
+def test_requests_waiting_too_long_are_rejected():
+    controller = AdmissionController(max_concurrent=1, max_queued=5, queue_timeout_seconds=0.05)
+
+    async def scenario():
+        await controller.admit()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.admit()
+        return rejected.value
+
+    assert asyncio.run(scenario()).reason == 'queue timeout'
+    assert controller.queued == 0
+
+
+def test_waiting_requests_are_admitted_in_order():
+    controller = AdmissionController(max_concurrent=1, max_queued=5, queue_timeout_seconds=5)
+    order = []
+
+    async def scenario():
+        first = await controller.admit()
+
+        async def wait_for_turn(name):
+            turn = await controller.admit()
+            order.append(name)
+            turn.release()
+
+        waiting = [asyncio.create_task(wait_for_turn(name)) for name in ('second', 'third')]
+        await asyncio.sleep(0)
+        first.release()
+        await asyncio.gather(*waiting)
+
+    asyncio.run(scenario())
+    assert order == ['second', 'third']
+    assert controller.running == 0
+
+
+def test_releasing_twice_frees_one_turn():
+    controller = AdmissionController(max_concurrent=2, max_queued=0)
+
+    async def scenario():
+        turn = await controller.admit()
+        await controller.admit()
+        turn.release()
+        turn.release()
+        await controller.admit()
+        # Both turns are taken again, so the next request finds the queue full
+        with pytest.raises(AdmissionRejected):
+            await controller.admit()
+
+    asyncio.run(scenario())
+
+
+def test_retry_after_grows_with_the_queue():
+    controller = AdmissionController(max_concurrent=4)
+    controller.average_service_seconds = 8
+    assert controller.retry_after_seconds() == 2
+    controller.queued = 7
+    assert controller.retry_after_seconds() == 16
+    controller.queued = 1000
+    assert controller.retry_after_seconds() == admission.MAX_RETRY_AFTER_SECONDS
+
+
+def test_background_work_waits_for_waiting_requests(monkeypatch):
+    monkeypatch.setattr(admission, 'BACKGROUND_ADMISSION_POLL_SECONDS', 0.01)
+    controller = AdmissionController(max_concurrent=2, max_queued=5, max_background=1)
+
+    async def scenario():
+        background = await controller.admit_background()
+        # At most max_background turns go to background work
+        second_background = asyncio.create_task(controller.admit_background())
+        await asyncio.sleep(0.05)
+        assert not second_background.done()
+
+        request = await controller.admit()
+        background.release()
+        await asyncio.sleep(0.05)
+        assert second_background.done()
+        request.release()
+        (await second_background).release()
+
+    asyncio.run(scenario())
+    assert (controller.running, controller.background) == (0, 0)
+
+
+def test_stage_limit_caps_concurrent_calls():
+    running = []
+    peak = []
+
+    async def call():
+        async with stage_limit('gpt'):
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+    async def scenario():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(scenario())
+    assert max(peak) == 2
+    assert admission._stage_running['gpt'] == 0
+
+
+def test_stage_limit_is_released_when_the_call_fails():
+    async def failing_call():
+        async with stage_limit('gpt'):
+            raise RuntimeError("upstream error")
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(RuntimeError):
+                await failing_call()
+        # Both slots are free again
+        async with stage_limit('gpt'):
+            async with stage_limit('gpt'):
+                pass
+
+    asyncio.run(asyncio.wait_for(scenario(), 1))
+    assert admission._stage_semaphores['gpt']._value == 2
+
+
+def test_full_server_answers_429_with_retry_after(monkeypatch):
+    controller = AdmissionController(max_concurrent=1, max_queued=0)
+    asyncio.run(controller.admit())
+    monkeypatch.setattr(assistant.assistant_controller, 'get_admission_controller', lambda: controller)
+    app = FastAPI()
+    app.include_router(assistant.assistant_controller.controller)
+
+    response = TestClient(app).post('/voice-assistant/text-message', json={'text': "Hello there"})
+
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_text_message_gives_back_its_turn_if_the_response_never_starts(monkeypatch):
+    controller = AdmissionController(max_concurrent=1, max_queued=0)
+    monkeypatch.setattr(assistant.assistant_controller, 'get_admission_controller', lambda: controller)
+    app = FastAPI()
+    app.include_router(assistant.assistant_controller.controller)
+
+    body = b'{"text": "Hello there"}'
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+        'scheme': 'http', 'path': '/voice-assistant/text-message', 'raw_path': b'/voice-assistant/text-message',
+        'query_string': b'', 'root_path': '', 'server': ('testserver', 80), 'client': ('testclient', 50000),
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    }
+
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        await asyncio.sleep(0)
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        # The client went away before the response could start
+        raise OSError("connection reset")
+
+    async def scenario():
+        # The connection error, wrapped in the response's task group error
+        with pytest.raises(Exception):
+            await app(scope, receive, send)
+
+    asyncio.run(scenario())
+    assert controller.running == 0
@@ -0,0 +1,63 @@
+import numpy as np
+from transcoding.audio_preprocessing import (
+    find_segment_bounds, find_speech_bounds, WHISPER_SAMPLE_RATE, VAD_PADDING_SECONDS, LONG_AUDIO_OVERLAP_SECONDS
+)
+
+
+def make_audio(*parts):
+    """Build 16 kHz mono PCM from (seconds, is_speech) parts: a 440 Hz tone for speech, faint noise otherwise"""
+    rng = np.random.default_rng(0)
+    chunks = []
+    for seconds, is_speech in parts:
+        length = int(WHISPER_SAMPLE_RATE * seconds)
+        if is_speech:
+            t = np.arange(length) / WHISPER_SAMPLE_RATE
+            chunks.append(10000 * np.sin(2 * np.pi * 440 * t))
+        else:
+            chunks.append(rng.normal(0, 20, length))
+    return np.concatenate(chunks).astype(np.int16)
+
+
+def test_speech_bounds_trim_silence_around_speech():
+    samples = make_audio((1, False), (2, True), (1, False))
+    start, end = find_speech_bounds(samples)
+
+    padding = WHISPER_SAMPLE_RATE * VAD_PADDING_SECONDS
+    assert abs(start - (WHISPER_SAMPLE_RATE - padding)) <= WHISPER_SAMPLE_RATE * 0.05
+    assert abs(end - (3 * WHISPER_SAMPLE_RATE + padding)) <= WHISPER_SAMPLE_RATE * 0.05
+
+
+def test_speech_bounds_keep_whole_clip_without_speech():
+    samples = make_audio((2, False))
+    assert find_speech_bounds(samples) == (0, len(samples))
+
+
+def test_short_audio_is_one_segment():
+    samples = make_audio((5, True))
+    assert find_segment_bounds(samples, max_segment_seconds=10) == [(0, len(samples))]
+
+
+def test_segments_cut_in_pauses():
+    samples = make_audio((7, True), (0.5, False), (7, True), (0.5, False), (3, True))
+    bounds = find_segment_bounds(samples, max_segment_seconds=10)
+
+    assert len(bounds) == 3
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(samples)
+    for (_, end), (next_start, _) in zip(bounds, bounds[1:]):
+        # Cuts in a pause don't overlap
+        assert end == next_start
+    assert 7 * WHISPER_SAMPLE_RATE <= bounds[0][1] <= 7.5 * WHISPER_SAMPLE_RATE
+    assert 14.5 * WHISPER_SAMPLE_RATE <= bounds[1][1] <= 15 * WHISPER_SAMPLE_RATE
+
+
+def test_segments_overlap_when_there_is_no_pause():
+    # The silence sets the noise floor, so the whole tone counts as speech
+    samples = make_audio((3, False), (25, True))
+    bounds = find_segment_bounds(samples, max_segment_seconds=10)
+
+    overlap = int(WHISPER_SAMPLE_RATE * LONG_AUDIO_OVERLAP_SECONDS) // 2 * 2
+    assert bounds[0][0] == 0 and bounds[-1][1] == len(samples)
+    for start, end in bounds:
+        assert end - start <= 10 * WHISPER_SAMPLE_RATE
+    for (_, end), (next_start, _) in zip(bounds, bounds[1:]):
+        assert end - next_start == overlap
@@ -0,0 +1,96 @@
+import asyncio
+import os
+from types import SimpleNamespace
+import pytest
+import chat_service
+from assistant import assistant_service, batch_jobs
+from assistant.batch_jobs import BatchJobQueue, BatchJobStore
+from audio_handling.reply_formats import DEFAULT_REPLY_FORMAT
+from chat_service import ChatInterface
+from sessions.conversation_store import InMemoryConversationBackend
+from utils import admission
+
+
+class FakeCompletions:
+    """Streams the same reply to every prompt, and records the prompts"""
+
+    def __init__(self):
+        self.prompts = []
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.prompts.append([dict(message) for message in messages])
+        return self._stream()
+
+    async def _stream(self):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="Here is your answer."))])
+
+
+@pytest.fixture(autouse=True)
+def fresh_stage_limits(monkeypatch):
+    # Semaphores belong to the event loop they were first waited on in
+    monkeypatch.setattr(admission, '_stage_semaphores', {})
+    monkeypatch.setattr(admission, '_stage_waiting', {})
+    monkeypatch.setattr(admission, '_stage_running', {})
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    monkeypatch.setattr(ChatInterface, '_instance', None)
+    chat = ChatInterface(openai_api_key='test')
+    chat.conversations = InMemoryConversationBackend()
+    chat.completions = FakeCompletions()
+    chat._own_client = SimpleNamespace(chat=SimpleNamespace(completions=chat.completions))
+
+    async def no_search(query):
+        return None
+    chat.search_google = no_search
+    monkeypatch.setattr(chat_service, '_chat_interface', chat)
+    return chat
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, 'BATCH_STORAGE_DIR', str(tmp_path))
+
+    async def transcribe(file):
+        return file.decode()
+
+    async def synthesize(text, reply_format):
+        return text.encode()
+
+    monkeypatch.setattr(assistant_service, '__transcribe_user_audio', transcribe)
+    monkeypatch.setattr(assistant_service, 'convert_text_to_audio_bytes', synthesize)
+    return BatchJobQueue(BatchJobStore(str(tmp_path / 'batch_jobs.db'), retry_backoff_seconds=0))
+
+
+def test_retried_clip_does_not_see_its_earlier_attempt(chat, queue, monkeypatch):
+    written = []
+
+    def write_reply(job, audio):
+        # The first attempt fails after the reply was generated
+        if not written:
+            written.append(None)
+            raise OSError("disk full")
+        written.append(audio)
+
+    monkeypatch.setattr(batch_jobs.BatchJob, 'write_reply', write_reply)
+
+    async def scenario():
+        os.makedirs(os.path.join(batch_jobs.BATCH_STORAGE_DIR, 'batch'))
+        await queue.store.create_batch('batch', ['job'], ['clip.wav'], DEFAULT_REPLY_FORMAT, None)
+        for _ in range(2):
+            job = await queue.store.claim_job()
+            with open(job.clip_path, 'wb') as f:
+                f.write(b"What is the weather like?")
+            await queue._process(job)
+        return await queue.store.get_batch('batch')
+
+    batch = asyncio.run(scenario())
+
+    assert written == [None, b"Here is your answer."]
+    assert batch['jobs'][0]['status'] == 'done'
+    # Both attempts start from an empty conversation
+    for prompt in chat.completions.prompts:
+        assert [message['role'] for message in prompt] == ['system', 'user']
+    # Nothing was added to the store real sessions live in
+    assert chat.conversations._sessions == {}
@@ -0,0 +1,247 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from chat_service import ChatInterface, SearchRouter
+from sessions.conversation_store import InMemoryConversationBackend
+from utils import admission
+
+
+class FakeCompletions:
+    """Streams a reply token by token, as the OpenAI client does with stream=True"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.prompts = []
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.prompts.append([dict(message) for message in messages])
+        return self._stream()
+
+    async def _stream(self):
+        for token in self.tokens:
+            await asyncio.sleep(0)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+
+@pytest.fixture(autouse=True)
+def fresh_stage_limits(monkeypatch):
+    # Semaphores belong to the event loop they were first waited on in
+    monkeypatch.setattr(admission, '_stage_semaphores', {})
+    monkeypatch.setattr(admission, '_stage_waiting', {})
+    monkeypatch.setattr(admission, '_stage_running', {})
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    monkeypatch.setattr(ChatInterface, '_instance', None)
+    chat = ChatInterface(openai_api_key='test')
+    chat.conversations = InMemoryConversationBackend()
+
+    async def no_search(query):
+        return None
+    chat.search_google = no_search
+    return chat
+
+
+def use_reply(chat, tokens):
+    completions = FakeCompletions(tokens)
+    chat._own_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return completions
+
+
+async def collect(chat, user_input, session_id='session'):
+    return [unit async for unit in chat.stream_response(user_input, session_id)]
+
+
+def test_stream_yields_each_unit_once_complete(chat):
+    use_reply(chat, ["The match ", "ended two", "-one. Both ", "goals came late", " in the second half."])
+
+    units = asyncio.run(collect(chat, "Who won the match?"))
+
+    assert units == ["The match ended two-one.", "Both goals came late in the second half."]
+
+
+def test_stream_flushes_the_unfinished_tail(chat):
+    use_reply(chat, ["Here is the answer you wanted. ", "And a tail without a full stop"])
+
+    units = asyncio.run(collect(chat, "Tell me"))
+
+    assert units == ["Here is the answer you wanted.", "And a tail without a full stop"]
+
+
+def test_streamed_reply_is_added_to_the_history(chat):
+    use_reply(chat, ["First reply sentence. ", "Second reply sentence."])
+    asyncio.run(collect(chat, "Question one"))
+
+    completions = use_reply(chat, ["Another reply."])
+    asyncio.run(collect(chat, "Question two"))
+
+    prompt = completions.prompts[0]
+    assert [message['role'] for message in prompt] == ['system', 'user', 'assistant', 'user']
+    assert prompt[2]['content'] == "First reply sentence. Second reply sentence."
+
+
+class SlowCompletions(FakeCompletions):
+    """A reply whose stream takes a while, recording when each prompt was sent"""
+
+    def __init__(self, tokens, events):
+        super().__init__(tokens)
+        self.events = events
+
+    async def create(self, messages, stream=False, **kwargs):
+        self.events.append(('prompt', messages[-1]['content']))
+        return await super().create(messages, stream=stream, **kwargs)
+
+    async def _stream(self):
+        await asyncio.sleep(0.05)
+        async for chunk in super()._stream():
+            yield chunk
+
+
+def test_turns_of_a_session_wait_for_each_other(chat):
+    events = []
+    completions = SlowCompletions(["A reply that takes a while."], events)
+    chat._own_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    async def scenario():
+        await asyncio.gather(collect(chat, "First question"), collect(chat, "Second question"))
+
+    asyncio.run(scenario())
+
+    # The second turn was only sent once the first reply was in the history
+    second_prompt = completions.prompts[1]
+    assert [message['content'] for message in second_prompt[1:]] == [
+        "First question", "A reply that takes a while.", "Second question"
+    ]
+
+
+def test_turns_of_different_sessions_run_concurrently(chat):
+    events = []
+    completions = SlowCompletions(["A reply that takes a while."], events)
+    chat._own_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    async def scenario():
+        async def turn(session_id, user_input):
+            await collect(chat, user_input, session_id)
+            events.append(('done', user_input))
+
+        await asyncio.gather(turn('a', "Question a"), turn('b', "Question b"))
+
+    asyncio.run(scenario())
+
+    assert events[:2] == [('prompt', "Question a"), ('prompt', "Question b")]
+    assert len(completions.prompts[1]) == 2
+    # Nothing is left behind once the turns are over
+    assert len(chat._session_locks) == 0
+
+
+@pytest.mark.parametrize('user_input, search, reason', [
+    ("Thanks, that is great!", False, 'small_talk'),
+    ("ok cool", False, 'small_talk'),
+    ("", False, 'small_talk'),
+    ("What are the latest election results?", True, 'fresh_information'),
+    ("Will it rain today?", True, 'fresh_information'),
+    ("Who wrote Pride and Prejudice?", True, 'default'),
+])
+def test_router_decides_from_the_utterance(user_input, search, reason):
+    router = SearchRouter()
+    assert router.needs_search(user_input, []) is search
+    assert router.stats == {'search' if search else 'skip': 1, f"reason:{reason}": 1}
+
+
+def test_router_answers_follow_ups_from_the_history():
+    router = SearchRouter()
+    history = [{'role': 'user', 'content': "Who wrote Dune?"}, {'role': 'assistant', 'content': "Frank Herbert."}]
+
+    assert not router.needs_search("Can you tell me more about him?", history)
+    assert router.stats['reason:follow_up'] == 1
+    # Without a previous answer there is nothing to follow up on
+    assert router.needs_search("Can you tell me more about him?", [])
+
+
+def test_router_freshness_wins_over_follow_up():
+    history = [{'role': 'assistant', 'content': "Earlier answer."}]
+    assert SearchRouter().needs_search("Tell me more about the latest news", history)
+
+
+def test_router_always_mode_searches_every_turn():
+    router = SearchRouter(mode='always')
+    assert router.needs_search("thanks", [])
+    assert router.stats['reason:always'] == 1
+
+
+def test_small_talk_turn_skips_the_search(chat):
+    searches = []
+
+    async def search_google(query):
+        searches.append(query)
+        return "Source: Example"
+    chat.search_google = search_google
+    chat.search_router = SearchRouter()
+    completions = use_reply(chat, ["You're welcome."])
+
+    asyncio.run(collect(chat, "thanks"))
+    asyncio.run(collect(chat, "What's the weather forecast?"))
+
+    assert searches == ["What's the weather forecast?"]
+    assert completions.prompts[-1][-1]['content'].endswith("Source: Example")
+
+
+class FailingCompletions(FakeCompletions):
+    """Breaks off the stream after its tokens"""
+
+    async def _stream(self):
+        async for chunk in super()._stream():
+            yield chunk
+        raise RuntimeError("connection reset")
+
+
+def gpt_calls_running():
+    return admission._stage_running.get('gpt', 0)
+
+
+def test_gpt_slot_is_released_when_the_stream_ends(chat):
+    use_reply(chat, ["First sentence of the reply. ", "Second sentence of the reply."])
+
+    async def scenario():
+        units = chat.stream_response("Question", 'session')
+        first = await anext(units)
+        # The consumer is still busy with the first unit, but the stream is over
+        await asyncio.sleep(0.01)
+        running_while_consuming = gpt_calls_running()
+        rest = [unit async for unit in units]
+        return first, rest, running_while_consuming
+
+    first, rest, running_while_consuming = asyncio.run(scenario())
+    assert [first] + rest == ["First sentence of the reply.", "Second sentence of the reply."]
+    assert running_while_consuming == 0
+
+
+def test_gpt_slot_is_released_when_the_stream_fails(chat):
+    completions = FailingCompletions(["A sentence that made it. ", "And a half"])
+    chat._own_client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+
+    async def scenario():
+        units = []
+        with pytest.raises(Exception, match="connection reset"):
+            async for unit in chat.stream_response("Question", 'session'):
+                units.append(unit)
+        return units
+
+    assert asyncio.run(scenario()) == ["A sentence that made it."]
+    assert gpt_calls_running() == 0
+    # The failed turn isn't saved
+    assert asyncio.run(chat.conversations.load('session')) is None
+
+
+def test_gpt_slot_is_released_when_the_consumer_goes_away(chat):
+    use_reply(chat, ["First sentence of the reply. "] + ["more "] * 1000)
+
+    async def scenario():
+        units = chat.stream_response("Question", 'session')
+        await anext(units)
+        await units.aclose()
+        await asyncio.sleep(0)
+        return gpt_calls_running()
+
+    assert asyncio.run(scenario()) == 0
@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+import context_window
+from context_window import ContextWindowManager, SEARCH_RESULTS_PREFIX, SUMMARY_PREFIX
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    # One token per word keeps the budgets below easy to follow
+    monkeypatch.setattr(context_window, 'count_text_tokens', lambda text: len(text.split()))
+
+
+def message(role, words):
+    return {'role': role, 'content': ' '.join([role] * words)}
+
+
+def search_results(words):
+    return {'role': 'system', 'content': f"{SEARCH_RESULTS_PREFIX} " + ' '.join(['result'] * words)}
+
+
+def conversation(*turns):
+    messages = [message('system', 10)]
+    for turn in turns:
+        messages.extend(turn)
+    return messages
+
+
+def test_prompt_under_budget_is_unchanged():
+    messages = conversation([message('user', 10), message('assistant', 10)], [message('user', 10)])
+    fitted, stats = asyncio.run(ContextWindowManager(prompt_token_budget=1000).fit(messages))
+
+    assert fitted == messages
+    assert stats == {
+        'prompt_tokens_before': stats['prompt_tokens'],
+        'prompt_tokens': stats['prompt_tokens'],
+        'dropped_search_results': 0,
+        'summarized_messages': 0,
+    }
+
+
+def test_stale_search_results_are_dropped_first_oldest_first():
+    older_results, old_results, current_results = search_results(100), search_results(101), search_results(102)
+    messages = conversation(
+        [message('user', 10), older_results, message('assistant', 10)],
+        [message('user', 10), old_results, message('assistant', 10)],
+        [message('user', 10), current_results],
+    )
+    manager = ContextWindowManager(prompt_token_budget=320)
+    fitted, stats = asyncio.run(manager.fit(messages))
+
+    assert stats['dropped_search_results'] == 1
+    assert stats['summarized_messages'] == 0
+    assert older_results not in fitted
+    assert old_results in fitted and current_results in fitted
+    assert stats['prompt_tokens'] <= 320
+
+
+def test_old_turns_are_folded_into_a_summary():
+    transcripts = []
+
+    async def summarize(transcript):
+        transcripts.append(transcript)
+        return "the user asked about the weather"
+
+    messages = conversation(
+        [message('user', 50), search_results(5), message('assistant', 50)],
+        [message('user', 50), message('assistant', 50)],
+        [message('user', 10)],
+    )
+    manager = ContextWindowManager(summarize=summarize, prompt_token_budget=150, keep_recent_messages=2)
+    fitted, stats = asyncio.run(manager.fit(messages))
+
+    assert fitted[0] == messages[0]
+    assert fitted[1] == {'role': 'system', 'content': f"{SUMMARY_PREFIX}\nthe user asked about the weather"}
+    # The assistant's reply goes along with the question it answered
+    assert fitted[2:] == messages[-3:]
+    # The stale search results went first, but weren't enough
+    assert stats['dropped_search_results'] == 1
+    assert stats['summarized_messages'] == 2
+    assert transcripts[0].startswith('user: user')
+    assert '\nassistant: assistant' in transcripts[0]
+
+
+def test_previous_summary_is_folded_into_the_next():
+    transcripts = []
+
+    async def summarize(transcript):
+        transcripts.append(transcript)
+        return "newer summary"
+
+    previous_summary = {'role': 'system', 'content': f"{SUMMARY_PREFIX}\nolder summary"}
+    messages = conversation(
+        [previous_summary],
+        [message('user', 50), message('assistant', 50)],
+        [message('user', 10)],
+    )
+    manager = ContextWindowManager(summarize=summarize, prompt_token_budget=50, keep_recent_messages=1)
+    fitted, _ = asyncio.run(manager.fit(messages))
+
+    assert 'older summary' in transcripts[0]
+    assert [m['content'] for m in fitted[1:]] == [f"{SUMMARY_PREFIX}\nnewer summary", messages[-1]['content']]
+
+
+@pytest.mark.parametrize('summarize', [None, 'failing'])
+def test_old_turns_are_dropped_without_a_summary(summarize):
+    async def failing_summarize(transcript):
+        raise RuntimeError("summary model unavailable")
+
+    messages = conversation([message('user', 50), message('assistant', 50)], [message('user', 10)])
+    manager = ContextWindowManager(
+        summarize=failing_summarize if summarize == 'failing' else None,
+        prompt_token_budget=50, keep_recent_messages=1
+    )
+    fitted, stats = asyncio.run(manager.fit(messages))
+
+    assert fitted == [messages[0], messages[-1]]
+    assert stats['summarized_messages'] == 2
+
+
+def test_current_turn_and_recent_messages_are_never_removed():
+    messages = conversation([message('user', 50), message('assistant', 50)], [message('user', 500)])
+    manager = ContextWindowManager(prompt_token_budget=100, keep_recent_messages=3)
+    fitted, stats = asyncio.run(manager.fit(messages))
+
+    # Still over budget, but there is nothing left that may go
+    assert fitted == messages
+    assert stats['prompt_tokens'] > 100
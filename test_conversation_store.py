@@ -0,0 +1,109 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from sessions import conversation_store
+from sessions.conversation_store import InMemoryConversationBackend, SQLiteConversationBackend
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    fake_time = SimpleNamespace(monotonic=lambda: clock.now, time=lambda: clock.now)
+    monkeypatch.setattr(conversation_store, 'time', fake_time)
+    return clock
+
+
+def turn(content):
+    return [{'role': 'user', 'content': content}]
+
+
+def test_loading_a_session_keeps_it_from_expiring(clock):
+    backend = InMemoryConversationBackend(idle_ttl_seconds=60)
+
+    async def scenario():
+        await backend.save('active', turn('a'))
+        clock.now += 10
+        await backend.save('idle', turn('b'))
+        clock.now += 40
+        # Loaded just before it would expire, so it's fresh again
+        assert await backend.load('active') == turn('a')
+        clock.now += 30
+        return await backend.load('active'), await backend.load('idle')
+
+    assert asyncio.run(scenario()) == (turn('a'), None)
+
+
+def test_memory_backend_evicts_the_least_recently_used(clock):
+    backend = InMemoryConversationBackend(max_sessions=2)
+
+    async def scenario():
+        await backend.save('a', turn('a'))
+        await backend.save('b', turn('b'))
+        await backend.load('a')
+        await backend.save('c', turn('c'))
+        return [await backend.load(session_id) for session_id in ('a', 'b', 'c')]
+
+    assert asyncio.run(scenario()) == [turn('a'), None, turn('c')]
+
+
+def test_memory_backend_expires_idle_sessions(clock):
+    backend = InMemoryConversationBackend(idle_ttl_seconds=60)
+
+    async def scenario():
+        await backend.save('a', turn('a'))
+        clock.now += 61
+        return await backend.load('a')
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_memory_backend_stores_copies(clock):
+    backend = InMemoryConversationBackend()
+    messages = turn('a')
+
+    async def scenario():
+        await backend.save('a', messages)
+        messages.append({'role': 'assistant', 'content': 'not saved'})
+        loaded = await backend.load('a')
+        loaded.append({'role': 'assistant', 'content': 'not saved either'})
+        return await backend.load('a')
+
+    assert asyncio.run(scenario()) == turn('a')
+
+
+def test_delete_removes_a_session(clock):
+    backend = InMemoryConversationBackend()
+
+    async def scenario():
+        await backend.save('a', turn('a'))
+        await backend.delete('a')
+        await backend.delete('missing')
+        return await backend.load('a')
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_sqlite_backend_is_shared_through_the_database(clock, tmp_path):
+    db_path = str(tmp_path / 'conversations.db')
+    writer = SQLiteConversationBackend(db_path, idle_ttl_seconds=60)
+    reader = SQLiteConversationBackend(db_path, idle_ttl_seconds=60)
+
+    async def scenario():
+        await writer.save('a', turn('first'))
+        await writer.save('a', turn('second'))
+        await writer.save('b', turn('b'))
+        await writer.delete('b')
+        return await reader.load('a'), await reader.load('b')
+
+    assert asyncio.run(scenario()) == (turn('second'), None)
+
+
+def test_sqlite_backend_expires_idle_sessions(clock, tmp_path):
+    backend = SQLiteConversationBackend(str(tmp_path / 'conversations.db'), idle_ttl_seconds=60)
+
+    async def scenario():
+        await backend.save('a', turn('a'))
+        clock.now += 61
+        return await backend.load('a')
+
+    assert asyncio.run(scenario()) is None
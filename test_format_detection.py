@@ -0,0 +1,32 @@
+import pytest
+from transcoding.format_detection import detect_audio_format, can_bypass_transcoding, WHISPER_MAX_UPLOAD_BYTES
+
+
+@pytest.mark.parametrize('header, expected', [
+    (b'\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\x82\x84webm', 'webm'),
+    (b'\x1a\x45\xdf\xa3\xa3\x42\x86\x81\x01\x42\x82\x88matroska', 'mkv'),
+    (b'OggS\x00\x02', 'ogg'),
+    (b'RIFF\x24\x08\x00\x00WAVEfmt ', 'wav'),
+    (b'fLaC\x00\x00\x00\x22', 'flac'),
+    (b'\x00\x00\x00\x20ftypM4A ', 'm4a'),
+    (b'ID3\x04\x00\x00', 'mp3'),
+    # MPEG-1 layer III frame header
+    (b'\xff\xfb\x90\x64', 'mp3'),
+    # AAC ADTS, which shares the sync bits with MP3
+    (b'\xff\xf1\x50\x80', 'aac'),
+    (b'RIFF\x24\x08\x00\x00AVI LIST', None),
+    (b'not audio at all', None),
+    (b'', None),
+])
+def test_detect_audio_format(header, expected):
+    assert detect_audio_format(header + b'\x00' * 64) == expected
+
+
+def test_bypass_only_formats_whisper_accepts():
+    assert can_bypass_transcoding(b'OggS' + b'\x00' * 64) == 'ogg'
+    assert can_bypass_transcoding(b'\x1a\x45\xdf\xa3matroska' + b'\x00' * 64) is None
+    assert can_bypass_transcoding(b'\xff\xf1\x50\x80' + b'\x00' * 64) is None
+
+
+def test_bypass_only_uploads_whisper_accepts_in_size():
+    assert can_bypass_transcoding(b'OggS' + b'\x00' * WHISPER_MAX_UPLOAD_BYTES) is None
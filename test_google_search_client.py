@@ -0,0 +1,128 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from search import google_search_client
+from search.google_search_client import GoogleSearchClient, normalize_query
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(google_search_client, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def make_client(**kwargs):
+    """A client whose upstream returns the query and a version, bumped on every request"""
+    client = GoogleSearchClient('key', 'cse', ttl_seconds=60, stale_seconds=120, **kwargs)
+    client.queries = []
+    client.fail = False
+
+    async def fetch(query):
+        client.stats['upstream_requests'] += 1
+        client.queries.append(query)
+        await asyncio.sleep(0.01)
+        if client.fail:
+            raise RuntimeError("quota exceeded")
+        return {'query': query, 'version': len(client.queries)}
+
+    client._fetch = fetch
+    return client
+
+
+def test_queries_are_normalized():
+    assert normalize_query("  Election   RESULTS today ") == "election results today"
+
+
+def test_fresh_results_are_served_from_the_cache(clock):
+    client = make_client()
+
+    async def scenario():
+        first = await client.search("election results")
+        clock.now += 59
+        return first, await client.search("Election  results")
+
+    first, second = asyncio.run(scenario())
+    assert first is second
+    assert client.queries == ["election results"]
+    assert client.stats['misses'] == 1 and client.stats['fresh_hits'] == 1
+
+
+def test_concurrent_identical_queries_share_one_request(clock):
+    client = make_client()
+
+    async def scenario():
+        return await asyncio.gather(*(client.search("election results") for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert all(result is results[0] for result in results)
+    assert len(client.queries) == 1
+    assert client.stats['coalesced'] == 4
+
+
+def test_stale_results_are_served_while_one_refresh_runs(clock):
+    client = make_client()
+
+    async def scenario():
+        await client.search("election results")
+        clock.now += 61
+        stale = await asyncio.gather(client.search("election results"), client.search("election results"))
+        await asyncio.sleep(0.05)
+        return stale, await client.search("election results")
+
+    stale, refreshed = asyncio.run(scenario())
+    assert [result['version'] for result in stale] == [1, 1]
+    assert refreshed['version'] == 2
+    assert len(client.queries) == 2
+    assert client.stats['stale_hits'] == 2
+
+
+def test_expired_results_are_fetched_again(clock):
+    client = make_client()
+
+    async def scenario():
+        await client.search("election results")
+        clock.now += 181
+        return await client.search("election results")
+
+    assert asyncio.run(scenario())['version'] == 2
+    assert client.stats['misses'] == 2
+
+
+def test_failures_are_not_cached(clock):
+    client = make_client()
+
+    async def scenario():
+        client.fail = True
+        with pytest.raises(RuntimeError):
+            await client.search("election results")
+        client.fail = False
+        return await client.search("election results")
+
+    assert asyncio.run(scenario())['version'] == 2
+    assert client._in_flight == {}
+
+
+def test_a_caller_going_away_does_not_cancel_the_shared_request(clock):
+    client = make_client()
+
+    async def scenario():
+        impatient = asyncio.create_task(client.search("election results"))
+        patient = asyncio.create_task(client.search("election results"))
+        await asyncio.sleep(0)
+        impatient.cancel()
+        return await patient
+
+    assert asyncio.run(scenario())['version'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(clock):
+    client = make_client(max_entries=2)
+
+    async def scenario():
+        for query in ("a", "b", "c"):
+            await client.search(query)
+        await client.search("a")
+
+    asyncio.run(scenario())
+    assert client.queries == ["a", "b", "c", "a"]
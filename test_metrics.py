@@ -0,0 +1,35 @@
+from utils.metrics import RequestTrace
+
+
+def make_trace(**stages):
+    trace = RequestTrace('test')
+    for stage, spans in stages.items():
+        for started_at, ended_at in spans:
+            trace.record_span(stage, started_at, ended_at)
+    return trace
+
+
+def test_sequential_spans_are_added():
+    trace = make_trace(history=[(0.0, 1.0), (5.0, 5.5)])
+    assert trace.stage_durations() == {'history': 1.5}
+
+
+def test_overlapping_spans_are_counted_once():
+    # Three sentences synthesized at once
+    trace = make_trace(tts=[(1.0, 3.0), (0.0, 2.0), (2.5, 4.0)])
+    assert trace.stage_durations() == {'tts': 4.0}
+
+
+def test_nested_spans_add_nothing():
+    trace = make_trace(llm=[(0.0, 10.0), (2.0, 3.0), (4.0, 9.0)])
+    assert trace.stage_durations() == {'llm': 10.0}
+
+
+def test_stages_are_reported_separately():
+    trace = make_trace(transcription=[(0.0, 2.0)], llm=[(1.0, 4.0)])
+    assert trace.stage_durations() == {'transcription': 2.0, 'llm': 3.0}
+
+
+def test_server_timing_lists_stages_in_milliseconds():
+    trace = make_trace(transcription=[(0.0, 0.25)], llm=[(0.25, 1.0)])
+    assert trace.server_timing() == 'transcription;dur=250.0, llm;dur=750.0'
@@ -0,0 +1,42 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from assistant.assistant_controller import controller
+
+
+@pytest.fixture
+def websocket():
+    app = FastAPI()
+    app.include_router(controller)
+    with TestClient(app).websocket_connect('/voice-assistant/realtime') as websocket:
+        assert websocket.receive_json()['type'] == 'ready'
+        yield websocket
+
+
+@pytest.mark.parametrize('text', ['not json', '[]', '1', '"start"', 'null'])
+def test_malformed_control_message_is_answered_with_an_error(websocket, text):
+    websocket.send_text(text)
+    assert websocket.receive_json()['type'] == 'error'
+
+    # The session is still usable
+    websocket.send_json({'type': 'start'})
+    websocket.send_json({'type': 'stop'})
+    assert websocket.receive_json() == {'type': 'speech_end'}
+    assert websocket.receive_json() == {'type': 'no_speech'}
+
+
+def test_malformed_control_message_during_a_turn(websocket):
+    websocket.send_json({'type': 'start'})
+    websocket.send_text('{"type": "stop"')
+    assert websocket.receive_json()['type'] == 'error'
+
+    websocket.send_json({'type': 'stop'})
+    assert websocket.receive_json() == {'type': 'speech_end'}
+    assert websocket.receive_json() == {'type': 'no_speech'}
+
+
+def test_unknown_control_message_is_ignored(websocket):
+    websocket.send_json({'type': 'hello'})
+    websocket.send_json({'type': 'start'})
+    websocket.send_json({'type': 'stop'})
+    assert websocket.receive_json() == {'type': 'speech_end'}
@@ -0,0 +1,209 @@
+import asyncio
+import json
+from types import SimpleNamespace
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import assistant.assistant_controller
+from assistant import reply_cache
+from assistant.reply_cache import ReplyCache, get_reply_cache, get_text_audio_cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(reply_cache, 'time', SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+class Pipeline:
+    """Produces one chunk each time it is released, and records how it ended"""
+
+    def __init__(self, chunks=(b'one ', b'two ', b'three')):
+        self.chunks = chunks
+        self.runs = 0
+        self.ended = None
+        self.released = asyncio.Semaphore(0)
+
+    def release(self, count=1):
+        for _ in range(count):
+            self.released.release()
+
+    async def generate(self):
+        self.runs += 1
+        try:
+            for chunk in self.chunks:
+                await self.released.acquire()
+                yield chunk
+            self.ended = 'completed'
+        except asyncio.CancelledError:
+            self.ended = 'cancelled'
+            raise
+
+
+async def failing_pipeline():
+    yield b'one '
+    raise RuntimeError("synthesis failed")
+
+
+def test_retries_attach_to_the_reply_in_flight(clock):
+    cache = ReplyCache()
+
+    async def scenario():
+        pipeline = Pipeline()
+        reply = cache.start('key', 'session', pipeline.generate())
+        first = asyncio.create_task(reply.read())
+        pipeline.release()
+        await asyncio.sleep(0.01)
+        # A retry arriving halfway through still gets the reply from the start
+        retry = cache.get('key')
+        second = asyncio.create_task(retry.read())
+        pipeline.release(2)
+        return retry is reply, await first, await second, pipeline.runs
+
+    is_shared, first, second, runs = asyncio.run(scenario())
+    assert is_shared
+    assert first == second == b'one two three'
+    assert runs == 1
+    assert cache.stats == {'misses': 1, 'in_flight_hits': 1}
+
+
+def test_completed_replies_are_kept_for_the_ttl(clock):
+    cache = ReplyCache(ttl_seconds=60)
+
+    async def scenario():
+        pipeline = Pipeline()
+        pipeline.release(3)
+        reply = cache.start('key', 'session', pipeline.generate())
+        await reply.read()
+        clock.now += 59
+        replayed = cache.get('key')
+        clock.now += 2
+        return reply, replayed, cache.get('key')
+
+    reply, replayed, expired = asyncio.run(scenario())
+    assert replayed is reply
+    assert expired is None
+    assert cache._completed_bytes == 0
+
+
+def test_oldest_completed_replies_are_dropped_beyond_the_size_cap(clock):
+    cache = ReplyCache(max_bytes=20)
+
+    async def scenario():
+        for key in ('a', 'b', 'c'):
+            pipeline = Pipeline(chunks=(b'x' * 8,))
+            pipeline.release()
+            await cache.start(key, 'session', pipeline.generate()).read()
+
+    asyncio.run(scenario())
+    assert list(cache._completed) == ['b', 'c']
+    assert cache._completed_bytes == 16
+
+
+def test_failed_replies_are_not_kept(clock):
+    cache = ReplyCache()
+    released = []
+
+    async def scenario():
+        reply = cache.start('key', 'session', failing_pipeline(), on_done=lambda: released.append(True))
+        with pytest.raises(RuntimeError):
+            await reply.read()
+        return cache.get('key')
+
+    assert asyncio.run(scenario()) is None
+    assert released == [True]
+    assert cache._in_flight == {}
+
+
+def test_reply_without_a_key_is_cancelled_when_its_client_goes_away(clock):
+    cache = ReplyCache()
+    released = []
+
+    async def scenario():
+        pipeline = Pipeline()
+        reply = cache.start(None, 'session', pipeline.generate(), on_done=lambda: released.append(True))
+        chunks = reply.iterate()
+        pipeline.release()
+        await anext(chunks)
+        # The client disconnects mid-stream
+        await chunks.aclose()
+        await asyncio.sleep(0.01)
+        return pipeline.ended, reply
+
+    ended, reply = asyncio.run(scenario())
+    assert ended == 'cancelled'
+    assert reply.done and reply.error is not None
+    assert released == [True]
+
+
+def test_keyed_reply_is_cancelled_when_its_last_client_goes_away(clock):
+    cache = ReplyCache()
+
+    async def scenario():
+        pipeline = Pipeline()
+        reply = cache.start('key', 'session', pipeline.generate())
+        first = asyncio.create_task(reply.read())
+        retry = asyncio.create_task(cache.get('key').read())
+        pipeline.release()
+        await asyncio.sleep(0.01)
+
+        # One client going away leaves the reply to the other
+        first.cancel()
+        await asyncio.sleep(0.01)
+        still_running = pipeline.ended is None
+
+        retry.cancel()
+        await asyncio.sleep(0.01)
+        return still_running, pipeline.ended, cache.get('key')
+
+    still_running, ended, replay = asyncio.run(scenario())
+    assert still_running
+    assert ended == 'cancelled'
+    # A later retry runs the pipeline again
+    assert replay is None
+
+
+def test_abandoned_replies_can_be_kept_running(clock):
+    cache = ReplyCache(cancel_abandoned=False)
+
+    async def scenario():
+        pipeline = Pipeline()
+        reply = cache.start('key', 'session', pipeline.generate())
+        chunks = reply.iterate()
+        pipeline.release()
+        await anext(chunks)
+        await chunks.aclose()
+        pipeline.release(2)
+        await reply.wait()
+        return pipeline.ended, await cache.get('key').read()
+
+    assert asyncio.run(scenario()) == ('completed', b'one two three')
+
+
+def test_text_message_audio_is_kept_apart_from_idempotent_replies(monkeypatch):
+    monkeypatch.setattr(reply_cache, '_reply_cache', None)
+    monkeypatch.setattr(reply_cache, '_text_audio_cache', None)
+
+    async def stream_response(text, session_id):
+        for unit in ("First sentence.", "Second sentence."):
+            yield unit
+
+    async def synthesize_text(unit, reply_format):
+        yield unit.encode()
+
+    monkeypatch.setattr(assistant.assistant_controller, 'get_chat_interface',
+                        lambda: SimpleNamespace(stream_response=stream_response))
+    monkeypatch.setattr(assistant.assistant_controller, 'synthesize_text', synthesize_text)
+    app = FastAPI()
+    app.include_router(assistant.assistant_controller.controller)
+    client = TestClient(app)
+
+    events = client.post('/voice-assistant/text-message?audio=true', json={'text': "Hello there"}).text
+    data = [json.loads(line[len('data: '):]) for line in events.splitlines() if line.startswith('data: ')]
+    audio_urls = [event['audio_url'] for event in data if 'audio_url' in event]
+    audio = [client.get(url).content for url in audio_urls]
+
+    assert audio == [b"First sentence.", b"Second sentence."]
+    assert len(get_text_audio_cache()._completed) == 2
+    assert get_reply_cache().stats == {} and get_reply_cache()._completed_bytes == 0
@@ -0,0 +1,67 @@
+import pytest
+from audio_handling.reply_formats import negotiate_reply_format, ReplyFormat, UnsupportedReplyFormat
+
+
+def test_default_is_mp3():
+    reply_format = negotiate_reply_format()
+    assert (reply_format.codec, reply_format.sample_rate, reply_format.bitrate) == ('mp3', 22050, None)
+    assert reply_format.key == 'mp3'
+
+
+@pytest.mark.parametrize('accept, codec', [
+    ('audio/ogg; codecs=opus', 'opus'),
+    ('audio/opus', 'opus'),
+    ('audio/ogg', 'ogg_vorbis'),
+    ('audio/mpeg', 'mp3'),
+    ('audio/*', 'mp3'),
+    ('*/*', 'mp3'),
+    # Preference is by quality, then order
+    ('audio/mpeg;q=0.5, audio/ogg; codecs=opus', 'opus'),
+    ('audio/ogg; codecs=opus;q=0, audio/mpeg', 'mp3'),
+    ('audio/flac, audio/ogg', 'ogg_vorbis'),
+    # Clients that don't ask for audio get the default
+    ('application/json', 'mp3'),
+    ('text/html,application/xhtml+xml', 'mp3'),
+])
+def test_codec_from_accept(accept, codec):
+    assert negotiate_reply_format(accept).codec == codec
+
+
+def test_pcm_rate_from_accept():
+    reply_format = negotiate_reply_format('audio/pcm; rate=8000')
+    assert (reply_format.codec, reply_format.sample_rate) == ('pcm', 8000)
+    assert reply_format.media_type == 'audio/pcm; rate=8000; channels=1; encoding=s16le'
+
+
+def test_query_overrides_accept():
+    reply_format = negotiate_reply_format('audio/mpeg', 'opus', 8000, '16K')
+    assert (reply_format.codec, reply_format.sample_rate, reply_format.bitrate) == ('opus', 8000, '16k')
+    assert reply_format.key == 'opus@8000/16k'
+
+
+def test_unproducible_audio_accept_is_406():
+    with pytest.raises(UnsupportedReplyFormat) as e:
+        negotiate_reply_format('audio/flac, audio/aac')
+    assert e.value.status_code == 406
+
+
+@pytest.mark.parametrize('codec, sample_rate, bitrate', [
+    ('wav', None, None),
+    ('opus', 22050, None),
+    ('mp3', 44100, None),
+    ('pcm', None, '32k'),
+    ('mp3', None, '4k'),
+    ('mp3', None, 'fast'),
+])
+def test_invalid_parameters_are_400(codec, sample_rate, bitrate):
+    with pytest.raises(UnsupportedReplyFormat) as e:
+        negotiate_reply_format(None, codec, sample_rate, bitrate)
+    assert e.value.status_code == 400
+
+
+def test_ogg_formats_are_synthesized_as_pcm():
+    reply_format = ReplyFormat('opus')
+    assert reply_format.is_stream_encoded
+    assert reply_format.polly_output_format == 'pcm'
+    assert reply_format.chunk_format.key == 'pcm'
+    assert not ReplyFormat('mp3').is_stream_encoded
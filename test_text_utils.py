@@ -0,0 +1,88 @@
+from utils.text_utils import pop_speakable_units, split_into_chunks, split_into_sentences, stitch_transcripts
+
+
+def test_stitch_drops_words_repeated_across_the_seam():
+    transcripts = [
+        "The results of the election were announced this",
+        "were announced this morning by the commission.",
+    ]
+    assert stitch_transcripts(transcripts) == (
+        "The results of the election were announced this morning by the commission."
+    )
+
+
+def test_stitch_ignores_case_and_punctuation_at_the_seam():
+    assert stitch_transcripts(["We met on Tuesday, at noon.", "at noon we had lunch"]) == (
+        "We met on Tuesday, at noon. we had lunch"
+    )
+
+
+def test_stitch_keeps_a_single_repeated_word():
+    assert stitch_transcripts(["I said no", "no one came"]) == "I said no no one came"
+
+
+def test_stitch_without_overlap_joins_transcripts():
+    assert stitch_transcripts(["First part.", "Second part."]) == "First part. Second part."
+
+
+def test_stitch_skips_empty_transcripts():
+    assert stitch_transcripts(["", "Only speech here", ""]) == "Only speech here"
+    assert stitch_transcripts([]) == ""
+
+
+def test_chunks_pack_whole_sentences():
+    text = "First sentence here. Second sentence here. Third sentence here."
+    assert split_into_chunks(text, 45) == ["First sentence here. Second sentence here.", "Third sentence here."]
+
+
+def test_short_text_is_one_chunk():
+    assert split_into_chunks("Just one short sentence.", 3000) == ["Just one short sentence."]
+    assert split_into_chunks("", 3000) == []
+
+
+def test_long_sentence_is_split_at_clauses_then_spaces():
+    sentence = "alpha beta gamma, delta epsilon zeta, eta theta iota kappa lambda mu nu xi omicron pi"
+    chunks = split_into_chunks(sentence, 30)
+
+    assert chunks[:2] == ["alpha beta gamma,", "delta epsilon zeta,"]
+    assert all(0 < len(chunk) <= 30 for chunk in chunks)
+    assert ' '.join(chunks) == sentence
+
+
+def test_word_longer_than_a_chunk_is_cut():
+    chunks = split_into_chunks("x" * 25, 10)
+    assert chunks == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_sentences_merge_short_fragments():
+    assert split_into_sentences("Yes. I can help with that today. Ok") == [
+        "Yes. I can help with that today.", "Ok"
+    ]
+
+
+def test_speakable_units_hold_back_the_unfinished_sentence():
+    units, remainder = pop_speakable_units("The first sentence is done. The second one is still")
+    assert units == ["The first sentence is done."]
+    assert remainder == "The second one is still"
+
+
+def test_speakable_units_wait_for_whitespace_after_the_full_stop():
+    # The next token may continue a number or an abbreviation
+    assert pop_speakable_units("It costs about 3.") == ([], "It costs about 3.")
+
+
+def test_short_unit_is_merged_into_the_next():
+    units, remainder = pop_speakable_units("Sure. ")
+    assert units == []
+    assert remainder == "Sure. "
+
+    units, remainder = pop_speakable_units(remainder + "Here is the answer you asked for. More")
+    assert units == ["Sure. Here is the answer you asked for."]
+    assert remainder == "More"
+
+
+def test_long_unfinished_sentence_is_flushed_at_a_clause():
+    buffer = "First clause of a long sentence, " + "and then it goes on " * 5
+    units, remainder = pop_speakable_units(buffer, max_length=60)
+    assert units == ["First clause of a long sentence,"]
+    assert buffer.endswith(remainder)
@@ -0,0 +1,75 @@
+import asyncio
+import io
+import wave
+import numpy as np
+import pytest
+from transcoding.transcoding_services import PyAVTranscoder, Transcoder
+
+# The in-process engine is optional
+av = pytest.importorskip('av')
+
+
+class RecordingTranscoder(Transcoder):
+    """Stands in for the subprocess engine and records what it was given"""
+
+    name = 'recording'
+
+    def __init__(self):
+        self.calls = []
+
+    async def to_mp3(self, data, sample_rate=None, channels=None, bitrate=None):
+        self.calls.append(('to_mp3', data))
+        return b'fallback mp3'
+
+    async def decode_pcm(self, data, sample_rate, channels=1):
+        self.calls.append(('decode_pcm', data))
+        return b'fallback pcm'
+
+
+def make_wav(seconds=0.5, sample_rate=16000):
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    samples = (10000 * np.sin(2 * np.pi * 440 * t)).astype(np.int16)
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.tobytes())
+    return output.getvalue()
+
+
+def make_video_only():
+    output = io.BytesIO()
+    with av.open(output, 'w', format='matroska') as container:
+        stream = container.add_stream('rawvideo', rate=1)
+        stream.width, stream.height, stream.pix_fmt = 16, 16, 'yuv420p'
+        frame = av.VideoFrame.from_ndarray(np.zeros((16, 16, 3), dtype=np.uint8), format='rgb24')
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return output.getvalue()
+
+
+def test_pyav_transcodes_in_process():
+    fallback = RecordingTranscoder()
+    transcoder = PyAVTranscoder(fallback)
+
+    pcm = asyncio.run(transcoder.decode_pcm(make_wav(), 8000))
+    mp3 = asyncio.run(transcoder.to_mp3(make_wav(), sample_rate=16000, channels=1, bitrate='32k'))
+
+    # Half a second of 8 kHz mono 16-bit audio
+    assert abs(len(pcm) - 8000) <= 64
+    assert mp3[:3] == b'ID3' or mp3[0] == 0xff
+    assert fallback.calls == []
+
+
+@pytest.mark.parametrize('data', [b'not audio at all' * 64, make_video_only()],
+                         ids=['undecodable', 'no_audio_stream'])
+def test_pyav_falls_back_on_audio_it_cannot_handle(data):
+    fallback = RecordingTranscoder()
+    transcoder = PyAVTranscoder(fallback)
+
+    assert asyncio.run(transcoder.to_mp3(data)) == b'fallback mp3'
+    assert asyncio.run(transcoder.decode_pcm(data, 16000)) == b'fallback pcm'
+    assert fallback.calls == [('to_mp3', data), ('decode_pcm', data)]
@@ -0,0 +1,91 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from audio_handling.tts_cache import TTSCache, get_tts_cache_key, TTS_CACHE_TMP_SUFFIX
+
+
+def key(text, voice_id='Raveena'):
+    return get_tts_cache_key(text, voice_id, 'standard', 'en-US', 'mp3')
+
+
+def disk_files(cache):
+    return sorted(os.listdir(cache.cache_dir))
+
+
+def test_key_ignores_whitespace_but_not_the_voice():
+    assert key("Hello  there.\n") == key("Hello there.")
+    assert key("Hello there.") != key("Hello there.", voice_id='Joanna')
+    assert key("Hello there.") != key("Hello there!")
+
+
+def test_memory_then_disk_then_miss(tmp_path):
+    cache = TTSCache(str(tmp_path))
+
+    async def scenario():
+        await cache.put(key("a"), b'audio a')
+        from_memory = await cache.get(key("a"))
+        # A fresh process only has the disk tier
+        restarted = TTSCache(str(tmp_path))
+        from_disk = await restarted.get(key("a"))
+        promoted = await restarted.get(key("a"))
+        missing = await restarted.get(key("b"))
+        return from_memory, from_disk, promoted, missing, restarted.stats
+
+    from_memory, from_disk, promoted, missing, stats = asyncio.run(scenario())
+    assert from_memory == from_disk == promoted == b'audio a'
+    assert missing is None
+    assert stats == {'disk_hits': 1, 'memory_hits': 1, 'misses': 1}
+
+
+def test_memory_tier_evicts_the_least_recently_used(tmp_path):
+    cache = TTSCache(str(tmp_path), max_memory_bytes=10)
+    cache._put_in_memory('a', b'aaaa')
+    cache._put_in_memory('b', b'bbbb')
+    asyncio.run(cache.get('a'))
+    cache._put_in_memory('c', b'cccc')
+
+    assert list(cache._memory) == ['a', 'c']
+    assert cache._memory_bytes == 8
+    # Too big for the memory tier at all
+    cache._put_in_memory('d', b'd' * 11)
+    assert 'd' not in cache._memory
+
+
+def test_disk_tier_evicts_the_least_recently_used(tmp_path):
+    cache = TTSCache(str(tmp_path), max_disk_bytes=10)
+    cache._write_to_disk('a', b'aaaa')
+    cache._write_to_disk('b', b'bbbb')
+    os.utime(os.path.join(cache.cache_dir, 'a'), (1, 1))
+    os.utime(os.path.join(cache.cache_dir, 'b'), (2, 2))
+    # Reading an entry makes it the most recently used
+    assert cache._read_from_disk('a') == b'aaaa'
+    cache._write_to_disk('c', b'cccc')
+
+    assert disk_files(cache) == ['a', 'c']
+    assert cache._disk_bytes == 8
+
+
+def test_concurrent_writes_of_the_same_phrase(tmp_path):
+    cache = TTSCache(str(tmp_path))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for _ in range(50):
+            list(executor.map(lambda i: cache._write_to_disk('a', b'x' * 100), range(8)))
+
+    assert disk_files(cache) == ['a']
+    assert cache._disk_bytes == 100
+
+
+def test_concurrent_writes_keep_the_size_exact(tmp_path):
+    cache = TTSCache(str(tmp_path), max_disk_bytes=1000)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache._write_to_disk(str(i % 40), b'x' * 100), range(200)))
+
+    assert not any(name.endswith(TTS_CACHE_TMP_SUFFIX) for name in disk_files(cache))
+    assert cache._disk_bytes == 100 * len(disk_files(cache)) <= 1000
+
+
+def test_unfinished_writes_are_not_counted(tmp_path):
+    (tmp_path / 'a').write_bytes(b'aaaa')
+    (tmp_path / f"b.123{TTS_CACHE_TMP_SUFFIX}").write_bytes(b'partial')
+
+    assert TTSCache(str(tmp_path))._disk_bytes == 4
@@ -0,0 +1,89 @@
+import io
+import wave
+import pytest
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.testclient import TestClient
+from assistant import upload_intake
+from assistant.upload_intake import UploadRejected, receive_audio_upload
+
+
+def make_wav(seconds=1.0, sample_rate=8000):
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b'\x00\x00' * int(sample_rate * seconds))
+    return output.getvalue()
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.post('/upload')
+    async def upload(request: Request):
+        try:
+            upload = await receive_audio_upload(request)
+        except UploadRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=e.reason)
+        try:
+            return {'format': upload.audio_format, 'size': upload.size, 'seconds': upload.estimated_seconds}
+        finally:
+            upload.close()
+
+    return TestClient(app)
+
+
+def post_form(client, data):
+    return client.post('/upload', files={'file': ('recording.wav', data, 'audio/wav')})
+
+
+def test_audio_is_received_and_measured(client, monkeypatch):
+    # Low enough that even a short clip is probed
+    monkeypatch.setattr(upload_intake, 'UPLOAD_MAX_SECONDS', 5)
+
+    response = post_form(client, make_wav(seconds=1))
+
+    assert response.status_code == 200
+    assert response.json()['format'] == 'wav'
+    assert response.json()['seconds'] == pytest.approx(1, abs=0.01)
+
+
+def test_oversized_upload_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(upload_intake, 'UPLOAD_MAX_BYTES', 1000)
+
+    as_form = post_form(client, make_wav(seconds=1))
+    as_body = client.post('/upload', content=make_wav(seconds=1), headers={'content-type': 'audio/wav'})
+
+    assert (as_form.status_code, as_form.json()['detail']) == (413, 'too_large')
+    assert (as_body.status_code, as_body.json()['detail']) == (413, 'too_large')
+
+
+def test_overlong_upload_is_rejected(client, monkeypatch):
+    monkeypatch.setattr(upload_intake, 'UPLOAD_MAX_SECONDS', 0.5)
+
+    response = post_form(client, make_wav(seconds=1))
+
+    assert (response.status_code, response.json()['detail']) == (413, 'too_long')
+
+
+@pytest.mark.parametrize('data', [b'%PDF-1.7 not audio' * 10, b''], ids=['not_audio', 'empty'])
+def test_upload_in_a_bad_format_is_rejected(client, data):
+    response = post_form(client, data)
+
+    assert (response.status_code, response.json()['detail']) == (415, 'not_audio')
+
+
+def test_failing_probe_skips_the_duration_check(client, monkeypatch):
+    async def failing_probe(head):
+        raise RuntimeError("ffmpeg failed to start")
+
+    monkeypatch.setattr(upload_intake, 'measure_seconds_per_byte', failing_probe)
+    monkeypatch.setattr(upload_intake, 'UPLOAD_MAX_SECONDS', 0.5)
+
+    response = post_form(client, make_wav(seconds=1))
+
+    # Checked for size only, like containers that can't be decoded from their start
+    assert response.status_code == 200
+    assert response.json()['seconds'] is None
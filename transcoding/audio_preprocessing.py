@@ -0,0 +1,174 @@
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from transcoding.transcoding_services import get_transcoder, TranscodingError
+
+# Whisper works on 16 kHz mono internally, so anything more is wasted upload
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_BITRATE = os.getenv('WHISPER_BITRATE', '32k')
+
+# Voice activity detection works on short frames of the decoded audio
+VAD_FRAME_SECONDS = 0.03
+# A frame is speech when it is this much louder than the noise floor ...
+VAD_MARGIN_DB = float(os.getenv('VAD_MARGIN_DB', '12'))
+# ... and louder than this in absolute terms
+VAD_MIN_SPEECH_DBFS = float(os.getenv('VAD_MIN_SPEECH_DBFS', '-45'))
+# Silence kept around the detected speech so word onsets and endings aren't clipped
+VAD_PADDING_SECONDS = float(os.getenv('VAD_PADDING_SECONDS', '0.25'))
+
+# Long recordings are split into segments no longer than this, transcribed in parallel
+LONG_AUDIO_SEGMENT_SECONDS = float(os.getenv('LONG_AUDIO_SEGMENT_SECONDS', '30'))
+# Segments cut where there is no pause overlap by this much, so no word is lost at the cut
+LONG_AUDIO_OVERLAP_SECONDS = float(os.getenv('LONG_AUDIO_OVERLAP_SECONDS', '1.5'))
+
+
+def get_frame_levels_dbfs(samples: np.ndarray, sample_rate: int = WHISPER_SAMPLE_RATE) -> np.ndarray:
+    """Get the loudness of each VAD frame of mono 16-bit PCM samples, in dBFS"""
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    frame_count = len(samples) // frame_length
+    frames = samples[:frame_count * frame_length].astype(np.float64).reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean(frames ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1.0) / 32768.0)
+
+
+def find_speech_frames(frame_dbfs: np.ndarray) -> np.ndarray:
+    """Get the indices of the frames that are loud enough to be speech"""
+    # The quietest tenth of the clip is taken as the noise floor
+    noise_floor_dbfs = np.percentile(frame_dbfs, 10)
+    threshold_dbfs = max(noise_floor_dbfs + VAD_MARGIN_DB, VAD_MIN_SPEECH_DBFS)
+    return np.flatnonzero(frame_dbfs > threshold_dbfs)
+
+
+def find_speech_bounds(samples: np.ndarray, sample_rate: int = WHISPER_SAMPLE_RATE) -> Tuple[int, int]:
+    """
+    Find where speech starts and ends using frame energy
+    Args:
+        samples (np.ndarray): Mono 16-bit PCM samples
+        sample_rate (int): Sample rate of the samples
+    Returns:
+        Tuple[int, int]: First and last (exclusive) sample to keep. The whole clip if no speech is found.
+    """
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    if len(samples) < frame_length:
+        return 0, len(samples)
+
+    speech_frames = find_speech_frames(get_frame_levels_dbfs(samples, sample_rate))
+    if len(speech_frames) == 0:
+        return 0, len(samples)
+
+    padding = int(sample_rate * VAD_PADDING_SECONDS)
+    start = max(speech_frames[0] * frame_length - padding, 0)
+    end = min((speech_frames[-1] + 1) * frame_length + padding, len(samples))
+    return start, end
+
+
+def find_segment_bounds(samples: np.ndarray, max_segment_seconds: float,
+                        sample_rate: int = WHISPER_SAMPLE_RATE) -> List[Tuple[int, int]]:
+    """
+    Split speech into segments of bounded length, cutting at the quietest moment
+    in the second half of each segment so cuts fall in pauses where possible
+    Args:
+        samples (np.ndarray): Mono 16-bit PCM samples
+        max_segment_seconds (float): Longest segment to produce
+        sample_rate (int): Sample rate of the samples
+    Returns:
+        List[Tuple[int, int]]: First and last (exclusive) sample of each segment, in order
+    """
+    max_segment_length = int(sample_rate * max_segment_seconds)
+    if len(samples) <= max_segment_length:
+        return [(0, len(samples))]
+
+    frame_length = int(sample_rate * VAD_FRAME_SECONDS)
+    frame_dbfs = get_frame_levels_dbfs(samples, sample_rate)
+    speech_frames = set(find_speech_frames(frame_dbfs).tolist())
+    half_overlap = int(sample_rate * LONG_AUDIO_OVERLAP_SECONDS) // 2
+
+    bounds = []
+    start = 0
+    while len(samples) - start > max_segment_length:
+        # Leave room for half the overlap after the cut
+        search_from = (start + max_segment_length // 2) // frame_length
+        search_to = max((start + max_segment_length - half_overlap) // frame_length, search_from + 1)
+        cut_frame = search_from + int(np.argmin(frame_dbfs[search_from:search_to]))
+        cut = cut_frame * frame_length + frame_length // 2
+
+        if cut_frame in speech_frames:
+            # No pause to cut in; overlap the segments around the cut
+            bounds.append((start, cut + half_overlap))
+            start = cut - half_overlap
+        else:
+            bounds.append((start, cut))
+            start = cut
+
+    bounds.append((start, len(samples)))
+    return bounds
+
+
+async def encode_speech_for_transcription(samples: np.ndarray,
+                                          max_segment_seconds: Optional[float] = None) -> List[bytes]:
+    """
+    Encode 16 kHz mono speech as low bitrate MP3, split into segments if it is long
+    Args:
+        samples (np.ndarray): Mono 16-bit PCM samples
+        max_segment_seconds (Optional[float]): Longest segment to produce, no splitting if None
+    Returns:
+        List[bytes]: The MP3 audio of each segment, in order
+    """
+    if max_segment_seconds is None:
+        bounds = [(0, len(samples))]
+    else:
+        bounds = find_segment_bounds(samples, max_segment_seconds)
+
+    transcoder = get_transcoder()
+    return list(await asyncio.gather(*(
+        transcoder.encode_mp3(
+            samples[start:end].tobytes(), sample_rate=WHISPER_SAMPLE_RATE, channels=1, bitrate=WHISPER_BITRATE
+        )
+        for start, end in bounds
+    )))
+
+
+async def preprocess_audio_for_transcription(data: bytes,
+                                             max_segment_seconds: Optional[float] = None) -> Tuple[List[bytes], Dict[str, float]]:
+    """
+    Prepare user audio for Whisper: decode it to 16 kHz mono, trim the
+    silence before and after the speech, and encode it as low bitrate MP3
+    Args:
+        data (bytes): Raw audio data in any format ffmpeg can read
+        max_segment_seconds (Optional[float]): Split speech longer than this into segments, never if None
+    Returns:
+        Tuple[List[bytes], Dict[str, float]]: The MP3 audio of each segment and a report of what was removed
+    """
+    try:
+        transcoder = get_transcoder()
+        pcm = await transcoder.decode_pcm(data, sample_rate=WHISPER_SAMPLE_RATE, channels=1)
+        samples = np.frombuffer(pcm, dtype=np.int16)
+
+        start, end = find_speech_bounds(samples)
+        speech = samples[start:end]
+
+        segments = await encode_speech_for_transcription(speech, max_segment_seconds)
+
+        original_seconds = len(samples) / WHISPER_SAMPLE_RATE
+        speech_seconds = len(speech) / WHISPER_SAMPLE_RATE
+        output_bytes = sum(len(segment) for segment in segments)
+        report = {
+            'original_seconds': original_seconds,
+            'speech_seconds': speech_seconds,
+            'removed_seconds': original_seconds - speech_seconds,
+            'original_bytes': len(data),
+            'output_bytes': output_bytes,
+            'removed_bytes': len(data) - output_bytes,
+            'segments': len(segments),
+        }
+        print(f"Trimmed {report['removed_seconds']:.2f}s of silence, "
+              f"{report['original_bytes']} -> {report['output_bytes']} bytes in {len(segments)} segment(s)")
+        return segments, report
+
+    except TranscodingError as e:
+        print(f"Transcoding error: {e}")
+        raise Exception(f"Failed to preprocess audio data: {e}")
+    except Exception as e:
+        print(f"Error during preprocessing: {str(e)}")
+        raise
@@ -0,0 +1,51 @@
+import struct
+from typing import Optional
+from transcoding.format_detection import detect_audio_format
+from transcoding.transcoding_services import get_transcoder, TranscodingError
+
+# Sample rate the start of an upload is decoded at to measure its bitrate
+PROBE_SAMPLE_RATE = 8000
+
+
+def get_wav_byte_rate(header: bytes) -> Optional[int]:
+    """
+    Read the byte rate from the fmt chunk of a WAV header
+    Args:
+        header (bytes): The start of the file
+    Returns:
+        Optional[int]: Bytes of audio per second, or None if the fmt chunk isn't in the header
+    """
+    offset = 12
+    while offset + 8 <= len(header):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', header, offset)
+        if chunk_id == b'fmt ':
+            if offset + 20 > len(header):
+                return None
+            return struct.unpack_from('<I', header, offset + 16)[0] or None
+        offset += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+async def measure_seconds_per_byte(head: bytes) -> Optional[float]:
+    """
+    Measure how many seconds of audio each byte of an upload holds, from its
+    first bytes, so its duration can be estimated before the rest has arrived.
+    WAV is read from the header; anything else is measured by decoding the
+    start, which is close for the near-constant bitrates recorders produce.
+    Args:
+        head (bytes): The start of the upload, or all of it
+    Returns:
+        Optional[float]: Seconds per byte, or None if the start couldn't be decoded
+            (some containers, like MP4 with its index at the end, need the whole file)
+    """
+    if detect_audio_format(head) == 'wav':
+        byte_rate = get_wav_byte_rate(head)
+        return 1 / byte_rate if byte_rate else None
+
+    try:
+        pcm = await get_transcoder().decode_pcm(head, PROBE_SAMPLE_RATE)
+    except TranscodingError:
+        return None
+    if not pcm:
+        return None
+    return len(pcm) / (2 * PROBE_SAMPLE_RATE) / len(head)
@@ -0,0 +1,72 @@
+import os
+from collections import Counter
+from typing import Optional
+from utils.metrics import register_callback_metric
+
+# Formats Whisper accepts as they are, by the file extension it expects
+WHISPER_ACCEPTED_FORMATS = {'flac', 'm4a', 'mp3', 'ogg', 'wav', 'webm'}
+# Whisper rejects uploads larger than 25 MB
+WHISPER_MAX_UPLOAD_BYTES = int(os.getenv('WHISPER_MAX_UPLOAD_BYTES', str(25 * 1024 * 1024)))
+
+# How often uploads could skip ffmpeg, and which formats they arrive in
+bypass_stats = Counter()
+register_callback_metric(
+    'voice_assistant_transcoding_bypass_total', 'Uploads by detected format and whether ffmpeg was skipped',
+    'counter', 'event', lambda: bypass_stats
+)
+
+
+def _is_mp3_frame_header(data: bytes) -> bool:
+    # 11 sync bits, then an MPEG version other than "reserved" and a layer
+    # other than 00 (which is AAC ADTS, not MP3)
+    return (len(data) >= 2 and data[0] == 0xFF and (data[1] & 0xE0) == 0xE0
+            and (data[1] & 0x18) != 0x08 and (data[1] & 0x06) != 0x00)
+
+
+def detect_audio_format(data: bytes) -> Optional[str]:
+    """
+    Detect the container of an audio upload from its first bytes. The file
+    name and content type sent by browsers can't be trusted; MediaRecorder
+    output is usually WebM even when it is uploaded as "recording.mp3".
+    Args:
+        data (bytes): The start of the upload, at least 64 bytes
+    Returns:
+        Optional[str]: The format as a file extension, or None if it isn't recognized
+    """
+    header = data[:64]
+
+    if header.startswith(b'\x1a\x45\xdf\xa3'):
+        # EBML header. The DocType tells WebM apart from other Matroska files.
+        return 'webm' if b'webm' in header else 'mkv'
+    if header.startswith(b'OggS'):
+        return 'ogg'
+    if header.startswith(b'RIFF') and header[8:12] == b'WAVE':
+        return 'wav'
+    if header.startswith(b'fLaC'):
+        return 'flac'
+    if header[4:8] == b'ftyp':
+        return 'm4a'
+    if header.startswith(b'ID3') or _is_mp3_frame_header(header):
+        return 'mp3'
+    if len(header) >= 2 and header[0] == 0xFF and (header[1] & 0xF6) == 0xF0:
+        return 'aac'
+    return None
+
+
+def can_bypass_transcoding(data: bytes) -> Optional[str]:
+    """
+    Check whether an upload can go to Whisper without transcoding
+    Args:
+        data (bytes): The complete upload
+    Returns:
+        Optional[str]: The detected format if the upload can be sent as is, otherwise None
+    """
+    audio_format = detect_audio_format(data)
+    bypass_stats[f"format:{audio_format or 'unknown'}"] += 1
+
+    if audio_format in WHISPER_ACCEPTED_FORMATS and len(data) <= WHISPER_MAX_UPLOAD_BYTES:
+        bypass_stats['bypassed'] += 1
+        return audio_format
+
+    bypass_stats['transcoded'] += 1
+    return None
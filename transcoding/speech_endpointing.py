@@ -0,0 +1,104 @@
+import asyncio
+import os
+from typing import AsyncIterator
+import numpy as np
+from transcoding.audio_preprocessing import (
+    WHISPER_SAMPLE_RATE, VAD_FRAME_SECONDS, get_frame_levels_dbfs, find_speech_frames, find_speech_bounds
+)
+from transcoding.transcoding_services import StreamingPcmDecoder
+
+# The user has finished speaking after this much silence following speech
+ENDPOINT_SILENCE_SECONDS = float(os.getenv('ENDPOINT_SILENCE_SECONDS', '0.8'))
+# Less speech than this (a cough, a click) doesn't count as an utterance
+ENDPOINT_MIN_SPEECH_SECONDS = float(os.getenv('ENDPOINT_MIN_SPEECH_SECONDS', '0.3'))
+# Utterances are cut off at this length even if the user keeps talking
+ENDPOINT_MAX_UTTERANCE_SECONDS = float(os.getenv('ENDPOINT_MAX_UTTERANCE_SECONDS', '60'))
+
+
+class SpeechEndpointDetector:
+    """
+    Collects decoded audio as it arrives and decides when the user has
+    finished speaking. Frame levels are computed once per frame, but speech
+    is re-detected over the whole utterance on every update so the noise
+    floor estimate improves as more of the recording comes in.
+    """
+
+    def __init__(self, sample_rate: int = WHISPER_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.frame_bytes = int(sample_rate * VAD_FRAME_SECONDS) * 2
+        self.pcm = bytearray()
+        self.unmeasured_pcm = bytearray()
+        self.frame_dbfs = np.empty(0)
+        self.has_speech = False
+
+    def feed(self, pcm: bytes) -> bool:
+        """
+        Add the next piece of mono 16-bit PCM
+        Returns:
+            bool: True once the user has stopped speaking or the utterance is too long
+        """
+        self.pcm += pcm
+        self.unmeasured_pcm += pcm
+        measurable = len(self.unmeasured_pcm) // self.frame_bytes * self.frame_bytes
+        if measurable:
+            samples = np.frombuffer(bytes(self.unmeasured_pcm[:measurable]), dtype=np.int16)
+            self.frame_dbfs = np.concatenate([self.frame_dbfs, get_frame_levels_dbfs(samples, self.sample_rate)])
+            del self.unmeasured_pcm[:measurable]
+
+        if len(self.frame_dbfs) == 0:
+            return False
+        if len(self.frame_dbfs) * VAD_FRAME_SECONDS >= ENDPOINT_MAX_UTTERANCE_SECONDS:
+            return True
+
+        speech_frames = find_speech_frames(self.frame_dbfs)
+        self.has_speech = len(speech_frames) * VAD_FRAME_SECONDS >= ENDPOINT_MIN_SPEECH_SECONDS
+        if not self.has_speech:
+            return False
+        trailing_silence_seconds = (len(self.frame_dbfs) - speech_frames[-1] - 1) * VAD_FRAME_SECONDS
+        return trailing_silence_seconds >= ENDPOINT_SILENCE_SECONDS
+
+    def get_speech_pcm(self) -> bytes:
+        """Get the utterance with the silence around it trimmed, or b'' if no speech was heard"""
+        if not self.has_speech:
+            return b''
+        samples = np.frombuffer(bytes(self.pcm[:len(self.pcm) // 2 * 2]), dtype=np.int16)
+        start, end = find_speech_bounds(samples, self.sample_rate)
+        return samples[start:end].tobytes()
+
+
+async def listen_for_utterance(audio: AsyncIterator[bytes]) -> bytes:
+    """
+    Decode a recording while it is still being received and return as soon
+    as the user stops speaking, without waiting for the recording to end
+    Args:
+        audio (AsyncIterator[bytes]): Consecutive pieces of one recording in any format
+            ffmpeg can stream (e.g. WebM timeslices from MediaRecorder). It may end early
+            if the client stops recording.
+    Returns:
+        bytes: The speech as 16 kHz mono 16-bit PCM, or b'' if no speech was heard
+    """
+    decoder = StreamingPcmDecoder(sample_rate=WHISPER_SAMPLE_RATE)
+    detector = SpeechEndpointDetector()
+    await decoder.start()
+
+    async def feed_decoder():
+        try:
+            async for chunk in audio:
+                await decoder.write(chunk)
+        finally:
+            decoder.end_input()
+
+    feeder = asyncio.create_task(feed_decoder())
+    try:
+        while pcm := await decoder.read():
+            if detector.feed(pcm):
+                print(f"✓ End of speech after {len(detector.pcm) / 2 / WHISPER_SAMPLE_RATE:.2f}s of audio")
+                return detector.get_speech_pcm()
+
+        # The recording ended before the user stopped speaking.
+        # Re-raise any error from receiving it.
+        await feeder
+        return detector.get_speech_pcm()
+    finally:
+        feeder.cancel()
+        await decoder.close()
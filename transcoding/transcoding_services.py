@@ -1,5 +1,21 @@
-import subprocess
+import asyncio
+import io
+import os
 import shutil
+from typing import AsyncIterator, Optional
+from utils.admission import stage_limit
+from utils.executors import run_in_stage_executor
+
+try:
+    import av
+    import numpy as np
+except ImportError:  # The in-process engine is optional
+    av = None
+
+# Which engine transcodes in-memory audio: 'subprocess' (spawns ffmpeg) or 'pyav' (in-process)
+TRANSCODER_ENGINE = os.getenv('TRANSCODER_ENGINE', 'subprocess')
+# Bitrate the in-process engine uses when no bitrate is requested, close to ffmpeg's -q:a 2
+DEFAULT_MP3_BITRATE = '192k'
 
 
 def get_ffmpeg_path():
@@ -23,29 +39,400 @@ def get_ffmpeg_path():
     raise FileNotFoundError("ffmpeg not found. Please ensure it's installed and in PATH")
 
 
-def convert_file_to_readable_mp3(local_input_file_path: str, local_output_file_path: str) -> None:
+class TranscodingError(Exception):
+    """Raised when ffmpeg exits with a non-zero status"""
+
+
+async def run_ffmpeg(args: list, input_data: bytes = None) -> bytes:
     """
-    Convert audio file to MP3 format using ffmpeg
+    Run ffmpeg without blocking the event loop
+    Args:
+        args (list): Arguments passed to ffmpeg
+        input_data (bytes): Data written to ffmpeg's stdin, if any
+    Returns:
+        bytes: Everything ffmpeg wrote to stdout
+    """
+    ffmpeg_path = get_ffmpeg_path()
+    print(f"Using ffmpeg at: {ffmpeg_path}")
+
+    # Don't start more ffmpeg processes at once than the machine can run
+    async with stage_limit('ffmpeg'):
+        process = await asyncio.create_subprocess_exec(
+            ffmpeg_path, *args,
+            stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate(input=input_data)
+
+    if process.returncode != 0:
+        raise TranscodingError(stderr.decode(errors='replace'))
+    return stdout
+
+
+class StreamingFfmpegProcess:
+    """
+    One long-running ffmpeg process that audio is piped through in pieces.
+    Output comes out as soon as ffmpeg has produced it rather than after all
+    of the input has been written.
+    """
+
+    READ_SIZE = 64 * 1024
+
+    def __init__(self):
+        self.process: Optional[asyncio.subprocess.Process] = None
+
+    def get_args(self) -> list:
+        """The ffmpeg arguments, reading from stdin and writing to stdout"""
+        raise NotImplementedError
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(
+            get_ffmpeg_path(),
+            '-loglevel', 'error',
+            *self.get_args(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL
+        )
+
+    async def write(self, data: bytes) -> None:
+        """Feed the next piece of input"""
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
+
+    def end_input(self) -> None:
+        """Signal that no more audio is coming, so ffmpeg flushes and exits"""
+        if not self.process.stdin.is_closing():
+            self.process.stdin.close()
+
+    async def read(self) -> bytes:
+        """Get the next output, or b'' once everything has been processed"""
+        return await self.process.stdout.read(self.READ_SIZE)
+
+    async def close(self) -> None:
+        if self.process and self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+
+
+class StreamingPcmDecoder(StreamingFfmpegProcess):
+    """
+    Decodes audio that arrives in pieces, such as MediaRecorder timeslices,
+    to PCM as soon as ffmpeg can rather than after the whole recording has
+    been received.
     """
+
+    def __init__(self, sample_rate: int, channels: int = 1):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.channels = channels
+
+    def get_args(self) -> list:
+        return [
+            # Start decoding after the first few kilobytes instead of probing for seconds
+            '-probesize', '32768',
+            '-analyzeduration', '0',
+            '-fflags', 'nobuffer',
+            '-i', 'pipe:0',
+            '-ac', str(self.channels),
+            '-ar', str(self.sample_rate),
+            '-f', 's16le',
+            'pipe:1'
+        ]
+
+
+class StreamingOggEncoder(StreamingFfmpegProcess):
+    """
+    Encodes mono PCM that arrives in pieces, such as one sentence of a reply
+    at a time, as a single Ogg Opus or Vorbis stream. Unlike MP3 frames,
+    separately encoded Ogg files can't simply be concatenated.
+    """
+
+    CODECS = {'opus': 'libopus', 'ogg_vorbis': 'libvorbis'}
+    # Short pages, so audio is sent as it is encoded rather than once a second
+    PAGE_DURATION_MICROSECONDS = 100000
+
+    def __init__(self, codec: str, sample_rate: int, bitrate: Optional[str] = None):
+        super().__init__()
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.bitrate = bitrate
+
+    def get_args(self) -> list:
+        args = [
+            '-f', 's16le',
+            '-ac', '1',
+            '-ar', str(self.sample_rate),
+            '-i', 'pipe:0',
+            '-c:a', self.CODECS[self.codec]
+        ]
+        if self.bitrate:
+            args += ['-b:a', self.bitrate]
+        return args + [
+            '-page_duration', str(self.PAGE_DURATION_MICROSECONDS),
+            '-flush_packets', '1',
+            '-f', 'ogg',
+            'pipe:1'
+        ]
+
+
+async def encode_pcm_stream(pcm_chunks: AsyncIterator[bytes], codec: str, sample_rate: int,
+                            bitrate: Optional[str] = None) -> AsyncIterator[bytes]:
+    """
+    Encode consecutive pieces of mono PCM as one Ogg stream, yielding pages as
+    soon as they are encoded
+    Args:
+        pcm_chunks (AsyncIterator[bytes]): Signed 16-bit little-endian PCM
+        codec (str): One of StreamingOggEncoder.CODECS
+        sample_rate (int): Sample rate of the PCM
+        bitrate (Optional[str]): Output bitrate such as '24k', the encoder's default if None
+    Yields:
+        bytes: The Ogg stream
+    """
+    encoder = StreamingOggEncoder(codec, sample_rate, bitrate)
+    await encoder.start()
+
+    async def feed_encoder():
+        try:
+            async for pcm in pcm_chunks:
+                await encoder.write(pcm)
+        finally:
+            encoder.end_input()
+
+    feeder = asyncio.create_task(feed_encoder())
     try:
-        ffmpeg_path = get_ffmpeg_path()
-        print(f"Using ffmpeg at: {ffmpeg_path}")
+        while data := await encoder.read():
+            yield data
+        # Re-raise any error from producing the PCM
+        await feeder
+        if await encoder.process.wait() != 0:
+            raise TranscodingError(f"ffmpeg could not encode {codec} (exit status {encoder.process.returncode})")
+    finally:
+        feeder.cancel()
+        await encoder.close()
+
+
+def parse_bitrate(bitrate: str) -> int:
+    """Convert an ffmpeg style bitrate such as '32k' to bits per second"""
+    bitrate = bitrate.lower()
+    if bitrate.endswith('k'):
+        return int(float(bitrate[:-1]) * 1000)
+    return int(bitrate)
+
+
+class Transcoder:
+    """
+    Decodes and encodes audio held in memory. The conversion functions and
+    the preprocessing stage go through the engine selected by TRANSCODER_ENGINE.
+    """
+
+    name = 'base'
 
-        # Run ffmpeg with full path
-        result = subprocess.run([
-            ffmpeg_path,
+    async def to_mp3(self, data: bytes, sample_rate: Optional[int] = None, channels: Optional[int] = None,
+                     bitrate: Optional[str] = None) -> bytes:
+        """
+        Transcode audio to MP3
+        Args:
+            data (bytes): Audio in any format ffmpeg can read
+            sample_rate (Optional[int]): Output sample rate, the source rate if None
+            channels (Optional[int]): Output channel count, the source count if None
+            bitrate (Optional[str]): Output bitrate such as '32k', high quality if None
+        Returns:
+            bytes: The MP3 audio
+        """
+        raise NotImplementedError
+
+    async def decode_pcm(self, data: bytes, sample_rate: int, channels: int = 1) -> bytes:
+        """Decode audio to interleaved signed 16-bit little-endian PCM"""
+        raise NotImplementedError
+
+    async def encode_mp3(self, pcm: bytes, sample_rate: int, channels: int, bitrate: str) -> bytes:
+        """Encode signed 16-bit little-endian PCM as MP3"""
+        raise NotImplementedError
+
+
+class SubprocessTranscoder(Transcoder):
+    """Spawns an ffmpeg process per conversion and pipes audio through it"""
+
+    name = 'subprocess'
+
+    async def to_mp3(self, data: bytes, sample_rate: Optional[int] = None, channels: Optional[int] = None,
+                     bitrate: Optional[str] = None) -> bytes:
+        args = ['-i', 'pipe:0']
+        if channels:
+            args += ['-ac', str(channels)]
+        if sample_rate:
+            args += ['-ar', str(sample_rate)]
+        args += ['-acodec', 'libmp3lame']
+        args += ['-b:a', bitrate] if bitrate else ['-q:a', '2']  # High quality MP3
+        args += ['-f', 'mp3', 'pipe:1']  # No file extension to infer the format from
+        return await run_ffmpeg(args, input_data=data)
+
+    async def decode_pcm(self, data: bytes, sample_rate: int, channels: int = 1) -> bytes:
+        return await run_ffmpeg([
+            '-i', 'pipe:0',
+            '-ac', str(channels),
+            '-ar', str(sample_rate),
+            '-f', 's16le',
+            'pipe:1'
+        ], input_data=data)
+
+    async def encode_mp3(self, pcm: bytes, sample_rate: int, channels: int, bitrate: str) -> bytes:
+        return await run_ffmpeg([
+            '-f', 's16le',
+            '-ac', str(channels),
+            '-ar', str(sample_rate),
+            '-i', 'pipe:0',
+            '-acodec', 'libmp3lame',
+            '-b:a', bitrate,
+            '-f', 'mp3',
+            'pipe:1'
+        ], input_data=pcm)
+
+
+class PyAVTranscoder(Transcoder):
+    """
+    Decodes, resamples and encodes inside the worker with PyAV (libav bindings)
+    and NumPy buffers, so no process is spawned. The work runs in the transcode
+    thread pool. Audio PyAV can't handle for any reason, such as an unknown
+    codec or a container without an audio stream, is passed to the fallback
+    engine.
+    """
+
+    name = 'pyav'
+
+    def __init__(self, fallback: Transcoder):
+        if av is None:
+            raise ImportError("PyAV is not installed. Install it with 'pip install av'")
+        self.fallback = fallback
+
+    @staticmethod
+    def _decode(data: bytes, sample_rate: Optional[int], channels: Optional[int]) -> tuple:
+        with av.open(io.BytesIO(data), mode='r') as container:
+            stream = container.streams.audio[0]
+            sample_rate = sample_rate or stream.codec_context.sample_rate
+            channels = channels or stream.codec_context.channels
+            resampler = av.AudioResampler(
+                format='s16',
+                layout='mono' if channels == 1 else 'stereo',
+                rate=sample_rate
+            )
+            chunks = []
+            for frame in container.decode(stream):
+                chunks.extend(resampled.to_ndarray().tobytes() for resampled in resampler.resample(frame))
+            chunks.extend(resampled.to_ndarray().tobytes() for resampled in resampler.resample(None))
+        return b''.join(chunks), sample_rate, min(channels, 2)
+
+    @staticmethod
+    def _encode(pcm: bytes, sample_rate: int, channels: int, bitrate: str) -> bytes:
+        layout = 'mono' if channels == 1 else 'stereo'
+        output = io.BytesIO()
+        with av.open(output, mode='w', format='mp3') as container:
+            stream = container.add_stream('libmp3lame', rate=sample_rate, layout=layout)
+            stream.bit_rate = parse_bitrate(bitrate)
+
+            samples = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+            frame = av.AudioFrame.from_ndarray(samples, format='s16', layout=layout)
+            frame.sample_rate = sample_rate
+            for packet in stream.encode(frame):
+                container.mux(packet)
+            for packet in stream.encode(None):
+                container.mux(packet)
+        return output.getvalue()
+
+    def _to_mp3(self, data: bytes, sample_rate: Optional[int], channels: Optional[int], bitrate: str) -> bytes:
+        pcm, sample_rate, channels = self._decode(data, sample_rate, channels)
+        return self._encode(pcm, sample_rate, channels, bitrate)
+
+    async def to_mp3(self, data: bytes, sample_rate: Optional[int] = None, channels: Optional[int] = None,
+                     bitrate: Optional[str] = None) -> bytes:
+        try:
+            return await run_in_stage_executor(
+                'transcode', self._to_mp3, data, sample_rate, channels, bitrate or DEFAULT_MP3_BITRATE
+            )
+        except Exception as e:
+            print(f"PyAV could not transcode audio, falling back to {self.fallback.name}: {e!r}")
+            return await self.fallback.to_mp3(data, sample_rate, channels, bitrate)
+
+    async def decode_pcm(self, data: bytes, sample_rate: int, channels: int = 1) -> bytes:
+        try:
+            pcm, _, _ = await run_in_stage_executor('transcode', self._decode, data, sample_rate, channels)
+            return pcm
+        except Exception as e:
+            print(f"PyAV could not decode audio, falling back to {self.fallback.name}: {e!r}")
+            return await self.fallback.decode_pcm(data, sample_rate, channels)
+
+    async def encode_mp3(self, pcm: bytes, sample_rate: int, channels: int, bitrate: str) -> bytes:
+        return await run_in_stage_executor('transcode', self._encode, pcm, sample_rate, channels, bitrate)
+
+
+_transcoder: Optional[Transcoder] = None
+
+
+def create_transcoder(engine: str) -> Transcoder:
+    """Create a transcoding engine by name, falling back to ffmpeg subprocesses if PyAV is missing"""
+    if engine == 'pyav':
+        try:
+            return PyAVTranscoder(fallback=SubprocessTranscoder())
+        except ImportError as e:
+            print(f"{str(e)}. Using the subprocess transcoder instead.")
+            return SubprocessTranscoder()
+    if engine == 'subprocess':
+        return SubprocessTranscoder()
+    raise ValueError(f"Unknown TRANSCODER_ENGINE: {engine}")
+
+
+def get_transcoder() -> Transcoder:
+    """Get or create the transcoding engine selected by TRANSCODER_ENGINE"""
+    global _transcoder
+    if _transcoder is None:
+        _transcoder = create_transcoder(TRANSCODER_ENGINE)
+    return _transcoder
+
+
+async def convert_file_to_readable_mp3(local_input_file_path: str, local_output_file_path: str) -> None:
+    """
+    Convert audio file to MP3 format using ffmpeg
+    """
+    try:
+        await run_ffmpeg([
             '-i', local_input_file_path,
             '-acodec', 'libmp3lame',
             '-q:a', '2',  # High quality MP3
             local_output_file_path
-        ], capture_output=True, text=True, check=True)
+        ])
 
         print("Conversion successful")
         return True
 
-    except subprocess.CalledProcessError as e:
-        print(f"FFmpeg error: {e.stderr}")
-        raise Exception(f"Failed to convert audio file: {e.stderr}")
+    except TranscodingError as e:
+        print(f"FFmpeg error: {e}")
+        raise Exception(f"Failed to convert audio file: {e}")
+    except Exception as e:
+        print(f"Error during conversion: {str(e)}")
+        raise
+
+
+async def convert_bytes_to_readable_mp3(data: bytes) -> bytes:
+    """
+    Convert audio data to MP3 format in memory with the configured engine.
+    The subprocess engine pipes the data through ffmpeg's stdin and stdout,
+    the PyAV engine converts it in-process, so no files are written.
+    Args:
+        data (bytes): Raw audio data in any format ffmpeg can read
+    Returns:
+        bytes: The MP3 encoded audio
+    """
+    try:
+        transcoded_audio = await get_transcoder().to_mp3(data)
+
+        print("Conversion successful")
+        return transcoded_audio
+
+    except TranscodingError as e:
+        print(f"FFmpeg error: {e}")
+        raise Exception(f"Failed to convert audio data: {e}")
     except Exception as e:
         print(f"Error during conversion: {str(e)}")
         raise
\ No newline at end of file
@@ -0,0 +1,222 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+from utils.executors import STAGE_POOL_SIZES
+from utils.metrics import counter, gauge, histogram, stage_span
+
+# How many requests run the pipeline at once, and how many more may wait for
+# a turn. Beyond that requests are turned away with a 429 right away instead
+# of queueing until every one of them times out.
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '16'))
+MAX_QUEUED_REQUESTS = int(os.getenv('MAX_QUEUED_REQUESTS', '32'))
+# A request that has waited this long is turned away too; it would likely time out anyway
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_SECONDS', '10'))
+# Background work, like batch clips, only takes a turn when no request is waiting for one,
+# and takes at most this many of the turns at once so requests always find some free
+MAX_CONCURRENT_BACKGROUND = int(os.getenv('MAX_CONCURRENT_BACKGROUND', str(max(MAX_CONCURRENT_REQUESTS // 4, 1))))
+# How often background work waiting for a turn checks for spare capacity
+BACKGROUND_ADMISSION_POLL_SECONDS = 0.5
+# Retry-After estimate used until some requests have completed
+DEFAULT_SERVICE_SECONDS = 5.0
+MAX_RETRY_AFTER_SECONDS = 60
+
+# Calls to each upstream or CPU-bound stage in flight at once, across all requests
+STAGE_CONCURRENCY_LIMITS = {
+    'ffmpeg': int(os.getenv('FFMPEG_CONCURRENCY', str(os.cpu_count() or 2))),
+    'whisper': int(os.getenv('WHISPER_CONCURRENCY', '16')),
+    'gpt': int(os.getenv('GPT_CONCURRENCY', '16')),
+    'polly': int(os.getenv('POLLY_CONCURRENCY', str(STAGE_POOL_SIZES['tts']))),
+}
+
+ADMISSION_REQUESTS = gauge(
+    'voice_assistant_admission_requests', 'Requests running the pipeline and waiting to be admitted', ('state',)
+)
+ADMISSION_WAIT_SECONDS = histogram('voice_assistant_admission_wait_seconds', 'Time requests waited to be admitted')
+ADMISSION_REJECTIONS = counter('voice_assistant_admission_rejections_total', 'Requests turned away', ('reason',))
+STAGE_LIMIT_CALLS = gauge(
+    'voice_assistant_stage_limit_calls', 'Calls running and waiting per concurrency-limited stage', ('stage', 'state')
+)
+STAGE_LIMIT_WAIT_SECONDS = histogram(
+    'voice_assistant_stage_limit_wait_seconds', 'Time calls waited for a concurrency-limited stage', ('stage',)
+)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can't be admitted because the server is at capacity"""
+
+    def __init__(self, reason: str, retry_after_seconds: int):
+        super().__init__(f"Server is at capacity ({reason}), retry in {retry_after_seconds}s")
+        self.reason = reason
+        self.retry_after_seconds = retry_after_seconds
+
+
+class Admission:
+    """A request's turn to run the pipeline. Releasing it more than once is harmless."""
+
+    def __init__(self, controller: 'AdmissionController', background: bool = False):
+        self._controller = controller
+        self._admitted_at = time.perf_counter()
+        self._background = background
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(time.perf_counter() - self._admitted_at, self._background)
+
+
+class AdmissionController:
+    """
+    Limits how many requests run at once, with a bounded FIFO wait queue.
+    Requests that find the queue full, or wait longer than the queue timeout,
+    are rejected with an estimate of when capacity will be available.
+    Background work shares the same turns at a lower priority.
+    """
+
+    # Weight of the latest request in the average service time
+    SERVICE_TIME_SMOOTHING = 0.2
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REQUESTS, max_queued: int = MAX_QUEUED_REQUESTS,
+                 queue_timeout_seconds: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                 max_background: int = MAX_CONCURRENT_BACKGROUND):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.max_background = max_background
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.running = 0
+        self.queued = 0
+        # Background turns, which are also counted as running
+        self.background = 0
+        self.average_service_seconds = DEFAULT_SERVICE_SECONDS
+
+    def retry_after_seconds(self) -> int:
+        """Roughly how long until the requests already waiting have been admitted"""
+        drain_seconds = self.average_service_seconds * (self.queued + 1) / self.max_concurrent
+        return min(max(math.ceil(drain_seconds), 1), MAX_RETRY_AFTER_SECONDS)
+
+    def _update_gauges(self) -> None:
+        ADMISSION_REQUESTS.set(self.running, state='running')
+        ADMISSION_REQUESTS.set(self.queued, state='queued')
+        ADMISSION_REQUESTS.set(self.background, state='background')
+
+    async def admit(self) -> Admission:
+        """
+        Wait for a turn to run the pipeline
+        Returns:
+            Admission: Release it once the request no longer needs the pipeline
+        Raises:
+            AdmissionRejected: If the queue is full or the wait timed out
+        """
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            ADMISSION_REJECTIONS.inc(reason='queue_full')
+            raise AdmissionRejected('queue full', self.retry_after_seconds())
+
+        started_at = time.perf_counter()
+        self.queued += 1
+        self._update_gauges()
+        try:
+            with stage_span('queue'):
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            ADMISSION_REJECTIONS.inc(reason='timeout')
+            raise AdmissionRejected('queue timeout', self.retry_after_seconds())
+        finally:
+            self.queued -= 1
+            self._update_gauges()
+            ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - started_at)
+
+        self.running += 1
+        self._update_gauges()
+        return Admission(self)
+
+    async def admit_background(self) -> Admission:
+        """
+        Wait for a turn to run background work through the pipeline. A turn is
+        only taken while no request is waiting and fewer than max_background
+        are in use, so background work never makes a request wait longer than
+        for the work already running. It waits as long as that takes.
+        Returns:
+            Admission: Release it once the work no longer needs the pipeline
+        """
+        while self._semaphore.locked() or self.queued > 0 or self.background >= self.max_background:
+            await asyncio.sleep(BACKGROUND_ADMISSION_POLL_SECONDS)
+        # Taken at once, as the semaphore isn't locked
+        await self._semaphore.acquire()
+        self.running += 1
+        self.background += 1
+        self._update_gauges()
+        return Admission(self, background=True)
+
+    def _release(self, service_seconds: float, background: bool = False) -> None:
+        self.running -= 1
+        if background:
+            self.background -= 1
+        else:
+            # Retry-After estimates are for requests, so background work isn't averaged in
+            self.average_service_seconds += (
+                self.SERVICE_TIME_SMOOTHING * (service_seconds - self.average_service_seconds)
+            )
+        self._update_gauges()
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def admitted(self) -> AsyncIterator[None]:
+        """Run the enclosed block as an admitted request"""
+        admission = await self.admit()
+        try:
+            yield
+        finally:
+            admission.release()
+
+
+_admission_controller: Optional[AdmissionController] = None
+
+
+def get_admission_controller() -> AdmissionController:
+    """Get or create the admission controller shared by all endpoints"""
+    global _admission_controller
+    if _admission_controller is None:
+        _admission_controller = AdmissionController()
+    return _admission_controller
+
+
+_stage_semaphores: Dict[str, asyncio.Semaphore] = {}
+_stage_waiting: Dict[str, int] = {}
+_stage_running: Dict[str, int] = {}
+
+
+@asynccontextmanager
+async def stage_limit(stage: str) -> AsyncIterator[None]:
+    """
+    Hold one of the concurrency slots of a stage, so a burst of requests can't
+    exceed an upstream's rate limits or start more ffmpeg processes than there
+    are cores. Calls beyond the limit wait in FIFO order.
+    Args:
+        stage (str): Name of the stage, one of STAGE_CONCURRENCY_LIMITS
+    """
+    if stage not in _stage_semaphores:
+        _stage_semaphores[stage] = asyncio.Semaphore(STAGE_CONCURRENCY_LIMITS[stage])
+    semaphore = _stage_semaphores[stage]
+
+    started_at = time.perf_counter()
+    _stage_waiting[stage] = _stage_waiting.get(stage, 0) + 1
+    STAGE_LIMIT_CALLS.set(_stage_waiting[stage], stage=stage, state='waiting')
+    try:
+        await semaphore.acquire()
+    finally:
+        _stage_waiting[stage] -= 1
+        STAGE_LIMIT_CALLS.set(_stage_waiting[stage], stage=stage, state='waiting')
+    STAGE_LIMIT_WAIT_SECONDS.observe(time.perf_counter() - started_at, stage=stage)
+
+    _stage_running[stage] = _stage_running.get(stage, 0) + 1
+    STAGE_LIMIT_CALLS.set(_stage_running[stage], stage=stage, state='running')
+    try:
+        yield
+    finally:
+        _stage_running[stage] -= 1
+        STAGE_LIMIT_CALLS.set(_stage_running[stage], stage=stage, state='running')
+        semaphore.release()
@@ -0,0 +1,48 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict
+
+# Thread pool size per pipeline stage. Each stage that still has to make
+# blocking calls gets its own pool so a slow upstream can only exhaust its
+# own threads and never stalls the event loop or the other stages.
+STAGE_POOL_SIZES = {
+    'tts': int(os.getenv('TTS_POOL_SIZE', '8')),
+    'file_io': int(os.getenv('FILE_IO_POOL_SIZE', '4')),
+    'session_store': int(os.getenv('SESSION_STORE_POOL_SIZE', '4')),
+    'batch_store': int(os.getenv('BATCH_STORE_POOL_SIZE', '2')),
+    'transcode': int(os.getenv('TRANSCODE_POOL_SIZE', str(os.cpu_count() or 2))),
+}
+
+_stage_executors: Dict[str, ThreadPoolExecutor] = {}
+
+
+def get_stage_executor(stage: str) -> ThreadPoolExecutor:
+    """Get or create the bounded thread pool for a pipeline stage"""
+    if stage not in _stage_executors:
+        _stage_executors[stage] = ThreadPoolExecutor(
+            max_workers=STAGE_POOL_SIZES[stage],
+            thread_name_prefix=f"{stage}-stage"
+        )
+    return _stage_executors[stage]
+
+
+async def run_in_stage_executor(stage: str, func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a blocking function in the thread pool of a pipeline stage
+    Args:
+        stage (str): Name of the stage, one of STAGE_POOL_SIZES
+        func (Callable): The blocking function to run
+    Returns:
+        Any: Whatever the function returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_stage_executor(stage), partial(func, *args, **kwargs))
+
+
+def shutdown_stage_executors() -> None:
+    """Shut down all stage thread pools, waiting for running calls to finish"""
+    for executor in _stage_executors.values():
+        executor.shutdown(wait=True, cancel_futures=True)
+    _stage_executors.clear()
@@ -1,20 +1,43 @@
+import asyncio
 import tempfile
 import os
+import time
+from typing import List, Optional
 from uuid import uuid4
+from utils.executors import run_in_stage_executor
 
 TMP_FOLDER_NAME = 'oz_voice_assistant'
+# Directory that holds the scratch folder. Defaults to the system temp directory,
+# or to RAM-backed /dev/shm when SCRATCH_USE_RAM is set and it exists.
+SCRATCH_BASE_DIR = os.getenv('SCRATCH_BASE_DIR')
+SCRATCH_USE_RAM = os.getenv('SCRATCH_USE_RAM', 'false').lower() == 'true'
+# Quotas enforced by the janitor on files left behind (e.g. by crashed requests)
+SCRATCH_MAX_AGE_SECONDS = int(os.getenv('SCRATCH_MAX_AGE_SECONDS', '900'))
+SCRATCH_MAX_BYTES = int(os.getenv('SCRATCH_MAX_BYTES', str(512 * 1024 * 1024)))
+SCRATCH_JANITOR_INTERVAL_SECONDS = int(os.getenv('SCRATCH_JANITOR_INTERVAL_SECONDS', '60'))
+
+_tmp_folder_path: Optional[str] = None
 
 def create_if_not_exists(path: str):
     """Create directory if it doesn't exist"""
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
+
+def get_scratch_base_dir() -> str:
+    """Get the directory the scratch folder lives in"""
+    if SCRATCH_BASE_DIR:
+        return SCRATCH_BASE_DIR
+    if SCRATCH_USE_RAM and os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
 def get_tmp_folder_path():
-    """Get path to temporary folder, create if doesn't exist"""
-    path = tempfile.gettempdir()
-    path = os.path.join(path, TMP_FOLDER_NAME)
-    create_if_not_exists(path)
-    return path
+    """Get path to temporary folder, create it on first use"""
+    global _tmp_folder_path
+    if _tmp_folder_path is None:
+        path = os.path.join(get_scratch_base_dir(), TMP_FOLDER_NAME)
+        create_if_not_exists(path)
+        _tmp_folder_path = path
+    return _tmp_folder_path
 
 def get_unique_tmp_file_path():
     """Generate a unique temporary file path"""
@@ -36,4 +59,87 @@ def persist_binary_file_locally(data: bytes, file_suffix: str) -> str:
     file_path = create_unique_tmp_file(file_suffix)
     with open(file_path, 'wb') as f:
         f.write(data)
-    return file_path
\ No newline at end of file
+    return file_path
+
+def remove_file_quietly(file_path: str) -> None:
+    """Delete a file, ignoring it if it's already gone"""
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+
+class ScratchSpace:
+    """
+    Request-scoped scratch files. Every path handed out is removed when the
+    context exits, whether or not the request succeeded.
+    """
+
+    def __init__(self):
+        self.file_paths: List[str] = []
+
+    def create_file_path(self, file_suffix: str) -> str:
+        """Reserve a unique scratch file path with the given suffix"""
+        file_path = create_unique_tmp_file(file_suffix)
+        self.file_paths.append(file_path)
+        return file_path
+
+    def persist(self, data: bytes, file_suffix: str) -> str:
+        """Save binary data to a scratch file"""
+        file_path = persist_binary_file_locally(data, file_suffix)
+        self.file_paths.append(file_path)
+        return file_path
+
+    def cleanup(self) -> None:
+        for file_path in self.file_paths:
+            remove_file_quietly(file_path)
+        self.file_paths.clear()
+
+    def __enter__(self) -> 'ScratchSpace':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.cleanup()
+
+
+def enforce_scratch_quotas(max_age_seconds: int = SCRATCH_MAX_AGE_SECONDS,
+                           max_bytes: int = SCRATCH_MAX_BYTES) -> int:
+    """
+    Remove scratch files older than the age quota, then the oldest files
+    until the folder is under the size quota
+    Returns:
+        int: Number of files removed
+    """
+    entries = []
+    with os.scandir(get_tmp_folder_path()) as scan:
+        for entry in scan:
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+    entries.sort()
+
+    now = time.time()
+    total_bytes = sum(size for _, size, _ in entries)
+    removed = 0
+    for modified_at, size, file_path in entries:
+        if now - modified_at <= max_age_seconds and total_bytes <= max_bytes:
+            break
+        remove_file_quietly(file_path)
+        total_bytes -= size
+        removed += 1
+    return removed
+
+
+async def run_scratch_janitor(interval_seconds: int = SCRATCH_JANITOR_INTERVAL_SECONDS) -> None:
+    """Enforce the scratch quotas periodically until cancelled"""
+    while True:
+        try:
+            removed = await run_in_stage_executor('file_io', enforce_scratch_quotas)
+            if removed:
+                print(f"Scratch janitor removed {removed} file(s)")
+        except Exception as e:
+            print(f"Scratch janitor error: {str(e)}")
+        await asyncio.sleep(interval_seconds)
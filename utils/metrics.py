@@ -0,0 +1,285 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from uuid import uuid4
+
+# Latency buckets in seconds, from a cache hit up to a slow upstream call
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+UPLOAD_BYTES_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+AUDIO_SECONDS_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+PROMPT_TOKENS_BUCKETS = (250, 500, 1000, 2000, 4000, 6000, 8000)
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape_label_value(str(value))}"' for name, value in zip(label_names, label_values))
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    """A metric in the Prometheus text exposition format"""
+
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yield (name suffix, formatted labels, value) for every sample"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{self.name}{suffix}{labels} {value:g}" for suffix, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class CounterMetric(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '', _format_labels(self.label_names, key), value
+
+
+class GaugeMetric(CounterMetric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            self._values[key] = value
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.label_names)
+        with self._lock:
+            bucket_counts, _, _ = series = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    bucket_counts[index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        with self._lock:
+            values = [(key, list(bucket_counts), total, count) for key, (bucket_counts, total, count) in self._values.items()]
+        bucket_label_names = self.label_names + ('le',)
+        for key, bucket_counts, total, count in values:
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                yield '_bucket', _format_labels(bucket_label_names, key + (f"{upper_bound:g}",)), bucket_count
+            yield '_bucket', _format_labels(bucket_label_names, key + ('+Inf',)), count
+            yield '_sum', _format_labels(self.label_names, key), total
+            yield '_count', _format_labels(self.label_names, key), count
+
+
+class CallbackMetric(Metric):
+    """
+    Exports statistics kept elsewhere (such as a component's stats Counter)
+    at scrape time. The callback returns a mapping of label value to value.
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str, label_name: str,
+                 callback: Callable[[], Mapping[str, float]]):
+        super().__init__(name, documentation, (label_name,))
+        self.type = metric_type
+        self.callback = callback
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for label_value, value in dict(self.callback()).items():
+            yield '', _format_labels(self.label_names, (label_value,)), value
+
+
+_registry: Dict[str, Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric: Metric) -> Metric:
+    with _registry_lock:
+        return _registry.setdefault(metric.name, metric)
+
+
+def counter(name: str, documentation: str, label_names: Sequence[str] = ()) -> CounterMetric:
+    """Get or create a registered counter"""
+    return _register(CounterMetric(name, documentation, label_names))
+
+
+def gauge(name: str, documentation: str, label_names: Sequence[str] = ()) -> GaugeMetric:
+    """Get or create a registered gauge"""
+    return _register(GaugeMetric(name, documentation, label_names))
+
+
+def histogram(name: str, documentation: str, label_names: Sequence[str] = (),
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> HistogramMetric:
+    """Get or create a registered histogram"""
+    return _register(HistogramMetric(name, documentation, label_names, buckets))
+
+
+def register_callback_metric(name: str, documentation: str, metric_type: str, label_name: str,
+                             callback: Callable[[], Mapping[str, float]]) -> None:
+    """Export statistics kept elsewhere, read at scrape time"""
+    _register(CallbackMetric(name, documentation, metric_type, label_name, callback))
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+STAGE_SECONDS = histogram(
+    'voice_assistant_stage_seconds',
+    'Time each pipeline stage was running per request',
+    ('stage',)
+)
+STAGE_CALLS = counter('voice_assistant_stage_calls_total', 'Calls made by each pipeline stage', ('stage',))
+REQUEST_SECONDS = histogram(
+    'voice_assistant_request_seconds', 'Total time per request', ('endpoint', 'outcome')
+)
+REQUESTS = counter('voice_assistant_requests_total', 'Requests handled', ('endpoint', 'outcome'))
+UPLOAD_BYTES = histogram(
+    'voice_assistant_upload_bytes', 'Size of uploaded audio', ('endpoint',), UPLOAD_BYTES_BUCKETS
+)
+AUDIO_SECONDS = histogram(
+    'voice_assistant_audio_seconds', 'Duration of uploaded audio, where known', ('endpoint',), AUDIO_SECONDS_BUCKETS
+)
+PROMPT_TOKENS = histogram(
+    'voice_assistant_prompt_tokens', 'Prompt tokens sent to GPT per request', ('endpoint',), PROMPT_TOKENS_BUCKETS
+)
+
+# Request attributes that are also recorded as histograms
+_ATTRIBUTE_HISTOGRAMS = {
+    'upload_bytes': UPLOAD_BYTES,
+    'audio_seconds': AUDIO_SECONDS,
+    'prompt_tokens': PROMPT_TOKENS,
+}
+
+
+class RequestTrace:
+    """
+    Timing spans and attributes of one request. A stage that runs several
+    times is reported as the time during which at least one of its calls was
+    running, so TTS calls for several sentences at once aren't counted twice,
+    and the gap between loading and saving the history isn't counted at all.
+    """
+
+    def __init__(self, endpoint: str, request_id: Optional[str] = None):
+        self.endpoint = endpoint
+        self.request_id = request_id or uuid4().hex
+        self.started_at = time.perf_counter()
+        # stage -> (start, end) of each call
+        self.stages: Dict[str, List[Tuple[float, float]]] = {}
+        self.attributes: Dict[str, Any] = {}
+        self.finished = False
+
+    def record_span(self, stage: str, started_at: float, ended_at: float) -> None:
+        self.stages.setdefault(stage, []).append((started_at, ended_at))
+
+    def stage_durations(self) -> Dict[str, float]:
+        """Seconds spent in each stage so far"""
+        durations = {}
+        for stage, spans in self.stages.items():
+            total, covered_until = 0.0, float('-inf')
+            for started_at, ended_at in sorted(spans):
+                started_at = max(started_at, covered_until)
+                if ended_at > started_at:
+                    total += ended_at - started_at
+                    covered_until = ended_at
+            durations[stage] = total
+        return durations
+
+    def server_timing(self) -> str:
+        """The stage durations as a Server-Timing header value"""
+        return ', '.join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stage_durations().items())
+
+    def finish(self, outcome: str = 'ok') -> None:
+        """Record the request's metrics and log its timings, once"""
+        if self.finished:
+            return
+        self.finished = True
+        total_seconds = time.perf_counter() - self.started_at
+
+        REQUESTS.inc(endpoint=self.endpoint, outcome=outcome)
+        REQUEST_SECONDS.observe(total_seconds, endpoint=self.endpoint, outcome=outcome)
+        stage_durations = self.stage_durations()
+        for stage, seconds in stage_durations.items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+            STAGE_CALLS.inc(len(self.stages[stage]), stage=stage)
+        for name, value in self.attributes.items():
+            if name in _ATTRIBUTE_HISTOGRAMS and value is not None:
+                _ATTRIBUTE_HISTOGRAMS[name].observe(value, endpoint=self.endpoint)
+
+        print("Request timings: " + json.dumps({
+            'request_id': self.request_id,
+            'endpoint': self.endpoint,
+            'outcome': outcome,
+            'total_ms': round(total_seconds * 1000, 1),
+            'stages_ms': {stage: round(seconds * 1000, 1) for stage, seconds in stage_durations.items()},
+            **self.attributes,
+        }))
+
+
+_current_trace: ContextVar[Optional[RequestTrace]] = ContextVar('current_trace', default=None)
+
+
+def start_trace(endpoint: str, request_id: Optional[str] = None) -> RequestTrace:
+    """Start tracing a request. Spans recorded in this context and tasks started from it belong to it."""
+    trace = RequestTrace(endpoint, request_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def set_trace_attribute(name: str, value: Any) -> None:
+    """Attach an attribute such as upload_bytes to the current request's trace, if any"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes[name] = value
+
+
+@contextmanager
+def stage_span(stage: str) -> Iterator[None]:
+    """Time a pipeline stage of the current request. Failed calls are timed too."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.record_span(stage, started_at, time.perf_counter())
+        else:
+            # Work outside a traced request still shows up in the stage histogram
+            STAGE_SECONDS.observe(time.perf_counter() - started_at, stage=stage)
+            STAGE_CALLS.inc(stage=stage)
@@ -0,0 +1,171 @@
+import re
+from typing import List, Tuple
+
+# A sentence ends at ., ! or ? (optionally followed by closing quotes/brackets)
+# and is followed by whitespace. Newlines also act as hard boundaries.
+SENTENCE_BOUNDARY_PATTERN = re.compile(r'(?<=[.!?])\s+|(?<=[.!?]["\')\]])\s+|\n+')
+
+# Fragments shorter than this are merged into the next sentence so we don't
+# send tiny requests like "1." or "Yes." to the TTS engine on their own.
+MIN_SENTENCE_LENGTH = 20
+
+
+def split_into_sentences(text: str, min_length: int = MIN_SENTENCE_LENGTH) -> List[str]:
+    """
+    Split text into sentences that can be synthesized independently
+    Args:
+        text (str): Text to split
+        min_length (int): Fragments shorter than this are merged with the next one
+    Returns:
+        List[str]: Non-empty sentences in their original order
+    """
+    sentences = []
+    pending = ''
+
+    for fragment in SENTENCE_BOUNDARY_PATTERN.split(text):
+        fragment = fragment.strip()
+        if not fragment:
+            continue
+
+        pending = f"{pending} {fragment}" if pending else fragment
+        if len(pending) >= min_length:
+            sentences.append(pending)
+            pending = ''
+
+    if pending:
+        sentences.append(pending)
+
+    return sentences
+
+
+# Clause boundaries used to break up long sentences while text is still streaming in
+CLAUSE_BOUNDARY_PATTERN = re.compile(r'[,;:]\s+')
+
+# A streamed sentence longer than this is flushed at its last clause boundary
+# instead of waiting for the sentence to end.
+MAX_UNIT_LENGTH = 200
+
+
+def pop_speakable_units(buffer: str,
+                        min_length: int = MIN_SENTENCE_LENGTH,
+                        max_length: int = MAX_UNIT_LENGTH) -> Tuple[List[str], str]:
+    """
+    Take the complete sentences (or long clauses) off the front of a streaming text buffer
+    Args:
+        buffer (str): Text received so far that hasn't been emitted yet
+        min_length (int): Units shorter than this are held back and merged with the next one
+        max_length (int): Incomplete sentences longer than this are split at a clause boundary
+    Returns:
+        Tuple[List[str], str]: The speakable units and the remaining, incomplete text
+    """
+    fragments = SENTENCE_BOUNDARY_PATTERN.split(buffer)
+    # The last fragment has no boundary after it yet, so it may still grow
+    remainder = fragments.pop()
+
+    units = []
+    pending = ''
+    for fragment in fragments:
+        fragment = fragment.strip()
+        if not fragment:
+            continue
+
+        pending = f"{pending} {fragment}" if pending else fragment
+        if len(pending) >= min_length:
+            units.append(pending)
+            pending = ''
+
+    if pending:
+        remainder = f"{pending} {remainder.lstrip()}"
+
+    if len(remainder) > max_length:
+        clause_ends = [match.end() for match in CLAUSE_BOUNDARY_PATTERN.finditer(remainder, 0, max_length)]
+        if clause_ends:
+            units.append(remainder[:clause_ends[-1]].strip())
+            remainder = remainder[clause_ends[-1]:]
+
+    return units, remainder
+
+
+def __split_long_sentence(sentence: str, max_length: int) -> List[str]:
+    """Split a sentence at clause boundaries, or failing that at spaces, into pieces no longer than max_length"""
+    pieces = []
+    while len(sentence) > max_length:
+        clause_ends = [match.end() for match in CLAUSE_BOUNDARY_PATTERN.finditer(sentence, 0, max_length)]
+        if clause_ends:
+            cut = clause_ends[-1]
+        else:
+            cut = sentence.rfind(' ', 0, max_length + 1)
+            if cut <= 0:
+                cut = max_length
+        pieces.append(sentence[:cut].strip())
+        sentence = sentence[cut:].strip()
+    if sentence:
+        pieces.append(sentence)
+    return pieces
+
+
+def split_into_chunks(text: str, max_length: int) -> List[str]:
+    """
+    Split text into as few chunks as possible, each no longer than max_length,
+    breaking between sentences where possible
+    Args:
+        text (str): Text to split
+        max_length (int): Longest chunk to produce
+    Returns:
+        List[str]: Non-empty chunks in their original order
+    """
+    chunks = []
+    current = ''
+
+    for sentence in split_into_sentences(text, min_length=0):
+        for piece in __split_long_sentence(sentence, max_length):
+            candidate = f"{current} {piece}" if current else piece
+            if len(candidate) <= max_length:
+                current = candidate
+            else:
+                chunks.append(current)
+                current = piece
+
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+# Segments of a long recording that are cut mid-speech overlap slightly, so the
+# same few words can end one transcript and start the next. Matches shorter
+# than this are left alone, since a single repeated word is usually real speech.
+MIN_OVERLAP_WORDS = 2
+MAX_OVERLAP_WORDS = 10
+
+
+def __normalize_word(word: str) -> str:
+    return re.sub(r'[^\w]', '', word.lower())
+
+
+def stitch_transcripts(transcripts: List[str],
+                       min_overlap: int = MIN_OVERLAP_WORDS,
+                       max_overlap: int = MAX_OVERLAP_WORDS) -> str:
+    """
+    Join the transcripts of consecutive segments, dropping words repeated across the seams
+    Args:
+        transcripts (List[str]): Transcripts in recording order
+        min_overlap (int): Fewest matching words treated as an overlap
+        max_overlap (int): Most words searched for an overlap at each seam
+    Returns:
+        str: The combined transcript
+    """
+    words = []
+    for transcript in transcripts:
+        next_words = transcript.split()
+        tail = [__normalize_word(word) for word in words[-max_overlap:]]
+        head = [__normalize_word(word) for word in next_words[:max_overlap]]
+
+        overlap = 0
+        for length in range(min(len(tail), len(head)), min_overlap - 1, -1):
+            if tail[-length:] == head[:length]:
+                overlap = length
+                break
+        words.extend(next_words[overlap:])
+
+    return ' '.join(words)
@@ -0,0 +1,117 @@
+import asyncio
+import os
+import threading
+from typing import Awaitable, Callable, Optional
+import boto3
+import httpx
+from botocore.config import Config
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from search.google_search_client import GoogleSearchClient
+from utils.executors import run_in_stage_executor, STAGE_POOL_SIZES
+from utils.metrics import register_callback_metric
+
+# Keep-alive pool sizes for the upstream services. Polly calls block a TTS
+# thread each, so its pool defaults to the size of the TTS thread pool.
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '50'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '20'))
+POLLY_MAX_CONNECTIONS = int(os.getenv('POLLY_MAX_CONNECTIONS', str(STAGE_POOL_SIZES['tts'])))
+# Open this many connections to each upstream at startup, so the first requests skip the TLS handshakes
+UPSTREAM_WARMUP_CONNECTIONS = int(os.getenv('UPSTREAM_WARMUP_CONNECTIONS', '2'))
+UPSTREAM_WARMUP_TIMEOUT_SECONDS = float(os.getenv('UPSTREAM_WARMUP_TIMEOUT_SECONDS', '5'))
+
+
+class UpstreamClients:
+    """
+    The clients for every upstream service, shared by all requests so their
+    connection pools and TLS sessions are reused. Created and warmed up when
+    the app starts, and closed when it shuts down.
+    """
+
+    def __init__(self):
+        self.openai = AsyncOpenAI(
+            api_key=os.getenv('OPENAI_API_KEY'),
+            http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS
+            ))
+        )
+        self.polly = boto3.client('polly', config=Config(
+            max_pool_connections=POLLY_MAX_CONNECTIONS,
+            tcp_keepalive=True
+        ))
+        self.search = GoogleSearchClient(
+            api_key=os.getenv('GOOGLE_API_KEY'),
+            cse_id=os.getenv('GOOGLE_CSE_ID')
+        )
+
+    async def _warm_up_openai(self) -> None:
+        await self.openai.with_options(max_retries=0, timeout=UPSTREAM_WARMUP_TIMEOUT_SECONDS).models.list()
+
+    async def _warm_up_polly(self) -> None:
+        await run_in_stage_executor('tts', self.polly.describe_voices, LanguageCode='en-US')
+
+    @staticmethod
+    async def _warm_up_connections(name: str, warm_up: Callable[[], Awaitable[None]], connections: int) -> None:
+        results = await asyncio.gather(*(warm_up() for _ in range(connections)), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            print(f"Could not warm up {name} connections: {errors[0]!r}")
+        else:
+            print(f"✓ Warmed up {connections} {name} connection(s)")
+
+    async def warm_up(self, connections: int = UPSTREAM_WARMUP_CONNECTIONS) -> None:
+        """
+        Open connections to each upstream with cheap requests. The upstreams
+        are warmed up at once, and startup waits for them for at most
+        UPSTREAM_WARMUP_TIMEOUT_SECONDS. Failures are only logged; the pools
+        then fill up on the first real requests instead.
+        """
+        warm_ups = {
+            'openai': self._warm_up_openai,
+            'polly': self._warm_up_polly,
+            'search': self.search.warm_up,
+        }
+        tasks = {
+            name: asyncio.create_task(self._warm_up_connections(name, warm_up, connections))
+            for name, warm_up in warm_ups.items()
+        }
+        _, pending = await asyncio.wait(tasks.values(), timeout=UPSTREAM_WARMUP_TIMEOUT_SECONDS)
+        for name, task in tasks.items():
+            if task in pending:
+                task.cancel()
+                print(f"Could not warm up {name} connections: timed out after {UPSTREAM_WARMUP_TIMEOUT_SECONDS}s")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def close(self) -> None:
+        await self.openai.close()
+        await self.search.close()
+        self.polly.close()
+
+
+_upstream_clients: Optional[UpstreamClients] = None
+# Polly calls look up the clients from TTS threads
+_upstream_clients_lock = threading.Lock()
+
+
+def get_upstream_clients() -> UpstreamClients:
+    """Get or create the shared upstream clients"""
+    global _upstream_clients
+    with _upstream_clients_lock:
+        if _upstream_clients is None:
+            _upstream_clients = UpstreamClients()
+        return _upstream_clients
+
+
+async def close_upstream_clients() -> None:
+    """Close the shared upstream clients' connections, if they were created"""
+    global _upstream_clients
+    with _upstream_clients_lock:
+        upstream_clients, _upstream_clients = _upstream_clients, None
+    if upstream_clients is not None:
+        await upstream_clients.close()
+
+
+register_callback_metric(
+    'voice_assistant_search_cache_total', 'Search cache results and upstream requests', 'counter', 'event',
+    lambda: _upstream_clients.search.stats if _upstream_clients is not None else {}
+)